@@ -25,9 +25,27 @@
 #include "io/save_gals_hdf5.h"
 #endif
 
+/* Time taken to process a forest, along with its size. Only recorded when compiled with -DFOREST_TIMING
+   and written to "OutputDir/FileNameGalaxies_forest_timings_<ThisTask>" after a header of
+   (int32_t ThisTask, int32_t NTasks, int64_t nforests, double task_seconds). Read by tests/sagetiming.py */
+struct forest_timing {
+    int64_t original_treenr; // The (file-local) tree number from the original tree files.
+    int64_t nhalos;
+    int32_t filenr;
+    int32_t ngals; // Number of galaxies constructed across all snapshots (not just the output ones).
+    double seconds; // Wall time to load, construct and save the forest.
+};
+
 /* main sage -> not exposed externally */
 int32_t sage_per_forest(const int64_t forestnr, struct save_info *save_info,
-                        struct forest_info *forest_info, struct params *run_params);
+                        struct forest_info *forest_info, struct forest_timing *timing,
+                        struct params *run_params);
+
+#ifdef FOREST_TIMING
+int32_t write_forest_timings(const int ThisTask, const int NTasks, const int64_t nforests,
+                             const struct forest_timing *timings, const double task_seconds,
+                             const struct params *run_params);
+#endif
 
 int init_sage(const int ThisTask, const char *param_file, struct params *run_params)
 {
@@ -107,6 +125,13 @@ int run_sage(const int ThisTask, const int NTasks, struct params *run_params)
                                          sizeof(*(save_info.forest_ngals[snap_idx])), snap_idx);
     }
 
+#ifdef FOREST_TIMING
+    struct forest_timing *timings = mycalloc(Nforests, sizeof(*timings));
+    CHECK_POINTER_AND_RETURN_ON_NULL(timings,
+                                     "Failed to allocate %"PRId64" elements of size %zu for timings", Nforests,
+                                     sizeof(*timings));
+#endif
+
     fprintf(stderr,"Task %d working on %"PRId64" forests covering %.3f fraction of the volume\n",
             ThisTask, Nforests, forest_info.frac_volume_processed);
 
@@ -132,11 +157,26 @@ int run_sage(const int ThisTask, const int NTasks, struct params *run_params)
             my_progressbar(stderr, forestnr, &(run_params->interrupted));
         }
 
+        struct forest_timing *timing = NULL;
+#ifdef FOREST_TIMING
+        timing = &(timings[forestnr]);
+        struct timeval tforest_start;
+        gettimeofday(&tforest_start, NULL);
+#endif
+
         /* the millennium tree is really a collection of trees, viz., a forest */
-        status = sage_per_forest(forestnr, &save_info, &forest_info, run_params);
+        status = sage_per_forest(forestnr, &save_info, &forest_info, timing, run_params);
         if(status != EXIT_SUCCESS) {
             return status;
         }
+
+#ifdef FOREST_TIMING
+        struct timeval tforest_end;
+        gettimeofday(&tforest_end, NULL);
+        timing->seconds = (tforest_end.tv_sec - tforest_start.tv_sec) + 1e-6 * (tforest_end.tv_usec - tforest_start.tv_usec);
+        timing->original_treenr = forest_info.original_treenr[forestnr];
+        timing->filenr = forest_info.FileNr[forestnr];
+#endif
     }
 
     status = finalize_galaxy_files(&forest_info, &save_info, run_params);
@@ -157,6 +197,15 @@ int run_sage(const int ThisTask, const int NTasks, struct params *run_params)
     gettimeofday(&tend, NULL);
     fprintf(stderr,"ThisTask = %d done processing all forests assigned. Time taken = %s\n", ThisTask, get_time_string(tstart, tend));
 
+#ifdef FOREST_TIMING
+    const double task_seconds = (tend.tv_sec - tstart.tv_sec) + 1e-6 * (tend.tv_usec - tstart.tv_usec);
+    status = write_forest_timings(ThisTask, NTasks, Nforests, timings, task_seconds, run_params);
+    myfree(timings);
+    if(status != EXIT_SUCCESS) {
+        return status;
+    }
+#endif
+
 cleanup:
     /* sage is done running -> do the cleanup */
     cleanup_forests_io(run_params->TreeType, &forest_info);
@@ -216,7 +265,8 @@ int32_t finalize_sage(struct params *run_params)
 // Local Functions //
 
 int32_t sage_per_forest(const int64_t forestnr, struct save_info *save_info,
-                        struct forest_info *forest_info, struct params *run_params)
+                        struct forest_info *forest_info, struct forest_timing *timing,
+                        struct params *run_params)
 {
     int32_t status = EXIT_FAILURE;
 
@@ -318,6 +368,11 @@ int32_t sage_per_forest(const int64_t forestnr, struct save_info *save_info,
 
 #endif /* PROCESS_LHVT_STYLE */
 
+    if(timing != NULL) {
+        timing->nhalos = nhalos;
+        timing->ngals = numgals;
+    }
+
     status = save_galaxies(forestnr, numgals, Halo, forest_info, HaloAux, HaloGal, save_info, run_params);
     if(status != EXIT_SUCCESS) {
         return status;
@@ -331,3 +386,34 @@ int32_t sage_per_forest(const int64_t forestnr, struct save_info *save_info,
 
     return EXIT_SUCCESS;
 }
+
+
+#ifdef FOREST_TIMING
+int32_t write_forest_timings(const int ThisTask, const int NTasks, const int64_t nforests,
+                             const struct forest_timing *timings, const double task_seconds,
+                             const struct params *run_params)
+{
+    char buffer[4*MAX_STRING_LEN + 1];
+    snprintf(buffer, 4*MAX_STRING_LEN, "%s/%s_forest_timings_%d", run_params->OutputDir, run_params->FileNameGalaxies, ThisTask);
+
+    FILE *fp = fopen(buffer, "w");
+    if(fp == NULL) {
+        fprintf(stderr, "Error: Could not open file %s to write the forest timings\n", buffer);
+        return FILE_NOT_FOUND;
+    }
+
+    const int32_t task = ThisTask, ntasks = NTasks;
+    if(myfwrite(&task, sizeof(task), 1, fp) != 1 ||
+       myfwrite(&ntasks, sizeof(ntasks), 1, fp) != 1 ||
+       myfwrite(&nforests, sizeof(nforests), 1, fp) != 1 ||
+       myfwrite(&task_seconds, sizeof(task_seconds), 1, fp) != 1 ||
+       myfwrite(timings, sizeof(*timings), nforests, fp) != (size_t) nforests) {
+        fprintf(stderr, "Error: Failed to write the timings of %"PRId64" forests to file %s\n", nforests, buffer);
+        fclose(fp);
+        return FILE_WRITE_ERROR;
+    }
+    fclose(fp);
+
+    return EXIT_SUCCESS;
+}
+#endif
@@ -0,0 +1,497 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+from sagediff import BinarySage, Hdf5Sage, compare_binary_catalogs, \
+    compare_binary_catalogs_streaming, compare_binary_hdf5_all_snapshots, \
+    compare_binary_hdf5_catalogs, determine_hdf5_metadata_fname, load_hdf5_metadata
+from sageconvert import convert_binary_to_hdf5
+from sageutils import lazy_import
+
+np = lazy_import("numpy")
+
+# The directory holding the scripts that are benchmarked.
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Prints whether numpy was imported.  Appended to the snippets run by the start-up benchmark.
+numpy_probe = "import sys; print('numpy' in sys.modules)"
+
+# The (snapshot number, redshift) of the synthetic outputs.  These are the first outputs of
+# Mini-Millennium.
+synthetic_snapshots = [(63, 0.0), (37, 0.989), (32, 1.386), (27, 2.07)]
+
+# The box size (Mpc/h) of the synthetic catalogs.
+synthetic_box_size = 62.5
+
+# The fields read by the projected-read benchmarks.
+projected_fields = ["GalaxyIndex", "StellarMass", "Mvir"]
+
+
+def determine_startup_commands(hdf5_fname=None):
+    """
+    Returns the commands timed by :py:func:`~benchmark_startup` as a list of ``(name,
+    arguments)``.  The bare interpreter is included so that its start-up cost can be
+    subtracted.  If ``hdf5_fname`` is given, metadata-only calls on that HDF5 master file are
+    included as well: one through the cached index and one that rebuilds the index from the
+    file, as :py:func:`sagediff.load_hdf5_metadata` does when the cache is missing or stale.
+    """
+
+    commands = [("python", ["-c", numpy_probe]),
+                ("import sagediff", ["-c", "import sagediff; " + numpy_probe])]
+
+    for script in ["sagediff", "sageconvert", "sagestats"]:
+        commands.append(("{0} --help".format(script),
+                         [os.path.join(tests_dir, "{0}.py".format(script)), "--help"]))
+
+    if hdf5_fname is not None:
+        snippet = "import sagediff; sagediff.load_hdf5_metadata({0!r}); {1}".format(
+            os.path.abspath(hdf5_fname), numpy_probe)
+        commands.append(("load_hdf5_metadata", ["-c", snippet]))
+
+        snippet = "import h5py, sagediff; fname = {0!r}; "\
+                  "sagediff.build_hdf5_metadata(h5py.File(fname, 'r'), fname); {1}".format(
+                      os.path.abspath(hdf5_fname), numpy_probe)
+        commands.append(("load_hdf5_metadata (uncached)", ["-c", snippet]))
+
+    return commands
+
+
+def time_command(arguments, num_repeats):
+    """
+    Runs ``python arguments`` ``num_repeats`` times and returns the wall time (in seconds) of
+    each run and whether numpy was imported (``None`` if the command does not report it).
+    """
+
+    seconds = []
+    imports_numpy = None
+
+    for _ in range(num_repeats):
+        start = time.time()
+        output = subprocess.check_output([sys.executable] + arguments, cwd=tests_dir)
+        seconds.append(time.time() - start)
+
+        lines = output.decode().split()
+        if lines and lines[-1] in ["True", "False"]:
+            imports_numpy = lines[-1] == "True"
+
+    return seconds, imports_numpy
+
+
+def benchmark_startup(hdf5_fname=None, num_repeats=10):
+    """
+    Times the start-up of the scripts in this directory (see
+    :py:func:`~determine_startup_commands`).
+
+    Returns a dictionary keyed by the command name.  Each entry holds the minimum and median
+    wall time (in milliseconds), the median with the start-up of the bare interpreter
+    subtracted, and whether numpy was imported.
+    """
+
+    results = {}
+    for name, arguments in determine_startup_commands(hdf5_fname):
+        seconds, imports_numpy = time_command(arguments, num_repeats)
+        seconds = sorted(seconds)
+        results[name] = {"min_ms": seconds[0] * 1000.0,
+                         "median_ms": seconds[len(seconds) // 2] * 1000.0,
+                         "imports_numpy": imports_numpy}
+
+    baseline_ms = results["python"]["median_ms"]
+    for name in results:
+        results[name]["overhead_ms"] = results[name]["median_ms"] - baseline_ms
+
+    return results
+
+
+def report_startup(results, max_time=None):
+    """
+    Prints the start-up benchmark ``results`` (see :py:func:`~benchmark_startup`).
+
+    Returns the names of the commands whose median time is above ``max_time`` milliseconds.
+    """
+
+    print("{0:<30} {1:>10} {2:>10} {3:>10} {4:>8}".format("command", "min (ms)", "median",
+                                                          "overhead", "numpy"))
+    slow = []
+    for name, result in results.items():
+        imports_numpy = "-" if result["imports_numpy"] is None else result["imports_numpy"]
+        print("{0:<30} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>8}".format(
+            name, result["min_ms"], result["median_ms"], result["overhead_ms"],
+            str(imports_numpy)))
+
+        if max_time is not None and result["median_ms"] > max_time:
+            slow.append(name)
+
+    return slow
+
+
+def determine_synthetic_binary_fname(binary_prefix, redshift, file_idx):
+    """
+    Returns the name of file number ``file_idx`` of the synthetic binary output at
+    ``redshift``.
+    """
+    return "{0}_z{1:.3f}_{2}".format(binary_prefix, redshift, file_idx)
+
+
+def generate_synthetic_snapshot(snap_num, num_gals, num_trees, rng):
+    """
+    Generates ``num_gals`` galaxies at snapshot ``snap_num``, spread over ``num_trees`` trees.
+
+    Returns the number of galaxies in each tree and the galaxies, ordered by tree and using
+    the galaxy struct of :py:class:`~sagediff.BinarySage`.  The values are random but
+    plausible, e.g., every tree has a single central galaxy and ``GalaxyIndex`` is unique.
+    """
+
+    dtype = BinarySage("").dtype
+
+    ngals_per_tree = rng.multinomial(num_gals, np.ones(num_trees) / num_trees).astype(np.int32)
+    tree_nums = np.repeat(np.arange(num_trees, dtype=np.int32), ngals_per_tree)
+    tree_offsets = np.cumsum(ngals_per_tree, dtype=np.int64) - ngals_per_tree
+    is_central = np.zeros(num_gals, dtype=bool)
+    is_central[tree_offsets[ngals_per_tree > 0]] = True
+
+    gals = np.zeros(num_gals, dtype=dtype)
+    for name in dtype.names:
+        if dtype[name].base.kind == "f":
+            gals[name] = rng.random(gals[name].shape, dtype=np.float32)
+
+    gals["SnapNum"] = snap_num
+    gals["Type"] = np.where(is_central, 0, rng.integers(1, 3, num_gals))
+    gals["GalaxyIndex"] = snap_num * 10 ** 12 + np.arange(num_gals)
+    gals["CentralGalaxyIndex"] = gals["GalaxyIndex"][tree_offsets[tree_nums]]
+    gals["SAGEHaloIndex"] = np.arange(num_gals) - tree_offsets[tree_nums]
+    gals["SAGETreeIndex"] = tree_nums
+    gals["SimulationHaloIndex"] = np.arange(num_gals)
+    gals["mergeIntoID"] = -1
+    gals["mergeIntoSnapNum"] = -1
+    gals["Len"] = rng.integers(20, 10000, num_gals)
+    gals["Pos"] *= synthetic_box_size
+    gals["Mvir"] *= 1.0e3
+    gals["StellarMass"] = 10.0 ** rng.uniform(-3.0, 1.0, num_gals)
+
+    return ngals_per_tree, gals
+
+
+def write_synthetic_binary_files(binary_prefix, redshift, ngals_per_tree, gals, num_files):
+    """
+    Splits the trees ``ngals_per_tree`` (and their galaxies ``gals``) over ``num_files`` binary
+    files.  Each file gets a contiguous range of trees, as when SAGE runs on ``num_files``
+    processors.
+    """
+
+    tree_offsets = np.concatenate([[0], np.cumsum(ngals_per_tree, dtype=np.int64)])
+
+    for file_idx, tree_nums in enumerate(np.array_split(np.arange(len(ngals_per_tree)),
+                                                        num_files)):
+
+        ngals_per_tree_this_file = ngals_per_tree[tree_nums]
+        start = tree_offsets[tree_nums[0]] if len(tree_nums) else 0
+        end = start + ngals_per_tree_this_file.sum()
+
+        fname = determine_synthetic_binary_fname(binary_prefix, redshift, file_idx)
+        with open(fname, "wb") as f:
+            header = [len(ngals_per_tree_this_file), end - start]
+            np.array(header, dtype=np.int32).tofile(f)
+            ngals_per_tree_this_file.astype(np.int32).tofile(f)
+            gals[start:end].tofile(f)
+
+
+def generate_synthetic_catalogs(work_dir, num_gals, num_trees, num_files, num_cores,
+                                num_snapshots, seed=0):
+    """
+    Writes a synthetic ``sage_binary`` catalog split over ``num_files`` files and the
+    equivalent ``sage_hdf5`` catalog written by ``num_cores`` cores into ``work_dir``.  Each of
+    the ``num_snapshots`` outputs holds ``num_gals`` galaxies in ``num_trees`` trees.
+
+    The HDF5 catalog uses the ``Core_N`` master file layout of SAGE (see
+    :py:func:`~sageconvert.convert_binary_to_hdf5`).  Both catalogs hold the same galaxies in
+    the same order, so they compare as equal.
+
+    Returns the binary model prefix and the HDF5 master file name.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    binary_prefix = os.path.join(work_dir, "model")
+    core_prefix = os.path.join(work_dir, "cores")
+    hdf5_fname = os.path.join(work_dir, "model.hdf5")
+
+    for snap_num, redshift in synthetic_snapshots[:num_snapshots]:
+        ngals_per_tree, gals = generate_synthetic_snapshot(snap_num, num_gals, num_trees, rng)
+        write_synthetic_binary_files(binary_prefix, redshift, ngals_per_tree, gals, num_files)
+        write_synthetic_binary_files(core_prefix, redshift, ngals_per_tree, gals, num_cores)
+
+    # Convert the per-core binary files, then remove them.
+    convert_binary_to_hdf5(core_prefix, num_cores, hdf5_fname, num_workers=1)
+    for _, redshift in synthetic_snapshots[:num_snapshots]:
+        for core_idx in range(num_cores):
+            os.remove(determine_synthetic_binary_fname(core_prefix, redshift, core_idx))
+
+    return binary_prefix, hdf5_fname
+
+
+def time_call(func, num_repeats, setup=None):
+    """
+    Calls ``func()`` ``num_repeats`` times and returns the wall time (in seconds) of each call.
+    ``setup()`` is called (untimed) before each call.  Anything printed by ``func`` is
+    discarded.
+    """
+    import contextlib
+    import io
+
+    seconds = []
+
+    for _ in range(num_repeats):
+        if setup is not None:
+            setup()
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.time()
+            func()
+            seconds.append(time.time() - start)
+
+    return seconds
+
+
+def determine_catalog_benchmarks(binary_prefix, hdf5_fname, num_files, num_tree_seeks, seed=0):
+    """
+    Returns the benchmarks run by :py:func:`~benchmark_catalogs` as a list of ``(name, func,
+    setup, num_gals)``.  ``num_gals`` is the number of galaxies processed by each call of
+    ``func``.
+    """
+
+    binary_fname = determine_synthetic_binary_fname(binary_prefix, synthetic_snapshots[0][1], 0)
+    snap_key = "Snap_{0}".format(synthetic_snapshots[0][0])
+    metadata_fname = determine_hdf5_metadata_fname(hdf5_fname)
+
+    def remove_metadata():
+        if os.path.exists(metadata_fname):
+            os.remove(metadata_fname)
+
+    g = BinarySage(binary_fname, num_files=num_files)
+    g.update_metadata()
+    num_gals = int(g.totngals_all_files)
+    num_trees = int(g.totntrees_all_files)
+
+    # Seek to the same random trees in both formats.
+    rng = np.random.default_rng(seed)
+    treenums = rng.integers(0, num_trees, num_tree_seeks)
+    num_seek_gals = int(g.tree_index["ngals"][treenums].sum())
+
+    def read_binary_trees():
+        g_seek = BinarySage(binary_fname, num_files=num_files)
+        for treenum in treenums:
+            g_seek.read_tree(treenum)
+
+    def read_hdf5_trees():
+        with Hdf5Sage(hdf5_fname) as g_seek:
+            for treenum in treenums:
+                g_seek.read_tree(treenum, snap_key)
+
+    def read_hdf5_gals(fields=None):
+        with Hdf5Sage(hdf5_fname, fields=fields) as g_read:
+            g_read.read_gals(snap_key)
+
+    def compare_binary(streaming=False):
+        g1 = BinarySage(binary_fname, num_files=num_files)
+        g2 = BinarySage(binary_fname, num_files=num_files)
+        if streaming:
+            compare_binary_catalogs_streaming(g1, g2)
+        else:
+            compare_binary_catalogs(g1, g2)
+
+    def compare_binary_hdf5():
+        with Hdf5Sage(hdf5_fname) as g2:
+            compare_binary_hdf5_catalogs(BinarySage(binary_fname, num_files=num_files), g2)
+
+    benchmarks = [
+        ("binary header", lambda: BinarySage(binary_fname, num_files=num_files).update_metadata(),
+         None, num_gals),
+        ("hdf5 header (uncached)", lambda: load_hdf5_metadata(hdf5_fname), remove_metadata,
+         num_gals),
+        ("hdf5 header (cached)", lambda: load_hdf5_metadata(hdf5_fname), None, num_gals),
+        ("binary full read", lambda: BinarySage(binary_fname, num_files=num_files).read_gals(),
+         None, num_gals),
+        ("binary full read (memmap)",
+         lambda: BinarySage(binary_fname, num_files=num_files, memmap=True).read_gals(),
+         None, num_gals),
+        ("hdf5 full read", read_hdf5_gals, None, num_gals),
+        ("binary projected read",
+         lambda: BinarySage(binary_fname, num_files=num_files,
+                            fields=projected_fields).read_gals(),
+         None, num_gals),
+        ("hdf5 projected read", lambda: read_hdf5_gals(projected_fields), None, num_gals),
+        ("binary tree seeks", read_binary_trees, None, num_seek_gals),
+        ("hdf5 tree seeks", read_hdf5_trees, None, num_seek_gals),
+        ("compare_binary_catalogs", compare_binary, None, num_gals),
+        ("compare_binary_catalogs_streaming", lambda: compare_binary(streaming=True), None,
+         num_gals),
+        ("compare_binary_hdf5_catalogs", compare_binary_hdf5, None, num_gals),
+        ("compare_binary_hdf5_all_snapshots",
+         lambda: compare_binary_hdf5_all_snapshots(binary_prefix, num_files, hdf5_fname, [],
+                                                   ["Pos", "Vel", "Spin"], num_workers=1),
+         None, None),
+    ]
+
+    return benchmarks
+
+
+def benchmark_catalogs(work_dir, num_gals=100000, num_trees=1000, num_files=4, num_cores=2,
+                       num_snapshots=2, num_tree_seeks=100, num_repeats=3, seed=0):
+    """
+    Generates synthetic catalogs in ``work_dir`` (see
+    :py:func:`~generate_synthetic_catalogs`) and times the readers and comparisons of
+    ``sagediff`` on them (see :py:func:`~determine_catalog_benchmarks`).
+
+    The files are read from the page cache, i.e., these are not cold-disk timings.
+
+    Returns a dictionary keyed by the benchmark name.  Each entry holds the minimum and median
+    wall time (in milliseconds) and, where meaningful, the galaxies processed per second.
+    """
+
+    binary_prefix, hdf5_fname = generate_synthetic_catalogs(work_dir, num_gals, num_trees,
+                                                            num_files, num_cores,
+                                                            num_snapshots, seed)
+
+    results = {}
+    for name, func, setup, num_bench_gals in determine_catalog_benchmarks(
+            binary_prefix, hdf5_fname, num_files, num_tree_seeks, seed):
+
+        seconds = sorted(time_call(func, num_repeats, setup))
+        results[name] = {"min_ms": seconds[0] * 1000.0,
+                         "median_ms": seconds[len(seconds) // 2] * 1000.0,
+                         "num_gals": num_bench_gals}
+
+        if num_bench_gals is not None and seconds[0] > 0.0:
+            results[name]["gals_per_s"] = num_bench_gals / seconds[0]
+
+    return results
+
+
+def report_catalogs(results):
+    """
+    Prints the catalog benchmark ``results`` (see :py:func:`~benchmark_catalogs`).
+    """
+
+    print("{0:<36} {1:>10} {2:>10} {3:>12}".format("benchmark", "min (ms)", "median",
+                                                   "gals/s"))
+    for name, result in results.items():
+        gals_per_s = result.get("gals_per_s")
+        gals_per_s = "-" if gals_per_s is None else "{0:.3e}".format(gals_per_s)
+        print("{0:<36} {1:>10.1f} {2:>10.1f} {3:>12}".format(name, result["min_ms"],
+                                                            result["median_ms"], gals_per_s))
+
+
+def determine_environment():
+    """
+    Returns the versions of Python and of the numerical libraries, and the git commit of this
+    checkout (``None`` if it cannot be determined), so that results can be tracked across
+    commits.
+    """
+    import platform
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=tests_dir,
+                                         stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    try:
+        import h5py
+        h5py_version = h5py.__version__
+    except ImportError:
+        h5py_version = None
+
+    return {"commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "h5py": h5py_version,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    description = "Benchmark the start-up time of the SAGE Python tools and the readers and "\
+                  "comparisons of sagediff on synthetic catalogs"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--suites", metavar="SUITE", nargs="+", default=["startup", "catalogs"],
+                        choices=["startup", "catalogs"],
+                        help="the benchmarks to run (default: startup catalogs).")
+    parser.add_argument("--hdf5_fname", metavar="FILE", default=None,
+                        help="also time a metadata-only call on this HDF5 master file.")
+    parser.add_argument("--num_repeats", metavar="NUM", type=int, default=None,
+                        help="number of times each command or benchmark is run (default: 10 "
+                             "for the start-up and 3 for the catalogs).")
+    parser.add_argument("--max_time", metavar="MS", type=float, default=None,
+                        help="exit with an error if the median start-up time of any command "
+                             "is above this many milliseconds.")
+    parser.add_argument("--num_gals", metavar="NUM", type=int, default=100000,
+                        help="number of galaxies at each synthetic snapshot.")
+    parser.add_argument("--num_trees", metavar="NUM", type=int, default=1000,
+                        help="number of trees at each synthetic snapshot.")
+    parser.add_argument("--num_files", metavar="NUM", type=int, default=4,
+                        help="number of files the synthetic binary catalog is split over.")
+    parser.add_argument("--num_cores", metavar="NUM", type=int, default=2,
+                        help="number of cores that 'wrote' the synthetic HDF5 catalog.")
+    parser.add_argument("--num_snapshots", metavar="NUM", type=int, default=2,
+                        choices=range(1, len(synthetic_snapshots) + 1),
+                        help="number of synthetic snapshots.")
+    parser.add_argument("--num_tree_seeks", metavar="NUM", type=int, default=100,
+                        help="number of random trees read by the tree seek benchmarks.")
+    parser.add_argument("--seed", metavar="SEED", type=int, default=0,
+                        help="seed of the synthetic catalogs.")
+    parser.add_argument("--work_dir", metavar="DIR", default=None,
+                        help="write the synthetic catalogs to this directory and keep them "
+                             "(default: a temporary directory that is removed afterwards).")
+    parser.add_argument("--output", metavar="FILE", default=None,
+                        help="also save the results as JSON to this file.")
+
+    args = parser.parse_args()
+
+    output = {"environment": determine_environment(),
+              "parameters": vars(args)}
+    slow = []
+
+    if "startup" in args.suites:
+        results = benchmark_startup(args.hdf5_fname, args.num_repeats or 10)
+        slow = report_startup(results, args.max_time)
+        output["startup"] = results
+
+    if "catalogs" in args.suites:
+        import shutil
+        import tempfile
+
+        work_dir = args.work_dir
+        if work_dir is None:
+            work_dir = tempfile.mkdtemp(prefix="sagebench")
+        elif not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+
+        try:
+            results = benchmark_catalogs(work_dir, args.num_gals, args.num_trees,
+                                         args.num_files, args.num_cores, args.num_snapshots,
+                                         args.num_tree_seeks, args.num_repeats or 3, args.seed)
+        finally:
+            if args.work_dir is None:
+                shutil.rmtree(work_dir)
+
+        print("")
+        report_catalogs(results)
+        output["catalogs"] = results
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+
+    if slow:
+        print("The start-up of {0} took longer than {1} ms.".format(", ".join(slow),
+                                                                    args.max_time))
+        sys.exit(1)
@@ -0,0 +1,1541 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+
+from sagediff import BinarySage, Hdf5Sage, compare_binary_catalogs, \
+    compare_binary_catalogs_streaming, determine_binary_redshift, determine_binary_snapshots, \
+    determine_hdf5_metadata_fname, determine_snap_from_metadata, find_binary_redshift_files, \
+    load_hdf5_metadata, snap_key_to_snap_num
+from sageutils import lazy_import, read_parameter_file
+
+np = lazy_import("numpy")
+
+# The directory holding this script (and the other tools).
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The number of files that catalogs are split into by :py:func:`~split_binary_catalog`.
+num_split_files = 3
+
+# The number of galaxies read at once by the chunked readers.  Small, so that the
+# Mini-Millennium catalogs are split over several chunks.
+check_chunk_size = 100
+
+
+def compare_galaxies(description, expected, actual, fields=None):
+    """
+    Returns whether the ``fields`` (defaults to every field of ``expected``) of the galaxies
+    ``actual`` are bitwise identical to those of ``expected``.  Both are indexable by the field
+    name.  The first field that differs is printed, prefixed by ``description``.
+    """
+
+    if fields is None:
+        fields = expected.dtype.names
+
+    if len(expected[fields[0]]) != len(actual[fields[0]]):
+        print("{0}: expected {1} galaxies but found {2}.".format(description,
+                                                                len(expected[fields[0]]),
+                                                                len(actual[fields[0]])))
+        return False
+
+    for field in fields:
+        expected_field = np.ascontiguousarray(expected[field])
+        actual_field = np.ascontiguousarray(actual[field], dtype=expected_field.dtype)
+
+        if expected_field.shape != actual_field.shape or \
+           expected_field.tobytes() != actual_field.tobytes():
+            print("{0}: field '{1}' differs.".format(description, field))
+            return False
+
+    return True
+
+
+def find_binary_catalogs(args):
+    """
+    Returns the name of the 0th file of every redshift output of the binary catalog
+    ``args.binary_prefix``.
+    """
+
+    fnames = find_binary_redshift_files(args.binary_prefix)
+    if not fnames:
+        msg = "Could not find any binary files named '{0}_z*'.".format(args.binary_prefix)
+        raise ValueError(msg)
+
+    return fnames
+
+
+def find_binary_snapshots(args):
+    """
+    Returns the snapshot key and the name of the 0th file of every redshift output (with
+    galaxies) of the binary catalog ``args.binary_prefix``.
+    """
+    return [(snap_key, binary_fnames[0][1]) for snap_key, _, binary_fnames
+            in determine_binary_snapshots(args.binary_prefix, args.num_files, skip_empty=True)]
+
+
+def split_binary_catalog(fname, args):
+    """
+    Splits the trees of the binary catalog ``fname`` over ``num_split_files`` files in
+    ``args.work_dir``, as if SAGE ran on ``num_split_files`` processors.
+
+    Returns the name of the 0th file, the galaxies and the number of galaxies in each tree.
+    """
+    from sagebench import write_synthetic_binary_files
+
+    g = BinarySage(fname, num_files=args.num_files)
+    gals = g.read_gals()
+    ngals_per_tree = g.tree_index["ngals"].astype(np.int32)
+
+    redshift = determine_binary_redshift(fname)
+    split_prefix = os.path.join(args.work_dir, "split")
+    write_synthetic_binary_files(split_prefix, redshift, ngals_per_tree, gals, num_split_files)
+
+    return "{0}_z{1:.3f}_0".format(split_prefix, redshift), gals, ngals_per_tree
+
+
+def perturb_binary_catalog(fname, num_files, field, indices):
+    """
+    Changes the value of ``field`` of the galaxies ``indices`` (across all ``num_files`` files)
+    of the binary catalog ``fname`` in place.
+    """
+
+    g = BinarySage(fname, num_files=num_files)
+    g.update_metadata()
+    file_offsets = np.concatenate([[0], np.cumsum(g.ngals_per_file)])
+
+    for idx in indices:
+        file_idx = np.searchsorted(file_offsets, idx, side="right") - 1
+        gals = np.memmap(g.determine_file_name(file_idx), dtype=g.dtype, mode="r+",
+                         offset=int(g.header_size_per_file[file_idx]),
+                         shape=(int(g.ngals_per_file[file_idx]), ))
+        gals[field][idx - file_offsets[file_idx]] = gals[field][idx - file_offsets[file_idx]] * \
+            2.0 + 1.0
+        gals.flush()
+        del gals
+
+
+def copy_binary_catalog(fname, args):
+    """
+    Copies the ``args.num_files`` files of the binary catalog ``fname`` (the 0th file) into
+    ``args.work_dir``.  Returns the name of the copied 0th file.
+    """
+
+    g = BinarySage(fname, num_files=args.num_files)
+    for file_idx in range(args.num_files):
+        shutil.copy(g.determine_file_name(file_idx), args.work_dir)
+
+    return os.path.join(args.work_dir, os.path.basename(fname))
+
+
+def copy_hdf5_catalog(args):
+    """
+    Copies the HDF5 master file ``args.hdf5_fname`` and its core files into ``args.work_dir``.
+    Returns the name of the copied master file.
+    """
+
+    hdf5_fname = os.path.join(args.work_dir, os.path.basename(args.hdf5_fname))
+    shutil.copy(args.hdf5_fname, hdf5_fname)
+
+    for core_fname in load_hdf5_metadata(args.hdf5_fname)["core_fnames"]:
+        shutil.copy(os.path.join(os.path.dirname(args.hdf5_fname), core_fname),
+                    os.path.join(args.work_dir, core_fname))
+
+    return hdf5_fname
+
+
+def scan_hdf5_snapshots(hdf5_fname):
+    """
+    Returns the redshift and the number of galaxies of each core at every snapshot of the HDF5
+    master file ``hdf5_fname``, read from the attributes of every core.
+    """
+    import h5py
+
+    snapshots = {}
+    with h5py.File(hdf5_fname, "r") as f:
+        ncores = int(f["Header"]["Misc"].attrs["num_cores"])
+        for core_idx in range(ncores):
+            core_group = f["Core_{0}".format(core_idx)]
+            for snap_key in core_group:
+                if not snap_key.startswith("Snap_"):
+                    continue
+                snapshot = snapshots.setdefault(snap_key, {"redshift": [],
+                                                           "num_gals_per_core": []})
+                snapshot["redshift"].append(float(core_group[snap_key].attrs["redshift"]))
+                snapshot["num_gals_per_core"].append(
+                    int(core_group[snap_key].attrs["num_gals"]))
+
+    return snapshots
+
+
+def check_memmap(args):
+    """
+    Memory-mapped reads of the binary catalog (whole catalogs, chunks and single files) equal
+    full reads.
+    """
+
+    passed = True
+
+    for fname in find_binary_catalogs(args):
+
+        gals = BinarySage(fname, num_files=args.num_files).read_gals()
+
+        g = BinarySage(fname, num_files=args.num_files, memmap=True)
+        passed &= compare_galaxies(fname, gals, g.read_gals())
+
+        chunks = np.concatenate([np.array(chunk) for chunk in g.iter_gals(check_chunk_size)])
+        passed &= compare_galaxies("{0} (chunks)".format(fname), gals, chunks)
+
+        offset = 0
+        for file_idx in range(args.num_files):
+            file_gals = g.memmap_file(file_idx)
+            passed &= compare_galaxies("{0} (file {1})".format(fname, file_idx),
+                                       gals[offset:offset + len(file_gals)], file_gals)
+            offset += len(file_gals)
+
+    return passed
+
+
+def check_projection(args):
+    """
+    Reads projected onto a few fields equal the same fields of full reads, for both the binary
+    (in RAM and memory-mapped) and the HDF5 catalogs.
+    """
+
+    fields = ["GalaxyIndex", "Type", "StellarMass", "Pos"]
+    passed = True
+
+    with Hdf5Sage(args.hdf5_fname, fields=fields) as hdf5_sage:
+        for snap_key, fname in find_binary_snapshots(args):
+
+            gals = BinarySage(fname, num_files=args.num_files).read_gals()
+
+            projected_gals = BinarySage(fname, num_files=args.num_files,
+                                        fields=fields).read_gals()
+            passed &= compare_galaxies(fname, gals, projected_gals, fields)
+            if projected_gals.dtype.names != tuple(fields):
+                print("{0}: the projected galaxies hold the fields {1}.".format(
+                    fname, projected_gals.dtype.names))
+                passed = False
+
+            passed &= compare_galaxies("{0} (memmap)".format(fname), gals,
+                                       BinarySage(fname, num_files=args.num_files,
+                                                  memmap=True, fields=fields).read_gals(),
+                                       fields)
+
+            hdf5_gals = hdf5_sage.read_gals(snap_key)
+            passed &= compare_galaxies("{0} {1}".format(args.hdf5_fname, snap_key), gals,
+                                       hdf5_gals, fields)
+            if sorted(hdf5_gals) != sorted(fields):
+                print("{0} {1}: read the fields {2}.".format(args.hdf5_fname, snap_key,
+                                                             sorted(hdf5_gals)))
+                passed = False
+
+    return passed
+
+
+def check_tree_index(args):
+    """
+    Seeking to every tree through the tree index gives the same galaxies as slicing a full
+    read, also for catalogs split over several files and for batches of trees.  Reading all
+    the galaxies of the 0th file (``read_tree(None)``) after the tree index has been built
+    (which reads the header of every file) still reads the 0th file.
+    """
+
+    rng = np.random.default_rng(0)
+    passed = True
+
+    for fname in find_binary_catalogs(args):
+
+        split_fname, gals, ngals_per_tree = split_binary_catalog(fname, args)
+        tree_offsets = np.cumsum(ngals_per_tree, dtype=np.int64) - ngals_per_tree
+
+        for tree_fname, num_files in [(fname, args.num_files), (split_fname, num_split_files)]:
+
+            g = BinarySage(tree_fname, num_files=num_files)
+            for treenum, (offset, ngals) in enumerate(zip(tree_offsets, ngals_per_tree)):
+                tree = g.read_tree(treenum)
+                if ngals == 0:
+                    if tree is not None:
+                        print("{0}: tree {1} should be empty.".format(tree_fname, treenum))
+                        passed = False
+                    continue
+                passed &= compare_galaxies("{0} (tree {1})".format(tree_fname, treenum),
+                                           gals[offset:offset + ngals], tree)
+
+            treenums = rng.permutation(len(ngals_per_tree))[:len(ngals_per_tree) // 2]
+            expected = np.concatenate([gals[tree_offsets[treenum]:
+                                            tree_offsets[treenum] + ngals_per_tree[treenum]]
+                                       for treenum in treenums])
+            passed &= compare_galaxies("{0} (trees {1})".format(tree_fname, treenums.tolist()),
+                                       expected, g.read_trees(treenums))
+
+        # ``update_metadata`` leaves the header of the last file behind.
+        g = BinarySage(split_fname, num_files=num_split_files)
+        g.update_metadata()
+        passed &= compare_galaxies("{0} (after update_metadata)".format(split_fname),
+                                   gals[:g.ngals_per_file[0]], g.read_tree(None))
+
+    return passed
+
+
+def check_parallel_read(args):
+    """
+    Reading a catalog split over several files with a pool of threads or processes gives the
+    same galaxies as reading the files one after another.  Also compares the split catalog
+    with the SAGE output through ``sagediff.py --use_processes`` (only its mismatches are
+    shown).
+    """
+    import subprocess
+
+    passed = True
+
+    for fname in find_binary_catalogs(args):
+
+        split_fname, gals, _ = split_binary_catalog(fname, args)
+
+        passed &= compare_galaxies("{0} (serial)".format(split_fname), gals,
+                                   BinarySage(split_fname, num_files=num_split_files).read_gals())
+        passed &= compare_galaxies("{0} (threads)".format(split_fname), gals,
+                                   BinarySage(split_fname, num_files=num_split_files,
+                                              num_workers=num_split_files).read_gals())
+        passed &= compare_galaxies("{0} (processes)".format(split_fname), gals,
+                                   BinarySage(split_fname, num_files=num_split_files,
+                                              num_workers=num_split_files,
+                                              use_processes=True).read_gals())
+
+        command = [sys.executable, os.path.join(tests_dir, "sagediff.py"), fname, split_fname,
+                   "binary-binary", str(args.num_files), str(num_split_files),
+                   "--num_workers", str(num_split_files), "--use_processes"]
+        if subprocess.call(command, stdout=subprocess.DEVNULL) != 0:
+            print("'{0}' failed.".format(" ".join(command)))
+            passed = False
+
+    return passed
+
+
+def check_streaming(args):
+    """
+    The streaming comparison (in chunks smaller than the files) passes for a copy of the
+    catalog split over several files and, like the in-memory comparison, fails for a
+    perturbed copy.  The mismatches saved by both comparisons are the perturbed galaxies.
+    """
+    import contextlib
+    import glob
+    import io
+
+    field = "StellarMass"
+    passed = True
+
+    for fname in find_binary_catalogs(args):
+
+        split_fname, gals, _ = split_binary_catalog(fname, args)
+
+        failed = compare_binary_catalogs_streaming(
+            BinarySage(fname, num_files=args.num_files),
+            BinarySage(split_fname, num_files=num_split_files), chunk_size=check_chunk_size)
+        if failed:
+            print("{0}: the streaming comparison failed for the fields {1}.".format(
+                split_fname, sorted(failed)))
+            passed = False
+
+        indices = np.unique([0, len(gals) // 2, len(gals) - 1])
+        perturb_binary_catalog(split_fname, num_split_files, field, indices)
+
+        for streaming in [False, True]:
+
+            mismatch_dir = os.path.join(args.work_dir, "{0}_{1}_mismatches".format(
+                os.path.basename(fname), "streaming" if streaming else "in_memory"))
+            os.makedirs(mismatch_dir)
+
+            g1 = BinarySage(fname, num_files=args.num_files)
+            g2 = BinarySage(split_fname, num_files=num_split_files)
+
+            description = "{0} ({1} comparison)".format(
+                split_fname, "streaming" if streaming else "in-memory")
+            try:
+                with contextlib.redirect_stdout(io.StringIO()), \
+                     contextlib.redirect_stderr(io.StringIO()):
+                    if streaming:
+                        compare_binary_catalogs_streaming(g1, g2, chunk_size=check_chunk_size,
+                                                          mismatch_dir=mismatch_dir)
+                    else:
+                        compare_binary_catalogs(g1, g2, mismatch_dir=mismatch_dir)
+                print("{0}: the perturbed catalog passed.".format(description))
+                passed = False
+            except ValueError:
+                pass
+
+            mismatch_fnames = glob.glob(os.path.join(mismatch_dir, "*"))
+            bad_idx = np.concatenate([np.load(mismatch_fname)["index"]
+                                      for mismatch_fname in mismatch_fnames]
+                                     or [np.empty(0, dtype=np.int64)])
+            if not all("_{0}_".format(field) in mismatch_fname
+                       for mismatch_fname in mismatch_fnames) or \
+               not np.array_equal(np.sort(bad_idx), indices):
+                print("{0}: saved the mismatches of galaxies {1} to {2}, but galaxies {3} of "
+                      "'{4}' were perturbed.".format(description, np.sort(bad_idx).tolist(),
+                                                     mismatch_fnames, indices.tolist(), field))
+                passed = False
+
+    return passed
+
+
+def check_hdf5_metadata(args):
+    """
+    The metadata index of the HDF5 catalog matches the attributes of every core, both when it
+    is built and when it is read back from the sidecar file.  The index is rebuilt once a core
+    file changes, and the snapshot of each binary redshift output is found from it.
+    """
+    import h5py
+
+    hdf5_fname = copy_hdf5_catalog(args)
+    metadata_fname = determine_hdf5_metadata_fname(hdf5_fname)
+    passed = True
+
+    def compare_metadata(description, metadata, snapshots):
+        if sorted(metadata["snap_keys"]) != sorted(snapshots):
+            print("{0}: the snapshots are {1} rather than {2}.".format(
+                description, metadata["snap_keys"], sorted(snapshots)))
+            return False
+
+        for snap_key, snapshot in snapshots.items():
+            if metadata["snapshots"][snap_key]["num_gals_per_core"] != \
+               snapshot["num_gals_per_core"] or \
+               metadata["snapshots"][snap_key]["redshift"] != snapshot["redshift"][0]:
+                print("{0}: the metadata of {1} is {2} rather than {3}.".format(
+                    description, snap_key, metadata["snapshots"][snap_key], snapshot))
+                return False
+
+        return True
+
+    if os.path.exists(metadata_fname):
+        os.remove(metadata_fname)
+
+    snapshots = scan_hdf5_snapshots(hdf5_fname)
+    passed &= compare_metadata("{0} (built)".format(hdf5_fname),
+                               load_hdf5_metadata(hdf5_fname), snapshots)
+    if not os.path.exists(metadata_fname):
+        print("{0}: the metadata index was not saved.".format(hdf5_fname))
+        passed = False
+    passed &= compare_metadata("{0} (cached)".format(hdf5_fname),
+                               load_hdf5_metadata(hdf5_fname), snapshots)
+
+    metadata = load_hdf5_metadata(hdf5_fname)
+    for snap_key, fname in find_binary_snapshots(args):
+        _, hdf5_snap_key = determine_snap_from_metadata(metadata,
+                                                        determine_binary_redshift(fname))
+        if hdf5_snap_key != snap_key:
+            print("{0}: found {1} for the binary file {2} at {3}.".format(
+                hdf5_fname, hdf5_snap_key, fname, snap_key))
+            passed = False
+
+    # Change the redshift of a snapshot in the 0th core file (which the redshifts are taken
+    # from), and make sure the modification time changes even on file systems with a coarse
+    # resolution.
+    core_fname = os.path.join(args.work_dir, metadata["core_fnames"][0])
+    snap_key = metadata["snap_keys"][0]
+    with h5py.File(core_fname, "r+") as f:
+        snap_group = f[snap_key]
+        snap_group.attrs["redshift"] = snap_group.attrs["redshift"] + 1.0
+    stat = os.stat(core_fname)
+    os.utime(core_fname, (stat.st_atime, stat.st_mtime + 10.0))
+
+    passed &= compare_metadata("{0} (changed)".format(hdf5_fname),
+                               load_hdf5_metadata(hdf5_fname), scan_hdf5_snapshots(hdf5_fname))
+
+    return passed
+
+
+def check_hdf5_trees(args):
+    """
+    Seeking to every tree of the HDF5 catalog (one at a time and by iterating over the trees)
+    gives the same galaxies as slicing a full read of the snapshot, and the same galaxies as
+    seeking to the tree in the binary catalog.
+    """
+
+    binary_fnames = dict(find_binary_snapshots(args))
+    passed = True
+
+    with Hdf5Sage(args.hdf5_fname) as hdf5_sage:
+        for snap_key in hdf5_sage.metadata["snap_keys"]:
+
+            gals = hdf5_sage.read_gals(snap_key)
+            fields = sorted(gals)
+            description = "{0} {1}".format(args.hdf5_fname, snap_key)
+
+            tree_index = hdf5_sage.get_tree_index(snap_key)
+            core_offsets = np.array(hdf5_sage.metadata["snapshots"][snap_key]["core_offsets"])
+            tree_offsets = core_offsets[tree_index["core_idx"]] + tree_index["gal_offset"]
+
+            binary_sage = None
+            if snap_key in binary_fnames:
+                binary_sage = BinarySage(binary_fnames[snap_key], num_files=args.num_files)
+                binary_sage.update_metadata()
+                if len(binary_sage.tree_index) != len(tree_index):
+                    print("{0}: has {1} trees but the binary catalog has {2}.".format(
+                        description, len(tree_index), len(binary_sage.tree_index)))
+                    passed = False
+                    binary_sage = None
+
+            for treenum, (offset, ngals) in enumerate(zip(tree_offsets, tree_index["ngals"])):
+
+                tree = hdf5_sage.read_tree(treenum, snap_key)
+                if ngals == 0:
+                    if tree is not None:
+                        print("{0}: tree {1} should be empty.".format(description, treenum))
+                        passed = False
+                    continue
+
+                tree_description = "{0} (tree {1})".format(description, treenum)
+                expected = dict((field, gals[field][offset:offset + ngals]) for field in fields)
+                passed &= compare_galaxies(tree_description, expected, tree, fields)
+
+                if binary_sage is not None:
+                    binary_tree = binary_sage.read_tree(treenum)
+                    passed &= compare_galaxies("{0} (binary)".format(tree_description),
+                                               binary_tree, tree,
+                                               [field for field in fields
+                                                if field in binary_tree.dtype.names])
+
+            num_trees = 0
+            for _, treenum, tree in hdf5_sage.iter_trees(snap_key, check_chunk_size):
+                offset, ngals = tree_offsets[treenum], tree_index["ngals"][treenum]
+                expected = dict((field, gals[field][offset:offset + ngals]) for field in fields)
+                passed &= compare_galaxies("{0} (iterated tree {1})".format(description,
+                                                                           treenum),
+                                           expected, tree, fields)
+                num_trees += 1
+
+            if num_trees != np.count_nonzero(tree_index["ngals"]):
+                print("{0}: iterated over {1} trees but {2} trees have galaxies.".format(
+                    description, num_trees, np.count_nonzero(tree_index["ngals"])))
+                passed = False
+
+    return passed
+
+
+def check_round_trip(args):
+    """
+    Converting the binary catalog to HDF5 gives the same galaxies and trees as the HDF5 catalog
+    written by SAGE, and converting that back to binary gives files that are bitwise identical
+    to the original binary files.
+    """
+    from sageconvert import convert_binary_to_hdf5, convert_hdf5_to_binary
+
+    hdf5_fname = os.path.join(args.work_dir, "round_trip.hdf5")
+    convert_binary_to_hdf5(args.binary_prefix, args.num_files, hdf5_fname,
+                           chunk_size=check_chunk_size)
+
+    passed = True
+
+    with Hdf5Sage(hdf5_fname) as hdf5_sage, Hdf5Sage(args.hdf5_fname) as sage_hdf5_sage:
+        for snap_key, fname in find_binary_snapshots(args):
+
+            gals = BinarySage(fname, num_files=args.num_files).read_gals()
+            converted_gals = hdf5_sage.read_gals(snap_key)
+            passed &= compare_galaxies("{0} {1}".format(hdf5_fname, snap_key), gals,
+                                       converted_gals)
+
+            sage_gals = sage_hdf5_sage.read_gals(snap_key)
+            passed &= compare_galaxies("{0} {1} (SAGE)".format(hdf5_fname, snap_key),
+                                       sage_gals, converted_gals, sorted(sage_gals))
+
+            if not np.array_equal(hdf5_sage.get_tree_index(snap_key),
+                                  sage_hdf5_sage.get_tree_index(snap_key)):
+                print("{0} {1}: the tree index differs from that of {2}.".format(
+                    hdf5_fname, snap_key, args.hdf5_fname))
+                passed = False
+
+    binary_prefix = os.path.join(args.work_dir, "round_trip")
+    binary_fnames = convert_hdf5_to_binary(hdf5_fname, binary_prefix,
+                                           chunk_size=check_chunk_size)
+
+    expected_fnames = ["{0}_{1}".format(fname[:-2], file_idx)
+                       for fname in find_binary_catalogs(args)
+                       for file_idx in range(args.num_files)]
+    if len(binary_fnames) != len(expected_fnames):
+        print("{0}: wrote {1} binary files but expected {2}.".format(
+            hdf5_fname, len(binary_fnames), len(expected_fnames)))
+        return False
+
+    for expected_fname in expected_fnames:
+        binary_fname = os.path.join(args.work_dir, "round_trip{0}".format(
+            os.path.basename(expected_fname)[len(os.path.basename(args.binary_prefix)):]))
+
+        with open(expected_fname, "rb") as fp:
+            expected = fp.read()
+        with open(binary_fname, "rb") as fp:
+            actual = fp.read()
+
+        if expected != actual:
+            print("{0}: differs from {1}.".format(binary_fname, expected_fname))
+            passed = False
+
+    return passed
+
+
+def check_parquet(args):
+    """
+    The Parquet export holds the same galaxies as the binary catalog, with row groups that end
+    on tree boundaries.  Skipped (and passes) if ``pyarrow`` is not installed.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("The parquet check is skipped as pyarrow is not installed.")
+        return True
+
+    from sageconvert import convert_binary_to_parquet, determine_parquet_fname
+
+    parquet_dir = os.path.join(args.work_dir, "parquet")
+    convert_binary_to_parquet(args.binary_prefix, args.num_files, parquet_dir,
+                              row_group_size=check_chunk_size)
+
+    passed = True
+
+    for snap_key, fname in find_binary_snapshots(args):
+
+        g = BinarySage(fname, num_files=args.num_files)
+        g.update_metadata()
+
+        for file_idx in range(args.num_files):
+
+            gals = g.memmap_file(file_idx)
+            with open(g.determine_file_name(file_idx), "rb") as fp:
+                g.read_header(fp)
+            tree_ends = np.cumsum(g.ngal_per_tree, dtype=np.int64)
+
+            parquet_fname = determine_parquet_fname(parquet_dir, snap_key, file_idx)
+            parquet_file = pq.ParquetFile(parquet_fname)
+            table = parquet_file.read()
+
+            if table.column_names != list(gals.dtype.names):
+                print("{0}: holds the columns {1}.".format(parquet_fname, table.column_names))
+                passed = False
+                continue
+
+            parquet_gals = {}
+            for name in gals.dtype.names:
+                column = table.column(name).combine_chunks()
+                if gals.dtype[name].shape:
+                    parquet_gals[name] = column.flatten().to_numpy().reshape(
+                        (-1, ) + gals.dtype[name].shape)
+                else:
+                    parquet_gals[name] = column.to_numpy()
+            passed &= compare_galaxies(parquet_fname, gals, parquet_gals)
+
+            row_group_ends = np.cumsum([parquet_file.metadata.row_group(idx).num_rows
+                                        for idx in range(parquet_file.num_row_groups)])
+            if not np.all(np.isin(row_group_ends, tree_ends)):
+                print("{0}: a row group does not end on a tree boundary.".format(parquet_fname))
+                passed = False
+
+    return passed
+
+
+def check_select(args):
+    """
+    Selections on the binary and HDF5 catalogs (predicates and a box that wraps around the
+    periodic boundary) equal a brute-force selection on a full read.
+    """
+
+    passed = True
+
+    with Hdf5Sage(args.hdf5_fname) as hdf5_sage:
+        for snap_key, fname in find_binary_snapshots(args):
+
+            gals = BinarySage(fname, num_files=args.num_files).read_gals()
+            if len(gals) == 0:
+                continue
+
+            # A box that wraps around along x and holds roughly half of the galaxies along y and
+            # z.
+            pos = gals["Pos"]
+            lower = [np.percentile(pos[:, 0], 70.0), np.percentile(pos[:, 1], 25.0),
+                     np.percentile(pos[:, 2], 25.0)]
+            upper = [np.percentile(pos[:, 0], 30.0), np.percentile(pos[:, 1], 75.0),
+                     np.percentile(pos[:, 2], 75.0)]
+            min_stellar_mass = np.median(gals["StellarMass"])
+            predicates = [("StellarMass", ">", min_stellar_mass), ("Type", "==", 0)]
+
+            in_box = ((pos[:, 0] >= lower[0]) | (pos[:, 0] < upper[0])) & \
+                     (pos[:, 1] >= lower[1]) & (pos[:, 1] < upper[1]) & \
+                     (pos[:, 2] >= lower[2]) & (pos[:, 2] < upper[2])
+            expected_indices = np.flatnonzero((gals["StellarMass"] > min_stellar_mass) &
+                                              (gals["Type"] == 0) & in_box)
+
+            g = BinarySage(fname, num_files=args.num_files, memmap=True)
+            indices = g.select(predicates, (lower, upper), check_chunk_size,
+                               return_indices=True)
+            if not np.array_equal(indices, expected_indices):
+                print("{0}: selected the wrong galaxies.".format(fname))
+                passed = False
+            passed &= compare_galaxies("{0} (select)".format(fname), gals[expected_indices],
+                                       g.select(predicates, (lower, upper), check_chunk_size))
+
+            description = "{0} {1}".format(args.hdf5_fname, snap_key)
+            indices = hdf5_sage.select(snap_key, predicates, (lower, upper), check_chunk_size,
+                                       return_indices=True)
+            if not np.array_equal(indices, expected_indices):
+                print("{0}: selected the wrong galaxies.".format(description))
+                passed = False
+            selected_gals = hdf5_sage.select(snap_key, predicates, (lower, upper),
+                                             check_chunk_size)
+            passed &= compare_galaxies("{0} (select)".format(description),
+                                       gals[expected_indices], selected_gals,
+                                       sorted(selected_gals))
+
+    return passed
+
+
+def brute_force_separations(points, pos, box_size):
+    """
+    Returns the periodic separations between each of the Nx3 ``points`` and each of the Mx3
+    ``pos`` as an NxM array, by comparing every pair.
+    """
+
+    pos = np.mod(np.asarray(pos, dtype=np.float64), box_size)
+
+    delta = points[:, np.newaxis, :] - pos[np.newaxis, :, :]
+    delta -= box_size * np.round(delta / box_size)
+
+    return np.sqrt(np.sum(delta * delta, axis=-1))
+
+
+def check_spatial(args):
+    """
+    Radius and nearest neighbour queries and pair counts (auto and cross) of the spatial index
+    of the binary and HDF5 catalogs equal brute-force searches over every pair.  The catalogs
+    are copied, as the index is cached next to them.
+    """
+    from sagespatial import load_spatial_index
+
+    radius = 5.0
+    k = 5
+    bins = np.logspace(-1.0, 1.0, 9)
+    cells_per_dim = 6
+
+    hdf5_fname = copy_hdf5_catalog(args)
+    passed = True
+
+    with Hdf5Sage(hdf5_fname) as hdf5_sage:
+        for snap_key, fname in find_binary_snapshots(args):
+
+            g = BinarySage(copy_binary_catalog(fname, args), num_files=args.num_files,
+                           memmap=True)
+            pos = g.read_gals()["Pos"]
+            if len(pos) < k:
+                continue
+
+            binary_grid = load_spatial_index(g, param_fname=args.param_fname,
+                                             cells_per_dim=cells_per_dim)
+            box_size = binary_grid.box_size
+
+            # Query around some of the galaxies and around points straddling the corners of the
+            # box, where the searches wrap around the periodic boundaries.
+            rng = np.random.RandomState(len(pos))
+            points = np.concatenate([np.asarray(pos[::max(1, len(pos) // 20)], dtype=np.float64),
+                                     rng.uniform(-1.0, 1.0, size=(10, 3)) % box_size])
+            separations = brute_force_separations(points, pos, box_size)
+
+            auto_separations = brute_force_separations(np.mod(np.asarray(pos, np.float64),
+                                                              box_size), pos, box_size)
+            expected_auto_counts, _ = np.histogram(
+                auto_separations[np.triu_indices(len(pos), 1)], bins=bins)
+            expected_cross_counts, _ = np.histogram(separations, bins=bins)
+
+            grids = [("binary", binary_grid),
+                     ("binary (cached)", load_spatial_index(g, param_fname=args.param_fname,
+                                                            cells_per_dim=cells_per_dim)),
+                     ("HDF5", load_spatial_index(hdf5_sage, snap_key,
+                                                 cells_per_dim=cells_per_dim)),
+                     ("binary (default cells)", load_spatial_index(g, box_size=box_size))]
+
+            for name, grid in grids:
+                description = "{0} {1} ({2})".format(os.path.basename(args.binary_prefix),
+                                                     snap_key, name)
+
+                if grid.box_size != box_size:
+                    print("{0}: the box size is {1} rather than {2}.".format(
+                        description, grid.box_size, box_size))
+                    passed = False
+                    continue
+
+                indices, distances = grid.query_radius(points, radius, return_distances=True)
+                for point_idx, point_separations in enumerate(separations):
+                    expected_indices = np.flatnonzero(point_separations <= radius)
+                    if not np.array_equal(np.sort(indices[point_idx]), expected_indices) or \
+                       not np.allclose(distances[point_idx],
+                                       np.sort(point_separations[expected_indices])):
+                        print("{0}: the galaxies within {1} of point {2} differ.".format(
+                            description, radius, point_idx))
+                        passed = False
+                        break
+
+                knn_distances, knn_indices = grid.query_knn(points, k)
+                if not np.allclose(knn_distances, np.sort(separations, axis=1)[:, :k]) or \
+                   not np.allclose(np.take_along_axis(separations, knn_indices, axis=1),
+                                   knn_distances):
+                    print("{0}: the {1} nearest neighbours differ.".format(description, k))
+                    passed = False
+
+                if not np.array_equal(grid.pair_counts(bins), expected_auto_counts):
+                    print("{0}: the pair counts differ.".format(description))
+                    passed = False
+
+                if not np.array_equal(grid.pair_counts(bins, points), expected_cross_counts):
+                    print("{0}: the cross pair counts differ.".format(description))
+                    passed = False
+
+    return passed
+
+
+def brute_force_history(gals, hubble_h, bins):
+    """
+    Returns the SMF counts, the sum of the stellar masses and of the star formation rates and
+    the number of the galaxies ``gals``, computed directly from all the galaxies at once.
+    """
+
+    stellar_mass = np.asarray(gals["StellarMass"], dtype=np.float64) * 1.0e10 / hubble_h
+    stellar_mass = stellar_mass[stellar_mass > 0.0]
+
+    return {"smf": np.histogram(np.log10(stellar_mass), bins=bins)[0],
+            "stellar_mass_sum": np.sum(stellar_mass),
+            "sfr_sum": np.sum(np.asarray(gals["SfrDisk"], dtype=np.float64) +
+                              np.asarray(gals["SfrBulge"], dtype=np.float64)),
+            "num_gals": len(gals["StellarMass"])}
+
+
+def compare_history(description, expected, accumulator):
+    """
+    Returns whether the sums of the :py:class:`sagestats.HistoryAccumulator` ``accumulator``
+    equal the brute-force sums ``expected`` (see :py:func:`~brute_force_history`).  The sums
+    are accumulated in a different order, so they only need to agree to rounding.
+    """
+
+    if not np.array_equal(accumulator.smf, expected["smf"]) or \
+       accumulator.num_gals != expected["num_gals"] or \
+       not np.isclose(accumulator.stellar_mass_sum, expected["stellar_mass_sum"],
+                      rtol=1e-10, atol=0.0) or \
+       not np.isclose(accumulator.sfr_sum, expected["sfr_sum"], rtol=1e-10, atol=1e-10):
+        print("{0}: the history differs from the brute-force history.".format(description))
+        return False
+
+    return True
+
+
+def check_stats(args):
+    """
+    The SMF, SMD and SFRD histories of the binary and HDF5 catalogs (computed by files and
+    chunks in parallel) equal the histories computed from full reads.  Both catalogs give the
+    snapshots in the same order, and selecting redshifts picks the closest snapshots.
+    """
+    from sagestats import compute_history, stellar_mass_bin_range
+
+    hubble_h = float(read_parameter_file(args.param_fname)["Hubble_h"])
+    bins = np.arange(*stellar_mass_bin_range)
+
+    binary_snapshots = find_binary_snapshots(args)
+    expected = {}
+    for snap_key, fname in binary_snapshots:
+        gals = BinarySage(fname, num_files=args.num_files).read_gals()
+        expected[snap_key] = (determine_binary_redshift(fname),
+                              brute_force_history(gals, hubble_h, bins))
+
+    passed = True
+
+    histories = [(args.binary_prefix, compute_history(args.binary_prefix, "sage_binary",
+                                                      hubble_h, num_files=args.num_files,
+                                                      chunk_size=check_chunk_size,
+                                                      num_workers=2)),
+                 (args.hdf5_fname, compute_history(args.hdf5_fname, "sage_hdf5", hubble_h,
+                                                   chunk_size=check_chunk_size,
+                                                   num_workers=2))]
+
+    for fname, history in histories:
+
+        snap_keys = [snap_key for snap_key, _, _ in history]
+        if snap_keys != [snap_key for snap_key, _ in binary_snapshots]:
+            print("{0}: the history holds the snapshots {1}.".format(fname, snap_keys))
+            passed = False
+            continue
+
+        for snap_key, redshift, accumulator in history:
+            expected_redshift, expected_sums = expected[snap_key]
+            if abs(redshift - expected_redshift) > 1e-3:
+                print("{0} {1}: the redshift is {2} rather than {3}.".format(
+                    fname, snap_key, redshift, expected_redshift))
+                passed = False
+            passed &= compare_history("{0} {1}".format(fname, snap_key), expected_sums,
+                                      accumulator)
+
+    # Ask for the redshifts of the first and last snapshots, slightly off.
+    redshifts = [expected[snap_key][0] for snap_key, _ in binary_snapshots]
+    history_redshifts = [redshifts[0] + 0.01, redshifts[-1] - 0.01]
+    history = compute_history(args.binary_prefix, "sage_binary", hubble_h, history_redshifts,
+                              num_files=args.num_files, num_workers=1)
+    snap_keys = [snap_key for snap_key, _, _ in history]
+    if snap_keys != [binary_snapshots[0][0], binary_snapshots[-1][0]]:
+        print("{0}: selected the snapshots {1} for the redshifts {2}.".format(
+            args.binary_prefix, snap_keys, history_redshifts))
+        passed = False
+
+    return passed
+
+
+def write_model_parameter_file(args, output_format, output_dir=None):
+    """
+    Writes a copy of the parameter file ``args.param_fname`` into ``args.work_dir`` that
+    describes the binary (``output_format="sage_binary"``) or HDF5 output of the runs, as found
+    in ``output_dir`` (defaults to where the outputs are).  Returns the name of the copy.
+    """
+    from sagegrid import write_parameter_file
+
+    if output_format == "sage_binary":
+        output_fname = args.binary_prefix
+        model = os.path.basename(args.binary_prefix)
+    else:
+        output_fname = args.hdf5_fname
+        model = os.path.splitext(os.path.basename(args.hdf5_fname))[0]
+
+    if output_dir is None:
+        output_dir = os.path.dirname(os.path.abspath(output_fname))
+
+    param_fname = os.path.join(args.work_dir, "{0}.par".format(output_format))
+    write_parameter_file(args.param_fname, {"OutputDir": output_dir + os.sep,
+                                            "FileNameGalaxies": model,
+                                            "OutputFormat": output_format}, param_fname)
+
+    return param_fname
+
+
+def compare_model_results(description, expected, results):
+    """
+    Returns whether the normalized histories ``results`` (see
+    :py:func:`sagestats.analyze_models`) equal ``expected``.  The SMD and SFRD only need to
+    agree to rounding, as they may have been summed in a different order.
+    """
+
+    if [result["snap_key"] for result in results] != \
+       [result["snap_key"] for result in expected]:
+        print("{0}: holds the snapshots {1}.".format(description,
+                                                     [result["snap_key"] for result in results]))
+        return False
+
+    for expected_result, result in zip(expected, results):
+        if not np.array_equal(result["SMF"], expected_result["SMF"]) or \
+           result["num_gals"] != expected_result["num_gals"] or \
+           not np.isclose(result["redshift"], expected_result["redshift"]) or \
+           not np.isclose(result["SMD"], expected_result["SMD"], rtol=1e-10, atol=0.0) or \
+           not np.isclose(result["SFRD"], expected_result["SFRD"], rtol=1e-10, atol=1e-20):
+            print("{0} {1}: the history differs.".format(description, result["snap_key"]))
+            return False
+
+    return True
+
+
+def check_analyze_models(args):
+    """
+    Analyzing the binary and HDF5 models together (serially, and in parallel with chunked
+    reads) gives the normalized histories of :py:func:`sagestats.compute_history` for each
+    model, and times every (model, snapshot, file) unit.
+    """
+    from sagestats import analyze_models, compute_history, read_model_parameters
+
+    param_fnames = [write_model_parameter_file(args, output_format)
+                    for output_format in ["sage_binary", "sage_hdf5"]]
+
+    expected = []
+    num_units = 0
+    for param_fname in param_fnames:
+        model = read_model_parameters(param_fname)
+        history = compute_history(model["output_fname"], model["output_format"],
+                                  model["hubble_h"], num_files=args.num_files, num_workers=1)
+
+        results = []
+        for snap_key, redshift, accumulator in history:
+            result = accumulator.normalize(model["volume"])
+            result["snap_key"] = snap_key
+            result["redshift"] = redshift
+            results.append(result)
+        expected.append(results)
+
+        num_files = args.num_files if model["output_format"] == "sage_binary" else \
+            len(load_hdf5_metadata(model["output_fname"])["core_fnames"])
+        num_units += len(history) * num_files
+
+    passed = True
+
+    for num_workers, chunk_size in [(1, 1000000), (2, check_chunk_size)]:
+        results_per_model, timings = analyze_models(param_fnames, num_files=args.num_files,
+                                                    chunk_size=chunk_size,
+                                                    num_workers=num_workers)
+
+        for param_fname, expected_results, results in zip(param_fnames, expected,
+                                                          results_per_model):
+            passed &= compare_model_results("{0} ({1} workers)".format(param_fname,
+                                                                       num_workers),
+                                            expected_results, results)
+
+        if len(timings) != num_units or any(seconds < 0.0 for _, _, _, seconds in timings):
+            print("Analyzing the models with {0} workers timed {1} units rather than "
+                  "{2}.".format(num_workers, len(timings), num_units))
+            passed = False
+
+    # Both formats hold the same galaxies, hence the same histories.
+    passed &= compare_model_results("{0} (against {1})".format(param_fnames[1],
+                                                               param_fnames[0]),
+                                    expected[0], expected[1])
+
+    return passed
+
+
+def copy_catalogs(args):
+    """
+    Copies every redshift output of the binary catalog and the HDF5 catalog into
+    ``args.work_dir`` and writes the parameter files describing the copies (see
+    :py:func:`~write_model_parameter_file`).  Returns the names of the parameter files.
+    """
+
+    for fname in find_binary_catalogs(args):
+        copy_binary_catalog(fname, args)
+    copy_hdf5_catalog(args)
+
+    return [write_model_parameter_file(args, output_format, args.work_dir)
+            for output_format in ["sage_binary", "sage_hdf5"]]
+
+
+def touch_file(fname, seconds=10.0):
+    """
+    Moves the modification time of ``fname`` ``seconds`` into the future, as if the file had
+    been rewritten (without relying on the resolution of the file system clock).
+    """
+
+    stat = os.stat(fname)
+    os.utime(fname, (stat.st_atime, stat.st_mtime + seconds))
+
+
+def check_cache(args):
+    """
+    Analyzing unchanged models a second time takes the results from the cache without
+    processing any units, while changing a catalog file recomputes (only) that model.  The
+    cached results equal the computed ones.
+    """
+    from sagestats import ResultCache, analyze_models
+
+    param_fnames = copy_catalogs(args)
+    cache = ResultCache(os.path.join(args.work_dir, "cache"))
+
+    expected, _ = analyze_models(param_fnames, num_files=args.num_files, num_workers=1)
+
+    passed = True
+
+    results_per_model, timings = analyze_models(param_fnames, num_files=args.num_files,
+                                                num_workers=1, cache=cache)
+    if not timings:
+        print("The first analysis did not process any units.")
+        passed = False
+
+    results_per_model, timings = analyze_models(param_fnames, num_files=args.num_files,
+                                                num_workers=1, cache=cache)
+    if timings:
+        print("The second analysis processed {0} units rather than taking the results from "
+              "the cache.".format(len(timings)))
+        passed = False
+    for param_fname, expected_results, results in zip(param_fnames, expected,
+                                                      results_per_model):
+        passed &= compare_model_results("{0} (cached)".format(param_fname), expected_results,
+                                        results)
+
+    touch_file(os.path.join(args.work_dir, os.path.basename(find_binary_catalogs(args)[0])))
+
+    results_per_model, timings = analyze_models(param_fnames, num_files=args.num_files,
+                                                num_workers=1, cache=cache)
+    if not timings or any(param_fname != param_fnames[0] for param_fname, _, _, _ in timings):
+        print("Changing a binary file recomputed the units {0}.".format(
+            [timing[:3] for timing in timings]))
+        passed = False
+    for param_fname, expected_results, results in zip(param_fnames, expected,
+                                                      results_per_model):
+        passed &= compare_model_results("{0} (recomputed)".format(param_fname),
+                                        expected_results, results)
+
+    return passed
+
+
+def run_incremental_analysis(param_fnames, args, cache):
+    """
+    Runs the incremental analysis of the models ``param_fnames``.  Returns the results of each
+    model and the sorted ``(param_fname, snap_key, file_idx)`` of the processed units.
+    """
+    from sagestats import analyze_models
+
+    results_per_model, timings = analyze_models(param_fnames, num_files=args.num_files,
+                                                num_workers=1, cache=cache, incremental=True)
+
+    return results_per_model, sorted(timing[:3] for timing in timings)
+
+
+def check_incremental(args):
+    """
+    The incremental analysis only processes the (snapshot, file) units that are new or have
+    changed since the last call: all but the missing one of a partially written catalog, the
+    new unit once the missing file is written, none if nothing changed and the changed unit
+    once a file is rewritten.  The results equal those of a full analysis.
+    """
+    from sagestats import ResultCache, analyze_models
+
+    param_fnames = copy_catalogs(args)
+    cache = ResultCache(os.path.join(args.work_dir, "cache"))
+    snap_keys = [snap_key for snap_key, _ in find_binary_snapshots(args)]
+
+    expected, timings = analyze_models(param_fnames, num_files=args.num_files, num_workers=1)
+    all_units = sorted(timing[:3] for timing in timings)
+
+    # Hide the last file of the binary catalog at its highest redshift, as if SAGE had not yet
+    # written it.
+    last_fname = BinarySage(os.path.join(args.work_dir,
+                                         os.path.basename(find_binary_catalogs(args)[-1])),
+                            num_files=args.num_files).determine_file_name(args.num_files - 1)
+    last_unit = (param_fnames[0], snap_keys[-1], args.num_files - 1)
+    first_fname = os.path.join(args.work_dir, os.path.basename(find_binary_catalogs(args)[0]))
+    first_unit = (param_fnames[0], snap_keys[0], 0)
+
+    os.rename(last_fname, "{0}.hidden".format(last_fname))
+    _, units = run_incremental_analysis(param_fnames, args, cache)
+    os.rename("{0}.hidden".format(last_fname), last_fname)
+
+    passed = True
+    if units != [unit for unit in all_units if unit != last_unit]:
+        print("The incremental analysis of a partial catalog processed the units {0}.".format(
+            units))
+        passed = False
+
+    for description, expected_units in [("once the missing file is written", [last_unit]),
+                                        ("of an unchanged catalog", []),
+                                        ("once a file is rewritten", [first_unit])]:
+
+        if expected_units == [first_unit]:
+            touch_file(first_fname)
+
+        results_per_model, units = run_incremental_analysis(param_fnames, args, cache)
+        if units != expected_units:
+            print("The incremental analysis {0} processed the units {1} rather than "
+                  "{2}.".format(description, units, expected_units))
+            passed = False
+
+        for param_fname, expected_results, results in zip(param_fnames, expected,
+                                                          results_per_model):
+            passed &= compare_model_results("{0} (incremental)".format(param_fname),
+                                            expected_results, results)
+
+    return passed
+
+def determine_tree_files(args):
+    """
+    Returns the prefix (``<SimulationDir>/<TreeName>``) and the number of the LHalo binary tree
+    files that the runs read, resolving the ``SimulationDir`` against ``args.run_dir``.
+    """
+
+    params = read_parameter_file(args.param_fname)
+    tree_prefix = os.path.join(args.run_dir, params["SimulationDir"], params["TreeName"])
+
+    return tree_prefix, int(params["NumSimulationTreeFiles"])
+
+
+def brute_force_read_forests(tree_prefix, num_files):
+    """
+    Parses the LHalo binary tree files ``tree_prefix.N`` directly.  Returns a list with the
+    halos of every forest, in the order that SAGE numbers the forests.
+    """
+    from sagetrees import determine_halo_dtype
+
+    forests = []
+    for file_idx in range(num_files):
+        with open("{0}.{1}".format(tree_prefix, file_idx), "rb") as fp:
+            nforests, totnhalos = np.fromfile(fp, dtype=np.int32, count=2)
+            nhalos_per_forest = np.fromfile(fp, dtype=np.int32, count=nforests)
+            halos = np.fromfile(fp, dtype=determine_halo_dtype(), count=totnhalos)
+
+        offset = 0
+        for nhalos in nhalos_per_forest:
+            forests.append(halos[offset:offset + nhalos])
+            offset += nhalos
+
+    return forests
+
+
+def check_trees(args):
+    """
+    Reading the input LHalo binary trees one forest at a time (and in batches) gives the halos
+    of a direct parse of the files, and the statistics at each snapshot (by file and chunk, in
+    parallel) equal those of all the halos at once.
+    """
+    from sagetrees import LHaloTrees, halo_pointer_fields
+
+    tree_prefix, num_files = determine_tree_files(args)
+    forests = brute_force_read_forests(tree_prefix, num_files)
+
+    passed = True
+
+    with LHaloTrees(tree_prefix, num_files) as trees:
+        trees.update_metadata()
+
+        if trees.num_forests != len(forests):
+            print("{0}: found {1} forests rather than {2}.".format(tree_prefix,
+                                                                   trees.num_forests,
+                                                                   len(forests)))
+            return False
+
+        for forestnr, halos in enumerate(forests):
+            passed &= compare_galaxies("{0} (forest {1})".format(tree_prefix, forestnr), halos,
+                                       trees.read_forest(forestnr))
+
+        forestnrs = np.random.RandomState(len(forests)).permutation(len(forests))[:50]
+        halos, forest_offsets = trees.read_forests(forestnrs)
+        expected_nhalos = np.array([len(forests[forestnr]) for forestnr in forestnrs])
+        passed &= compare_galaxies("{0} (forests)".format(tree_prefix),
+                                   np.concatenate([forests[forestnr]
+                                                   for forestnr in forestnrs]), halos)
+        if not np.array_equal(forest_offsets, np.cumsum(expected_nhalos) - expected_nhalos):
+            print("{0}: the offsets of the forests differ.".format(tree_prefix))
+            passed = False
+
+        all_stats = [trees.compute_snapshot_statistics(num_workers=1),
+                     trees.compute_snapshot_statistics(check_chunk_size, num_workers=2)]
+
+    # The index of each halo within its forest, which is what the tree pointers refer to.
+    halos = np.concatenate(forests)
+    local_idx = np.concatenate([np.arange(len(forest)) for forest in forests])
+    nhalos = np.concatenate([np.full(len(forest), len(forest)) for forest in forests])
+
+    snap_num = halos["SnapNum"].astype(np.int64)
+    num_snaps = snap_num.max() + 1
+    mvir = halos["Mvir"].astype(np.float64)
+
+    expected = {"num_halos": np.bincount(snap_num, minlength=num_snaps),
+                "num_fof_groups": np.zeros(num_snaps, dtype=np.int64),
+                "num_particles": np.zeros(num_snaps, dtype=np.int64),
+                "Mvir_sum": np.zeros(num_snaps),
+                "Mvir_max": np.full(num_snaps, -np.inf),
+                "num_bad_pointers": np.zeros(num_snaps, dtype=np.int64)}
+    for halo_idx, snap in enumerate(snap_num):
+        expected["num_fof_groups"][snap] += halos["FirstHaloInFOFgroup"][halo_idx] == \
+            local_idx[halo_idx]
+        expected["num_particles"][snap] += halos["Len"][halo_idx]
+        expected["Mvir_sum"][snap] += mvir[halo_idx]
+        expected["Mvir_max"][snap] = max(expected["Mvir_max"][snap], mvir[halo_idx])
+        expected["num_bad_pointers"][snap] += sum(
+            halos[field][halo_idx] < -1 or halos[field][halo_idx] >= nhalos[halo_idx]
+            for field in halo_pointer_fields)
+
+    for chunk_description, stats in zip(["", " (chunked)"], all_stats):
+        for key in sorted(expected):
+            if key == "Mvir_sum":
+                equal = np.allclose(stats[key], expected[key], rtol=1e-10, atol=0.0)
+            else:
+                equal = np.array_equal(stats[key], expected[key])
+            if not equal:
+                print("{0}{1}: the statistic '{2}' differs.".format(tree_prefix,
+                                                                    chunk_description, key))
+                passed = False
+
+    return passed
+
+
+def brute_force_histories(snapshots, galaxy_indices, start_idx, fields):
+    """
+    Follows the ``galaxy_indices`` through the ``snapshots`` (a list of ``(gals, ngals_per_tree,
+    snap_num)``, from the latest to the earliest) by their ``GalaxyIndex``, starting at the
+    snapshot ``start_idx``.
+
+    Returns the rows, the merger targets (snapshot index and row) and the ``fields`` of each
+    galaxy at each snapshot as lists of lists, with ``None`` where the galaxy does not exist.
+    """
+
+    snap_idx_per_num = dict((snap_num, snap_idx)
+                            for snap_idx, (_, _, snap_num) in enumerate(snapshots))
+    rows_per_tree = []
+    for gals, ngals_per_tree, _ in snapshots:
+        treenums = np.repeat(np.arange(len(ngals_per_tree)), ngals_per_tree)
+        rows_per_tree.append(dict((treenum, np.flatnonzero(treenums == treenum))
+                                  for treenum in np.unique(treenums)))
+
+    histories = {"rows": [], "merges": [], "fields": []}
+    for galaxy_index in galaxy_indices:
+
+        rows = [-1] * len(snapshots)
+        merges = [(-1, -1)] * len(snapshots)
+        values = [None] * len(snapshots)
+
+        for snap_idx in range(start_idx, len(snapshots)):
+            gals, ngals_per_tree, _ = snapshots[snap_idx]
+
+            row_per_id = dict((gal_id, row) for row, gal_id in enumerate(gals["GalaxyIndex"]))
+            if galaxy_index not in row_per_id:
+                break
+
+            row = row_per_id[galaxy_index]
+            rows[snap_idx] = row
+            values[snap_idx] = [gals[field][row] for field in fields]
+
+            target_idx = snap_idx_per_num.get(gals["mergeIntoSnapNum"][row])
+            if gals["mergeType"][row] > 0 and gals["mergeIntoID"][row] >= 0 and \
+               target_idx is not None:
+                treenum = np.repeat(np.arange(len(ngals_per_tree)), ngals_per_tree)[row]
+                target_rows = rows_per_tree[target_idx].get(treenum, [])
+                if gals["mergeIntoID"][row] < len(target_rows):
+                    merges[snap_idx] = (target_idx, target_rows[gals["mergeIntoID"][row]])
+
+        histories["rows"].append(rows)
+        histories["merges"].append(merges)
+        histories["fields"].append(values)
+
+    return histories
+
+
+def compare_histories(description, expected, histories, fields):
+    """
+    Returns whether the ``histories`` (see :py:func:`sagehistory.read_main_branch_histories`)
+    equal the brute-force histories ``expected`` (see :py:func:`~brute_force_histories`).
+    """
+
+    for gal_idx, (rows, merges, values) in enumerate(zip(expected["rows"], expected["merges"],
+                                                         expected["fields"])):
+        for snap_idx, row in enumerate(rows):
+
+            if histories["rows"][snap_idx][gal_idx] != row or \
+               (histories["merge_snaps"][snap_idx][gal_idx],
+                histories["merge_rows"][snap_idx][gal_idx]) != merges[snap_idx]:
+                print("{0}: galaxy {1} differs at {2}.".format(description, gal_idx,
+                                                               histories["snap_keys"][snap_idx]))
+                return False
+
+            for field_idx, field in enumerate(fields):
+                value = histories[field][snap_idx][gal_idx]
+                if row < 0:
+                    missing = np.isnan(value) if value.dtype.kind == "f" else value == -1
+                    equal = np.all(missing)
+                else:
+                    equal = np.array_equal(value, values[snap_idx][field_idx])
+                if not equal:
+                    print("{0}: the '{1}' of galaxy {2} differs at {3}.".format(
+                        description, field, gal_idx, histories["snap_keys"][snap_idx]))
+                    return False
+
+    return True
+
+
+def check_history(args):
+    """
+    The main-branch histories of galaxies (from the latest snapshot and from an earlier one)
+    in the binary and HDF5 catalogs equal the histories found by following the
+    ``GalaxyIndex`` through full reads, both when the history index is built and when it is
+    taken from its cache.  The catalogs are copied, as the index is cached next to them.
+    """
+    from sagehistory import read_main_branch_histories
+
+    for fname in find_binary_catalogs(args):
+        copy_binary_catalog(fname, args)
+    catalog_fnames = [os.path.join(args.work_dir, os.path.basename(args.binary_prefix)),
+                      copy_hdf5_catalog(args)]
+
+    fields = ["StellarMass", "Type", "Pos"]
+
+    # From the latest to the earliest snapshot, as the histories are.
+    snapshots = []
+    for snap_key, fname in find_binary_snapshots(args):
+        g = BinarySage(fname, num_files=args.num_files)
+        gals = g.read_gals()
+        snapshots.append((gals, g.tree_index["ngals"], snap_key_to_snap_num(snap_key)))
+    snapshots.sort(key=lambda snapshot: snapshot[2], reverse=True)
+
+    passed = True
+
+    for start_idx in [0, len(snapshots) // 2]:
+
+        gals, _, snap_num = snapshots[start_idx]
+        # Some galaxies, those that merge at this snapshot and one that does not exist.
+        galaxy_indices = list(gals["GalaxyIndex"][::max(1, len(gals) // 25)]) + \
+            list(gals["GalaxyIndex"][gals["mergeType"] > 0]) + [-12345]
+        expected = brute_force_histories(snapshots, galaxy_indices, start_idx, fields)
+
+        for catalog_fname in catalog_fnames:
+            for description in ["first read", "second read"]:
+                histories = read_main_branch_histories(catalog_fname, galaxy_indices, fields,
+                                                       snap=snap_num,
+                                                       num_files=args.num_files)
+                passed &= compare_histories("{0} Snap_{1} ({2})".format(
+                    os.path.basename(catalog_fname), snap_num, description), expected,
+                    histories, fields)
+
+    return passed
+
+
+def check_grid(args):
+    """
+    Running SAGE over a parameter grid that holds the parameters of the runs reproduces the
+    histories of the runs at that point, and not at the other.  Running the grid again takes
+    every point from the cache.
+    """
+    from sagegrid import run_parameter_grid, write_parameter_file
+    from sagestats import ResultCache, analyze_models
+
+    if not os.path.isfile(args.sage):
+        print("The SAGE executable '{0}' does not exist.".format(args.sage))
+        return False
+
+    # The grid runs are launched from elsewhere, so the input files must be absolute.
+    params = read_parameter_file(args.param_fname)
+    base_param_fname = os.path.join(args.work_dir, "base.par")
+    write_parameter_file(args.param_fname, {
+        "SimulationDir": os.path.join(os.path.abspath(os.path.join(args.run_dir,
+                                                                   params["SimulationDir"])),
+                                      ""),
+        "FileWithSnapList": os.path.abspath(os.path.join(args.run_dir,
+                                                         params["FileWithSnapList"]))},
+        base_param_fname)
+
+    expected, _ = analyze_models([write_model_parameter_file(args, params["OutputFormat"])],
+                                 num_files=args.num_files, num_workers=1)
+
+    base_value = params["SfrEfficiency"]
+    grid = {"SfrEfficiency": [base_value, str(2.0 * float(base_value))]}
+    cache = ResultCache(os.path.join(args.work_dir, "cache"))
+
+    passed = True
+
+    all_results = []
+    for description in ["run", "cached"]:
+        results = run_parameter_grid(args.sage, base_param_fname, grid,
+                                     os.path.join(args.work_dir, "grid"), num_workers=2,
+                                     cache=cache)
+
+        for result in results:
+            if "error" in result:
+                print("The grid run with {0} failed: {1}\n{2}".format(result["parameters"],
+                                                                      result["error"],
+                                                                      result["log"]))
+                return False
+            if result["cached"] != (description == "cached"):
+                print("The grid point {0} was {1}cached.".format(
+                    result["parameters"], "" if result["cached"] else "not "))
+                passed = False
+            for snapshot in result["history"]:
+                snapshot["SMF"] = np.array(snapshot["SMF"])
+
+        all_results.append(results)
+
+        passed &= compare_model_results("The grid point {0} ({1})".format(
+            results[0]["parameters"], description), expected[0], results[0]["history"])
+        if all(np.array_equal(snapshot["SMF"], expected_snapshot["SMF"])
+               for snapshot, expected_snapshot in zip(results[1]["history"], expected[0])):
+            print("The grid point {0} has the histories of the runs.".format(
+                results[1]["parameters"]))
+            passed = False
+
+    passed &= compare_model_results("The grid point {0} (cached)".format(grid),
+                                    all_results[0][1]["history"], all_results[1][1]["history"])
+
+    return passed
+
+
+def check_timing(args):
+    """
+    If SAGE was compiled with ``USE-FOREST-TIMING``, the timings of the runs cover every forest
+    of the input trees exactly once, with the number of halos of the trees.
+    """
+    from sagetiming import determine_timing_fname, read_run_timings
+    from sagetrees import read_lhalo_header
+
+    # The runs only write timings files if SAGE was compiled with USE-FOREST-TIMING.
+    params = read_parameter_file(args.param_fname)
+    timing_prefix = os.path.join(os.path.dirname(os.path.abspath(args.binary_prefix)),
+                                 params["FileNameGalaxies"])
+    if not os.path.exists(determine_timing_fname(timing_prefix, 0)):
+        print("{0}: SAGE did not record any forest timings.".format(timing_prefix))
+        return True
+
+    forests = read_run_timings(timing_prefix)["forests"]
+
+    tree_prefix, num_files = determine_tree_files(args)
+    nhalos_per_forest = [read_lhalo_header("{0}.{1}".format(tree_prefix, file_idx))[0]
+                         for file_idx in range(num_files)]
+
+    expected = sorted((file_idx, forestnr, nhalos)
+                      for file_idx in range(num_files)
+                      for forestnr, nhalos in enumerate(nhalos_per_forest[file_idx]))
+    found = sorted(zip(forests["filenr"].tolist(), forests["original_treenr"].tolist(),
+                       forests["nhalos"].tolist()))
+    if found != expected:
+        print("{0}: the timings hold {1} forests, rather than the {2} forests of the "
+              "trees.".format(timing_prefix, len(found), len(expected)))
+        return False
+
+    return True
+
+
+# The checks run by ``test_sage.sh``, keyed by their name.  They need the output of the SAGE
+# runs; the properties that do not are covered by the ``test_*.py`` unit tests.
+checks = {"memmap": check_memmap,
+          "projection": check_projection,
+          "tree_index": check_tree_index,
+          "parallel_read": check_parallel_read,
+          "streaming": check_streaming,
+          "hdf5_metadata": check_hdf5_metadata,
+          "hdf5_trees": check_hdf5_trees,
+          "round_trip": check_round_trip,
+          "parquet": check_parquet,
+          "select": check_select,
+          "spatial": check_spatial,
+          "stats": check_stats,
+          "analyze_models": check_analyze_models,
+          "cache": check_cache,
+          "incremental": check_incremental,
+          "trees": check_trees,
+          "history": check_history,
+          "grid": check_grid,
+          "timing": check_timing}
+
+
+if __name__ == '__main__':
+
+    import argparse
+    import tempfile
+
+    description = "Check the Python tools against the Mini-Millennium outputs written by "\
+                  "test_sage.sh.  Run from the directory holding the outputs."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("check", metavar="CHECK", choices=sorted(checks),
+                        help="the check to run. One of {0}.".format(sorted(checks)))
+    parser.add_argument("--binary_prefix", metavar="PREFIX", default="test_sage",
+                        help="the model prefix of the binary output (default: test_sage).")
+    parser.add_argument("--hdf5_fname", metavar="FILE", default="test_sage.hdf5",
+                        help="the HDF5 master file (default: test_sage.hdf5).")
+    parser.add_argument("--num_files", metavar="NUM_FILES", type=int, default=1,
+                        help="number of processors SAGE ran on, i.e., the number of files each "
+                             "binary redshift output is split over (default: 1).")
+    parser.add_argument("--param_fname", metavar="FILE", default="mini-millennium.par",
+                        help="the parameter file of the runs (default: mini-millennium.par).")
+    parser.add_argument("--run_dir", metavar="DIR", default=os.path.dirname(tests_dir),
+                        help="the directory SAGE ran from, which the paths inside the parameter "
+                             "file are relative to (default: the SAGE root directory).")
+    parser.add_argument("--sage", metavar="EXECUTABLE", default=None,
+                        help="the SAGE executable (default: 'sage' in the run directory).")
+
+    args = parser.parse_args()
+    if args.sage is None:
+        args.sage = os.path.join(args.run_dir, "sage")
+
+    # Anything written by the checks (converted catalogs, caches, ...) goes here.
+    args.work_dir = tempfile.mkdtemp(prefix="sagecheck")
+    try:
+        passed = checks[args.check](args)
+    finally:
+        shutil.rmtree(args.work_dir, ignore_errors=True)
+
+    print("Check: {0} {1}".format(args.check, "passed" if passed else "failed"))
+    if not passed:
+        sys.exit(1)
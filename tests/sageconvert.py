@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+
+from sagediff import BinarySage, Hdf5Sage, determine_binary_snapshots, snap_key_to_snap_num
+from sageutils import lazy_import, run_tasks
+
+np = lazy_import("numpy")
+
+# Matches the chunking used by ``save_gals_hdf5.c``.
+num_gals_per_buffer = 8192
+
+# Parquet row groups hold roughly this many galaxies (always a whole number of trees).
+parquet_row_group_size = 131072
+
+# Min/max statistics are only written for these Parquet columns so that scans selecting on
+# (say) the stellar mass can skip row groups.
+parquet_statistics_fields = ["GalaxyIndex", "SAGETreeIndex", "Mvir", "CentralMvir", "ColdGas",
+                             "StellarMass", "BulgeMass", "HotGas", "EjectedMass",
+                             "BlackHoleMass", "IntraClusterStars"]
+
+
+def determine_core_hdf5_fname(hdf5_fname, core_idx):
+    """
+    Returns the name of the file written by core ``core_idx`` for the master file
+    ``hdf5_fname`` (e.g., ``model.hdf5`` -> ``model_1.hdf5``).
+    """
+
+    base, _ = os.path.splitext(hdf5_fname)
+
+    return "{0}_{1}.hdf5".format(base, core_idx)
+
+
+def write_binary_file_to_hdf5(binary_fnames, core_idx, ncores, core_fname, chunk_size,
+                              compression, compression_opts):
+    """
+    Writes the binary files of a single core into the HDF5 file ``core_fname`` using the
+    layout of ``save_gals_hdf5.c``.
+
+    ``binary_fnames`` is a list of ``(snap_key, redshift, binary_fname)``.  The galaxies are
+    streamed through in chunks of ``chunk_size`` galaxies, which is also the chunk size of the
+    HDF5 datasets.
+    """
+    import h5py
+
+    with h5py.File(core_fname, "w") as hdf5_file:
+
+        tree_info_group = hdf5_file.create_group("TreeInfo")
+
+        for snap_key, redshift, binary_fname in binary_fnames:
+
+            g = BinarySage(binary_fname, memmap=True)
+            with open(binary_fname, "rb") as fp:
+                g.read_header(fp)
+
+            snap_group = hdf5_file.create_group(snap_key)
+            snap_group.attrs.create("redshift", redshift, dtype=np.float32)
+            snap_group.attrs.create("num_gals", g.totngals, dtype=np.int64)
+
+            tree_info_group.create_group(snap_key).create_dataset(
+                "NumGalsPerTreePerSnap", data=g.ngal_per_tree.astype(np.int32))
+
+            # The datasets are unlimited, just as if they were written by SAGE.
+            datasets = {}
+            for name in g.dtype.names:
+                if g.dtype[name].shape:
+                    dataset_names = ["{0}{1}".format(name, dim_name)
+                                     for dim_name in ["x", "y", "z"]]
+                    dtype = g.dtype[name].base
+                else:
+                    dataset_names = [name]
+                    dtype = g.dtype[name]
+
+                for dataset_name in dataset_names:
+                    datasets[dataset_name] = snap_group.create_dataset(
+                        dataset_name, shape=(g.totngals, ), maxshape=(None, ), dtype=dtype,
+                        chunks=(chunk_size, ), compression=compression,
+                        compression_opts=compression_opts)
+
+            task_forestnr = snap_group.create_dataset(
+                "TaskForestNr", shape=(g.totngals, ), maxshape=(None, ), dtype=np.int64,
+                chunks=(chunk_size, ), compression=compression,
+                compression_opts=compression_opts)
+
+            # The first galaxy of each tree.  Used to recover the forest of each galaxy.
+            tree_offsets = np.cumsum(g.ngal_per_tree, dtype=np.int64) - g.ngal_per_tree
+
+            offset = 0
+            for chunk in g.iter_gals(chunk_size):
+
+                ngals = len(chunk)
+                for name in g.dtype.names:
+                    if g.dtype[name].shape:
+                        for dim_num, dim_name in enumerate(["x", "y", "z"]):
+                            datasets["{0}{1}".format(name, dim_name)][offset:offset+ngals] = \
+                                chunk[name][:, dim_num]
+                    else:
+                        datasets[name][offset:offset+ngals] = chunk[name]
+
+                gal_idx = np.arange(offset, offset + ngals)
+                task_forestnr[offset:offset+ngals] = \
+                    np.searchsorted(tree_offsets, gal_idx, side="right") - 1
+
+                offset += ngals
+
+        header_group = hdf5_file.create_group("Header")
+        header_group.create_group("Misc").attrs.create("num_cores", ncores, dtype=np.int32)
+        header_group.create_group("Simulation").attrs.create("num_trees_this_file",
+                                                             g.totntrees, dtype=np.int64)
+        header_group.create_dataset("output_snapshots",
+                                    data=[snap_key_to_snap_num(snap_key)
+                                          for snap_key, _, _ in binary_fnames],
+                                    dtype=np.int32)
+
+    return core_fname
+
+
+def write_hdf5_master_file(hdf5_fname, core_fnames, snap_keys):
+    """
+    Writes the master file linking to each core file as ``Core_N``.
+    """
+    import h5py
+
+    with h5py.File(hdf5_fname, "w") as hdf5_file:
+
+        for core_idx, core_fname in enumerate(core_fnames):
+            link_fname = "./{0}".format(os.path.basename(core_fname))
+            hdf5_file["Core_{0}".format(core_idx)] = h5py.ExternalLink(link_fname, "/")
+
+        header_group = hdf5_file.create_group("Header")
+        header_group.create_group("Misc").attrs.create("num_cores", len(core_fnames),
+                                                       dtype=np.int32)
+        header_group.create_dataset("output_snapshots",
+                                    data=[snap_key_to_snap_num(snap_key)
+                                          for snap_key in snap_keys],
+                                    dtype=np.int32)
+
+
+def convert_binary_to_hdf5(binary_prefix, num_files, hdf5_fname, chunk_size=num_gals_per_buffer,
+                           compression=None, compression_opts=None, num_workers=None):
+    """
+    Converts every redshift output of the binary model ``binary_prefix`` (split over
+    ``num_files`` files) into the HDF5 master file ``hdf5_fname``.
+
+    Each binary file number becomes one core file (``<base>_N.hdf5``) and the files are
+    converted in parallel by ``num_workers`` processes (defaults to the number of CPUs).  At
+    most ``chunk_size`` galaxies are held in memory by each process.
+
+    ``compression`` and ``compression_opts`` are passed to ``h5py`` (e.g., ``"gzip"`` and
+    ``4``).  The binary format does not store the descriptions and units of the fields nor
+    the simulation parameters, so these are not written.
+    """
+
+    snapshots = determine_binary_snapshots(binary_prefix, num_files)
+
+    tasks = []
+    for core_idx in range(num_files):
+        binary_fnames = [(snap_key, redshift, fnames[core_idx][1])
+                         for (snap_key, redshift, fnames) in snapshots]
+        core_fname = determine_core_hdf5_fname(hdf5_fname, core_idx)
+
+        tasks.append((binary_fnames, core_idx, num_files, core_fname, chunk_size, compression,
+                      compression_opts))
+
+    core_fnames = run_tasks(write_binary_file_to_hdf5, tasks, num_workers)
+
+    write_hdf5_master_file(hdf5_fname, core_fnames, [snap_key for snap_key, _, _ in snapshots])
+
+    return hdf5_fname
+
+
+def write_hdf5_core_to_binary(hdf5_fname, core_idx, binary_prefix, chunk_size):
+    """
+    Writes the galaxies of core ``core_idx`` of the HDF5 master file ``hdf5_fname`` into one
+    binary file per snapshot (``<binary_prefix>_zW.XYZ_<core_idx>``).
+
+    The galaxies are streamed through in chunks of ``chunk_size`` galaxies.  Fields that are
+    not part of the binary galaxy struct (e.g., ``TaskForestNr``) are skipped.
+    """
+
+    binary_fnames = []
+
+    with Hdf5Sage(hdf5_fname) as hdf5_sage:
+
+        dtype = BinarySage(binary_prefix).dtype
+        core_group = hdf5_sage.get_core_groups()[core_idx]
+
+        for snap_key in hdf5_sage.metadata["snap_keys"]:
+
+            snapshot = hdf5_sage.metadata["snapshots"][snap_key]
+            ngals = snapshot["num_gals_per_core"][core_idx]
+            ngal_per_tree = core_group["TreeInfo"][snap_key]["NumGalsPerTreePerSnap"][:]
+
+            datasets = hdf5_sage.get_snap_datasets(snap_key, core_idx)
+            fields = [key for key in hdf5_sage.determine_fields(snap_key)
+                      if key in dtype.names]
+
+            binary_fname = "{0}_z{1:1.3f}_{2}".format(binary_prefix, snapshot["redshift"],
+                                                       core_idx)
+            with open(binary_fname, "wb") as fp:
+
+                np.array([len(ngal_per_tree), ngals], dtype=np.int32).tofile(fp)
+                ngal_per_tree.astype(np.int32).tofile(fp)
+
+                for start in range(0, ngals, chunk_size):
+
+                    num_gals_chunk = min(chunk_size, ngals - start)
+                    chunk = np.zeros(num_gals_chunk, dtype=dtype)
+
+                    for key in fields:
+                        data = hdf5_sage.allocate_field(snap_key, key, num_gals_chunk)
+                        hdf5_sage.read_field_slice(datasets, key, start, num_gals_chunk,
+                                                   data, 0)
+                        chunk[key] = data
+
+                    chunk.tofile(fp)
+
+            binary_fnames.append(binary_fname)
+
+    return binary_fnames
+
+
+def convert_hdf5_to_binary(hdf5_fname, binary_prefix, chunk_size=num_gals_per_buffer,
+                           num_workers=None):
+    """
+    Converts every snapshot of the HDF5 master file ``hdf5_fname`` into the binary format
+    written by ``save_gals_binary.c``.  One binary file is written per core and snapshot.
+
+    The cores are converted in parallel by ``num_workers`` processes (defaults to the number
+    of CPUs).  At most ``chunk_size`` galaxies are held in memory by each process.
+    """
+
+    with Hdf5Sage(hdf5_fname) as hdf5_sage:
+        ncores = hdf5_sage.ncores
+
+    tasks = [(hdf5_fname, core_idx, binary_prefix, chunk_size) for core_idx in range(ncores)]
+    binary_fnames = run_tasks(write_hdf5_core_to_binary, tasks, num_workers)
+
+    return [fname for fnames in binary_fnames for fname in fnames]
+
+
+def determine_parquet_fname(parquet_dir, snap_key, file_idx):
+    """
+    Returns the name of the Parquet file holding file number ``file_idx`` at snapshot
+    ``snap_key``.  The directories follow the Hive partitioning scheme so that readers (e.g.,
+    ``pyarrow.dataset``) can filter on ``snap`` and ``file`` without opening the files.
+    """
+
+    return os.path.join(parquet_dir, "snap={0}".format(snap_key_to_snap_num(snap_key)),
+                        "file={0}".format(file_idx), "part-0.parquet")
+
+
+def galaxies_to_arrow_table(gals):
+    """
+    Converts the galaxy struct array ``gals`` into an Arrow table with one column per field.
+    Multi-dimensional fields (e.g., ``Pos``) become fixed-size list columns.
+    """
+    import pyarrow as pa
+
+    columns = []
+    for name in gals.dtype.names:
+
+        data = np.ascontiguousarray(gals[name])
+
+        if data.ndim > 1:
+            columns.append(pa.FixedSizeListArray.from_arrays(pa.array(data.reshape(-1)),
+                                                             data.shape[1]))
+        else:
+            columns.append(pa.array(data))
+
+    return pa.Table.from_arrays(columns, names=list(gals.dtype.names))
+
+
+def write_binary_file_to_parquet(binary_fnames, file_idx, parquet_dir, row_group_size,
+                                 compression):
+    """
+    Writes the binary files of a single file number into one Parquet file per snapshot (see
+    :py:func:`~determine_parquet_fname`).
+
+    ``binary_fnames`` is a list of ``(snap_key, redshift, binary_fname)``.  Each row group
+    holds whole trees and roughly ``row_group_size`` galaxies.  Only a single row group is
+    held in memory at any time.
+    """
+    import pyarrow.parquet as pq
+
+    parquet_fnames = []
+
+    for snap_key, redshift, binary_fname in binary_fnames:
+
+        g = BinarySage(binary_fname, memmap=True)
+        with open(binary_fname, "rb") as fp:
+            g.read_header(fp)
+            gals = g.memmap_gals(fp)
+
+        parquet_fname = determine_parquet_fname(parquet_dir, snap_key, file_idx)
+        if not os.path.isdir(os.path.dirname(parquet_fname)):
+            os.makedirs(os.path.dirname(parquet_fname))
+
+        schema = galaxies_to_arrow_table(gals[0:0]).schema
+        schema = schema.with_metadata({"redshift": repr(redshift), "snap_key": snap_key})
+
+        # The galaxy index just past the end of each tree.
+        tree_ends = np.cumsum(g.ngal_per_tree, dtype=np.int64)
+
+        with pq.ParquetWriter(parquet_fname, schema, compression=compression,
+                              write_statistics=parquet_statistics_fields) as writer:
+
+            start = 0
+            while start < g.totngals:
+
+                # End the row group at the last tree that fits, but always include at least one
+                # tree.
+                tree_idx = np.searchsorted(tree_ends, start + row_group_size, side="right")
+                end = tree_ends[tree_idx - 1] if tree_idx > 0 else 0
+                if end <= start:
+                    end = tree_ends[np.searchsorted(tree_ends, start, side="right")]
+
+                table = galaxies_to_arrow_table(gals[start:end]).replace_schema_metadata(
+                    schema.metadata)
+                writer.write_table(table, row_group_size=end - start)
+
+                start = end
+
+        parquet_fnames.append(parquet_fname)
+
+    return parquet_fnames
+
+
+def convert_binary_to_parquet(binary_prefix, num_files, parquet_dir,
+                              row_group_size=parquet_row_group_size, compression="snappy",
+                              num_workers=None):
+    """
+    Exports every redshift output of the binary model ``binary_prefix`` (split over
+    ``num_files`` files) into a Parquet dataset in ``parquet_dir``, partitioned by snapshot and
+    file number.
+
+    Row groups are aligned to trees, ``Pos/Vel/Spin`` become fixed-size list columns and
+    min/max statistics are written for ``parquet_statistics_fields``.  The files are exported
+    in parallel by ``num_workers`` processes (defaults to the number of CPUs).
+
+    Requires ``pyarrow``.
+    """
+
+    snapshots = determine_binary_snapshots(binary_prefix, num_files)
+
+    tasks = []
+    for file_idx in range(num_files):
+        binary_fnames = [(snap_key, redshift, fnames[file_idx][1])
+                         for (snap_key, redshift, fnames) in snapshots]
+
+        tasks.append((binary_fnames, file_idx, parquet_dir, row_group_size, compression))
+
+    parquet_fnames = run_tasks(write_binary_file_to_parquet, tasks, num_workers)
+
+    return [fname for fnames in parquet_fnames for fname in fnames]
+
+
+if __name__ == '__main__':
+
+    import argparse
+    description = "Convert SAGE catalogs between the binary and HDF5 formats, or export them "\
+                  "to Parquet"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("mode", metavar="MODE",
+                        help="Either 'binary-hdf5', 'hdf5-binary' or 'binary-parquet'.")
+    parser.add_argument("input", metavar="INPUT",
+                        help="the binary model prefix (say, /path/to/model) or the HDF5 "
+                             "master file.")
+    parser.add_argument("output", metavar="OUTPUT",
+                        help="the HDF5 master file, the binary model prefix or the Parquet "
+                             "dataset directory.")
+    parser.add_argument("--num_files", metavar="NUM_FILES", type=int, default=1,
+                        help="in 'binary-hdf5' and 'binary-parquet' mode, number of files "
+                             "the binary catalog was split over.")
+    parser.add_argument("--chunk_size", metavar="CHUNK_SIZE", type=int,
+                        default=num_gals_per_buffer,
+                        help="number of galaxies streamed at once, and the chunk size of the "
+                             "HDF5 datasets (default: {0}).".format(num_gals_per_buffer))
+    parser.add_argument("--row_group_size", metavar="ROW_GROUP_SIZE", type=int,
+                        default=parquet_row_group_size,
+                        help="approximate number of galaxies per Parquet row group "
+                             "(default: {0}).".format(parquet_row_group_size))
+    parser.add_argument("--compression", metavar="FILTER", default=None,
+                        help="compress the HDF5 datasets (say, gzip) or the Parquet files "
+                             "(default: snappy) with this codec.")
+    parser.add_argument("--compression_opts", metavar="LEVEL", type=int, default=None,
+                        help="options for the compression filter (say, the gzip level).")
+    parser.add_argument("--num_workers", metavar="NUM_WORKERS", type=int, default=None,
+                        help="number of files converted in parallel (default: the number of "
+                             "CPUs).")
+
+    args = parser.parse_args()
+
+    if args.mode == "binary-hdf5":
+        convert_binary_to_hdf5(args.input, args.num_files, args.output,
+                               chunk_size=args.chunk_size, compression=args.compression,
+                               compression_opts=args.compression_opts,
+                               num_workers=args.num_workers)
+    elif args.mode == "hdf5-binary":
+        convert_hdf5_to_binary(args.input, args.output, chunk_size=args.chunk_size,
+                               num_workers=args.num_workers)
+    elif args.mode == "binary-parquet":
+        convert_binary_to_parquet(args.input, args.num_files, args.output,
+                                  row_group_size=args.row_group_size,
+                                  compression=args.compression or "snappy",
+                                  num_workers=args.num_workers)
+    else:
+        print("We only accept conversions from 'binary-hdf5', 'hdf5-binary' or "
+              "'binary-parquet'. Please set the 'mode' argument to one of these options.")
+        raise ValueError
+
+    print("Converted {0} to {1}".format(args.input, args.output))
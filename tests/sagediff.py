@@ -1,22 +1,226 @@
 #!/usr/bin/env python
 from __future__ import print_function
 
+import itertools
+import json
 import os
 import sys
-import numpy as np
+
+from sageutils import determine_file_stamps, lazy_import
 
 try:
     xrange
 except NameError:
     xrange = range
 
+np = lazy_import("numpy")
+
+
+# Each entry of the tree index describes where a single tree lives on disk.  The dtypes are
+# kept as field lists so that they can be built without importing numpy.
+tree_index_dtype = [("file_idx", "<i4"),
+                    ("byte_offset", "<i8"),
+                    ("ngals", "<i4")]
+
+# The HDF5 counterpart of the tree index.  ``gal_offset`` is the index of the first galaxy of
+# the tree within the snapshot group of core ``core_idx``.
+hdf5_tree_index_dtype = [("core_idx", "<i4"),
+                         ("gal_offset", "<i8"),
+                         ("ngals", "<i4")]
+
+# HDF5 reads of up to this many galaxies use h5py's fast path for simple slices, which has a
+# far smaller per-call overhead than ``read_direct`` (e.g., for tree seeks).  Larger reads use
+# ``read_direct`` to avoid a temporary copy.
+hdf5_sliced_read_max_gals = 1 << 20
+
+# The comparison operators that can be used in selection predicates (see
+# ``evaluate_selection``), mapped to the name of the matching numpy function.
+selection_operators = {"<": "less",
+                       "<=": "less_equal",
+                       ">": "greater",
+                       ">=": "greater_equal",
+                       "==": "equal",
+                       "!=": "not_equal"}
+
+
+def determine_selection_fields(predicates=None, box=None):
+    """
+    Returns the fields that are needed to evaluate the selection (see
+    :py:func:`~evaluate_selection`).
+    """
+
+    fields = []
+    for (field, operator, _) in (predicates or []):
+        if operator not in selection_operators:
+            msg = "Operator '{0}' is not supported. The valid operators are "\
+                  "{1}".format(operator, sorted(selection_operators))
+            raise ValueError(msg)
+        if field not in fields:
+            fields.append(field)
+
+    if box is not None and "Pos" not in fields:
+        fields.append("Pos")
+
+    return fields
+
+
+def evaluate_selection(gals, num_gals, predicates=None, box=None):
+    """
+    Returns a boolean mask of the ``num_gals`` galaxies in ``gals`` (anything indexable by the
+    field name) that satisfy all of the ``predicates`` and lie inside ``box``.
+
+    ``predicates`` is a list of ``(field, operator, value)`` tuples, e.g., ``("StellarMass",
+    ">", 1.0)``.  See ``selection_operators`` for the supported operators.
+
+    ``box`` is a pair ``(lower, upper)`` of 3-element positions and selects galaxies with
+    ``lower <= Pos < upper``.  If ``lower > upper`` along a dimension, the box wraps around
+    the periodic boundary along that dimension.
+    """
+
+    mask = np.ones(num_gals, dtype=bool)
+
+    for (field, operator, value) in (predicates or []):
+        mask &= getattr(np, selection_operators[operator])(gals[field], value)
+
+    if box is not None:
+        pos = gals["Pos"]
+        for dim_num, (lower, upper) in enumerate(zip(box[0], box[1])):
+            if lower <= upper:
+                mask &= (pos[:, dim_num] >= lower) & (pos[:, dim_num] < upper)
+            else:
+                mask &= (pos[:, dim_num] >= lower) | (pos[:, dim_num] < upper)
+
+    return mask
+
+# When reading files with a process pool, the galaxies are written into an anonymous shared
+# memory buffer.  The buffer is inherited by each worker through ``_init_shared_gals_buffer``.
+_shared_gals_buffer = None
+
+
+def _init_shared_gals_buffer(shared_buffer):
+    global _shared_gals_buffer
+    _shared_gals_buffer = shared_buffer
+
+
+def _read_file_into_gals(gals, fname, byte_offset, ngal, dest_offset, file_dtype, fields=None):
+    """
+    Reads ``ngal`` galaxies (of type ``file_dtype``), starting ``byte_offset`` bytes into the
+    file ``fname``, directly into ``gals[dest_offset:dest_offset+ngal]``.
+
+    If ``fields`` is not ``None``, only these fields are read using a strided access.
+    """
+
+    if ngal == 0:
+        return
+
+    dest = gals[dest_offset:dest_offset+ngal]
+
+    with open(fname, "rb") as fp:
+        if fields is None:
+            fp.seek(byte_offset)
+            nbytes = fp.readinto(dest.view(np.uint8))
+            if nbytes != ngal * file_dtype.itemsize:
+                msg = "Expected to read {0} bytes from file {1} but only read {2} "\
+                      "bytes".format(ngal * file_dtype.itemsize, fname, nbytes)
+                raise IOError(msg)
+        else:
+            file_gals = np.memmap(fp, dtype=file_dtype, mode="r", offset=byte_offset,
+                                  shape=(ngal,))
+            for field in fields:
+                dest[field] = file_gals[field]
+
+
+def _read_file_into_shared_gals(dtype, *args):
+    gals = np.frombuffer(_shared_gals_buffer, dtype=dtype)
+    _read_file_into_gals(gals, *args)
+
+
+class ConcatenatedGalaxies(object):
+    """
+    A read-only view of galaxies that are spread across multiple (memory-mapped) files.
+
+    Each file is kept as its own ``np.memmap`` so no galaxies are copied when this object is
+    created.  Accessing a single field (e.g., ``gals["StellarMass"]``) only pages in the bytes of
+    that field and returns a contiguous array.  Slices that lie within a single file are returned
+    as zero-copy views.
+    """
+
+    def __init__(self, file_views, dtype):
+
+        self.file_views = file_views
+        self.dtype = dtype
+
+        ngals_per_file = np.array([len(view) for view in file_views], dtype=np.int64)
+
+        # Offset of the first galaxy of each file within the concatenated array.  The final
+        # entry is the total number of galaxies.
+        self.file_offsets = np.zeros(len(file_views) + 1, dtype=np.int64)
+        self.file_offsets[1:] = ngals_per_file.cumsum()
+
+
+    def __len__(self):
+        return int(self.file_offsets[-1])
+
+
+    def __getitem__(self, key):
+
+        # Field access.  This needs to be stitched together across all the files.
+        if isinstance(key, str):
+            if len(self.file_views) == 1:
+                return self.file_views[0][key]
+            return np.concatenate([view[key] for view in self.file_views])
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[start:stop][::step]
+
+            pieces = []
+            for file_idx, view in enumerate(self.file_views):
+                file_start = self.file_offsets[file_idx]
+                file_stop = self.file_offsets[file_idx + 1]
+
+                if stop <= file_start or start >= file_stop:
+                    continue
+
+                pieces.append(view[max(start - file_start, 0):min(stop, file_stop) - file_start])
+
+            if len(pieces) == 1:
+                return pieces[0]
+            if not pieces:
+                return np.empty(0, dtype=self.dtype)
+            return np.concatenate(pieces)
+
+        # Otherwise we're indexing a single galaxy.
+        idx = int(key)
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            msg = "Galaxy index {0} is out of bounds for {1} galaxies".format(key, len(self))
+            raise IndexError(msg)
+
+        file_idx = np.searchsorted(self.file_offsets, idx, side="right") - 1
+        return self.file_views[file_idx][idx - self.file_offsets[file_idx]]
+
 
 class BinarySage(object):
 
 
-    def __init__(self, filename, ignored_fields=None, num_files=1):
+    def __init__(self, filename, ignored_fields=None, num_files=1, memmap=False, fields=None,
+                 num_workers=1, use_processes=False):
         """
         Set up instance variables
+
+        If ``memmap`` is ``True``, the galaxies are memory-mapped rather than read into RAM.
+        The returned arrays are then read-only views of the files on disk.
+
+        ``fields`` projects the galaxies onto a subset of the galaxy fields.  Only these fields
+        are then read from disk, using a strided access over the galaxy structs.  If ``None``,
+        all fields are read.
+
+        ``num_workers`` sets the number of files that :py:meth:`~read_gals` reads concurrently.
+        Threads are used unless ``use_processes`` is ``True``, in which case the galaxies are
+        read by a process pool into shared memory.
         """
         # The input galaxy structure:
         Galdesc_full = [
@@ -75,15 +279,37 @@ class BinarySage(object):
 
         self.filename = filename
         self.num_files = num_files
+        self.memmap = memmap
+        self.num_workers = num_workers
+        self.use_processes = use_processes
         self.dtype = _galdesc
         self.totntrees = None
         self.totngals = None
         self.ngal_per_tree = None
         self.bytes_offset_per_tree = None
+        self.header_size = None
+        self.tree_index = None
         if not ignored_fields:
             ignored_fields = []
         self.ignored_fields = ignored_fields
 
+        if fields is None:
+            fields = list(_names)
+        for field in fields:
+            if field not in _names:
+                msg = "Field '{0}' is not a valid galaxy field. The valid fields are "\
+                      "{1}".format(field, _names)
+                raise ValueError(msg)
+        self.fields = list(fields)
+
+        # When a projection is requested, galaxies read into RAM are stored compactly using only
+        # the requested fields.
+        self.is_projected = self.fields != _names
+        if self.is_projected:
+            self.projected_dtype = np.dtype([(field, _galdesc[field]) for field in self.fields])
+        else:
+            self.projected_dtype = _galdesc
+
 
     def __enter__(self):
         return self
@@ -108,155 +334,962 @@ class BinarySage(object):
         self.totngals = totngals
         self.ngal_per_tree = ngal_per_tree
 
-        # First calculate the bytes size of each tree
-        bytes_offset_per_tree = ngal_per_tree * self.dtype.itemsize
+        # First calculate the bytes size of each tree.  Use 64-bit integers because large files
+        # can exceed 2GB.
+        bytes_per_tree = ngal_per_tree.astype(np.int64) * self.dtype.itemsize
+
+        # The offset to the N'th tree is the sum of the sizes of trees 0 to N-1 (inclusive).
+        # Hence the 0'th tree has an offset of 0.
+        bytes_offset_per_tree = np.zeros(totntrees, dtype=np.int64)
+        bytes_offset_per_tree[1:] = bytes_per_tree.cumsum()[:-1]
+
+        # Now add the initial offset that we need to get to the
+        # 0'th tree -- i.e., the size of the headers
+        header_size = 4 + 4 + totntrees*4
+        bytes_offset_per_tree += header_size
+
+        # Now assign to the instance variable
+        self.header_size = header_size
+        self.bytes_offset_per_tree = bytes_offset_per_tree
+
+
+    def determine_file_name(self, file_idx):
+        """
+        Determines the name of file number ``file_idx``.  ``self.filename`` is assumed to be
+        the name of the 0th file (i.e., it ends in ``_0``).
+        """
+
+        # Catalogs that are not split over multiple files may not have a file number at all.
+        if self.num_files == 1:
+            return self.filename
+
+        # Cut off the number at the end of the file.
+        fname_base = self.filename[:-2]
+
+        # Then append this file number.
+        return "{0}_{1}".format(fname_base, file_idx)
+
+
+    def memmap_gals(self, fp):
+        """
+        Memory-maps all the galaxies in the file ``fp``.  The header of this file must have
+        already been read (see :py:meth:`~read_header`).
+        """
+
+        if self.totngals == 0:
+            return np.empty(0, dtype=self.dtype)
+
+        return np.memmap(fp, dtype=self.dtype, mode="r", offset=self.header_size,
+                         shape=(self.totngals,))
+
+
+    def read_gals_at_offset(self, fp, byte_offset, ngal):
+        """
+        Reads ``ngal`` galaxies starting ``byte_offset`` bytes into the file ``fp``.
+
+        The galaxies are memory-mapped and/or projected onto the requested fields as
+        specified at initialization.
+        """
+
+        # Projected reads go through a memory-map so that we only touch the requested fields.
+        if self.memmap or self.is_projected:
+            gals = np.memmap(fp, dtype=self.dtype, mode="r", offset=byte_offset, shape=(ngal,))
+            return self.project_fields(gals)
+
+        fp.seek(byte_offset)
+        return np.fromfile(fp, dtype=self.dtype, count=ngal)
+
+
+    def project_fields(self, gals):
+        """
+        Projects ``gals`` onto the fields requested at initialization.
+
+        For memory-mapped galaxies, this returns a zero-copy view.  Otherwise, each field is
+        copied into a compact array with a strided read so that only the requested fields are
+        touched.
+        """
+
+        if not self.is_projected:
+            return gals
+
+        if self.memmap:
+            return gals[self.fields]
+
+        projected_gals = np.empty(len(gals), dtype=self.projected_dtype)
+        for field in self.fields:
+            projected_gals[field] = gals[field]
+
+        return projected_gals
+
+
+    def read_tree(self, treenum, fp=None):
+        """
+        Read a single tree specified by the tree number.
+
+        If ``fp`` is ``None``, ``treenum`` is the global tree number across all ``num_files``
+        files and is located using the tree index (see :py:meth:`~update_metadata`).  Otherwise,
+        ``treenum`` is the tree number within ``fp`` and the header of ``fp`` must have already
+        been read.
+
+        If ``trenum`` is ``None``, all trees are read from ``fp`` (or from ``self.filename`` if
+        ``fp`` is ``None``, in which case its header is always read first; the header state may
+        hold another file's header after :py:meth:`~update_metadata`).
+        """
+
+        if fp is None and treenum is not None:
+            if self.tree_index is None:
+                self.update_metadata()
+
+            if treenum < 0 or treenum >= len(self.tree_index):
+                msg = "The requested tree index = {0} should be within [0, {1})"\
+                    .format(treenum, len(self.tree_index))
+                raise ValueError(msg)
+
+            if self.tree_index["ngals"][treenum] == 0:
+                return None
+
+            return self.read_trees([treenum])
+
+        close_file = False
+        if fp is None:
+            fp = open(self.filename, "rb")
+            close_file = True
+
+        if close_file or self.totntrees is None:
+            self.read_header(fp)
+
+        if treenum is not None:
+            if treenum < 0 or treenum >= self.totntrees:
+                msg = "The requested tree index = {0} should be within [0, {1})"\
+                    .format(treenum, self.totntrees)
+                raise ValueError(msg)
+
+        if treenum is not None:
+            ngal = self.ngal_per_tree[treenum]
+            byte_offset = self.bytes_offset_per_tree[treenum]
+        else:
+            ngal = self.totngals
+            byte_offset = self.header_size
+
+        if ngal == 0:
+            return None
+
+        # Seek directly to the tree; we don't rely on the position of ``fp``.
+        tree = self.read_gals_at_offset(fp, byte_offset, ngal)
+
+        # If we had to open up the file, close it.
+        if close_file:
+            fp.close()
+
+        return tree
+
+
+    def update_metadata(self):
+        """
+        The binary galaxies can be split up over multiple files.  In this method, we
+        iterate over the files and collect info that is spread across them.
+
+        This also builds the tree index, ``self.tree_index``, which maps each global tree
+        number to the file it is in, the byte offset of its first galaxy and its number of
+        galaxies.  The header of each file is only read here; :py:meth:`~read_gals` reuses
+        this information.
+        """
+
+        self.totntrees_all_files = 0
+        self.totngals_all_files = 0
+        self.ngal_per_tree_all_files = []
+        self.ngals_per_file = np.zeros(self.num_files, dtype=np.int64)
+        self.header_size_per_file = np.zeros(self.num_files, dtype=np.int64)
+
+        tree_index_per_file = []
+
+        for file_idx in range(self.num_files):
+
+            fname = self.determine_file_name(file_idx)
+
+            # Open and read the header.
+            with open(fname, "rb") as fp:
+
+                self.read_header(fp)
+
+                # Then update the global parameters.
+                self.totntrees_all_files += self.totntrees
+                self.totngals_all_files += self.totngals
+                self.ngal_per_tree_all_files.extend(self.ngal_per_tree)
+                self.ngals_per_file[file_idx] = self.totngals
+                self.header_size_per_file[file_idx] = self.header_size
+
+                tree_index_this_file = np.empty(self.totntrees, dtype=tree_index_dtype)
+                tree_index_this_file["file_idx"] = file_idx
+                tree_index_this_file["byte_offset"] = self.bytes_offset_per_tree
+                tree_index_this_file["ngals"] = self.ngal_per_tree
+                tree_index_per_file.append(tree_index_this_file)
+
+        self.tree_index = np.concatenate(tree_index_per_file)
+
+
+    def iter_gals(self, chunk_size):
+        """
+        Iterates over the galaxies of all the files in chunks of at most ``chunk_size``
+        galaxies.  Chunks do not span files.
+
+        Unless this instance was created with ``memmap=True`` (in which case views are
+        yielded), each chunk is copied into memory before being yielded.  Hence only a single
+        chunk needs to be held in memory at any time.
+        """
+
+        for _, chunk in self.iter_memmap_chunks(chunk_size):
+
+            if self.memmap or self.is_projected:
+                yield self.project_fields(chunk)
+            else:
+                yield np.array(chunk)
+
+
+    def iter_memmap_chunks(self, chunk_size):
+        """
+        Iterates over the memory-mapped galaxies of all the files in chunks of at most
+        ``chunk_size`` galaxies, yielding ``(offset, chunk)``.  ``offset`` is the index of the
+        first galaxy of the chunk across all files.  The chunks are neither copied nor
+        projected.
+        """
+
+        if self.tree_index is None:
+            self.update_metadata()
+
+        offset = 0
+        for file_idx in range(self.num_files):
+
+            ngal = int(self.ngals_per_file[file_idx])
+            if ngal == 0:
+                continue
+
+            file_gals = np.memmap(self.determine_file_name(file_idx), dtype=self.dtype, mode="r",
+                                  offset=int(self.header_size_per_file[file_idx]), shape=(ngal,))
+
+            for start in range(0, ngal, chunk_size):
+                yield offset + start, file_gals[start:start+chunk_size]
+
+            offset += ngal
+            del file_gals
+
+
+    def select(self, predicates=None, box=None, chunk_size=1000000, return_indices=False):
+        """
+        Selects the galaxies (across all files) that satisfy the ``predicates`` and lie inside
+        ``box`` (see :py:func:`~evaluate_selection`).
+
+        The selection is evaluated on memory-mapped chunks of ``chunk_size`` galaxies.  Only
+        the selected galaxies are copied into memory (projected onto the fields requested at
+        initialization).  If ``return_indices`` is ``True``, the indices of the selected
+        galaxies (as ordered by :py:meth:`~read_gals`) are returned instead.
+        """
+
+        determine_selection_fields(predicates, box)
+
+        selected = []
+        for offset, chunk in self.iter_memmap_chunks(chunk_size):
+
+            mask = evaluate_selection(chunk, len(chunk), predicates, box)
+
+            if return_indices:
+                selected.append(np.flatnonzero(mask) + offset)
+                continue
+
+            # Fancy indexing copies the selected galaxies out of the memory-map.
+            selected_gals = chunk[mask]
+            if self.is_projected:
+                projected_gals = np.empty(len(selected_gals), dtype=self.projected_dtype)
+                for field in self.fields:
+                    projected_gals[field] = selected_gals[field]
+                selected_gals = projected_gals
+
+            selected.append(selected_gals)
+
+        if not selected:
+            if return_indices:
+                return np.empty(0, dtype=np.int64)
+            return np.empty(0, dtype=self.projected_dtype)
+
+        return np.concatenate(selected)
+
+
+    def read_trees(self, treenums):
+        """
+        Reads multiple trees specified by their global tree numbers (across all
+        ``num_files`` files).  The galaxies are returned in the order of ``treenums``.
+
+        Trees that are adjacent on disk (e.g., ``[4, 5, 6]``) are coalesced and read in a single
+        read.
+        """
+
+        if self.tree_index is None:
+            self.update_metadata()
+
+        treenums = np.atleast_1d(np.asarray(treenums, dtype=np.int64))
+        if np.any(treenums < 0) or np.any(treenums >= len(self.tree_index)):
+            msg = "The requested tree indices should be within [0, {0})"\
+                .format(len(self.tree_index))
+            raise ValueError(msg)
+
+        index = self.tree_index[treenums]
+
+        # A run of trees can be read in one go if each tree starts where the previous one ends
+        # within the same file.
+        tree_nbytes = index["ngals"].astype(np.int64) * self.dtype.itemsize
+        contiguous = (index["file_idx"][1:] == index["file_idx"][:-1]) & \
+                     (index["byte_offset"][1:] == index["byte_offset"][:-1] + tree_nbytes[:-1])
+        run_starts = np.concatenate(([0], np.flatnonzero(~contiguous) + 1))
+        run_ends = np.concatenate((run_starts[1:], [len(index)]))
+
+        file_handles = {}
+        trees = []
+
+        try:
+            for run_start, run_end in zip(run_starts, run_ends):
+
+                ngal = int(index["ngals"][run_start:run_end].sum())
+                if ngal == 0:
+                    continue
+
+                file_idx = int(index["file_idx"][run_start])
+                if file_idx not in file_handles:
+                    file_handles[file_idx] = open(self.determine_file_name(file_idx), "rb")
+
+                trees.append(self.read_gals_at_offset(file_handles[file_idx],
+                                                      int(index["byte_offset"][run_start]), ngal))
+        finally:
+            for fp in file_handles.values():
+                fp.close()
+
+        if len(trees) == 1:
+            return trees[0]
+        if not trees:
+            return self.project_fields(np.empty(0, dtype=self.dtype))
+
+        return np.concatenate(trees)
+
+
+    def memmap_file(self, file_idx):
+        """
+        Returns a read-only, memory-mapped view of all the galaxies in file number
+        ``file_idx``.  No galaxies are read until they are accessed.
+
+        The file is located using the per-file headers read by :py:meth:`~update_metadata`, so
+        the header state used by :py:meth:`~read_tree` is left untouched.
+        """
+
+        if self.tree_index is None:
+            self.update_metadata()
+
+        ngal = int(self.ngals_per_file[file_idx])
+        if ngal == 0:
+            return np.empty(0, dtype=self.dtype)
+
+        return np.memmap(self.determine_file_name(file_idx), dtype=self.dtype, mode="r",
+                         offset=int(self.header_size_per_file[file_idx]), shape=(ngal,))
+
+
+    def read_gals(self):
+        """
+        Reads the galaxies from all the files.
+
+        If this instance was created with ``memmap=True``, the galaxies are not copied into
+        memory.  Instead, a :py:class:`~ConcatenatedGalaxies` view of the memory-mapped files is
+        returned.
+
+        Otherwise, the output array is sized using the headers read by
+        :py:meth:`~update_metadata` and each file is read directly into its own slice.  With
+        ``num_workers > 1``, the files are read concurrently.
+        """
+
+        if self.tree_index is None:
+            self.update_metadata()
+
+        fnames = [self.determine_file_name(file_idx) for file_idx in range(self.num_files)]
+
+        if self.memmap:
+            file_views = []
+            for fname, ngal, header_size in zip(fnames, self.ngals_per_file,
+                                                self.header_size_per_file):
+                if ngal == 0:
+                    file_gals = np.empty(0, dtype=self.dtype)
+                else:
+                    file_gals = np.memmap(fname, dtype=self.dtype, mode="r", offset=header_size,
+                                          shape=(ngal,))
+                file_views.append(self.project_fields(file_gals))
+            return ConcatenatedGalaxies(file_views, file_views[0].dtype)
+
+        # The galaxies of each file are placed one after another.
+        dest_offsets = np.zeros(self.num_files, dtype=np.int64)
+        dest_offsets[1:] = self.ngals_per_file.cumsum()[:-1]
+
+        fields = self.fields if self.is_projected else None
+        work = [(fname, int(header_size), int(ngal), int(dest_offset), self.dtype, fields)
+                for (fname, header_size, ngal, dest_offset) in zip(fnames,
+                                                                   self.header_size_per_file,
+                                                                   self.ngals_per_file,
+                                                                   dest_offsets)]
+
+        num_workers = min(self.num_workers, self.num_files)
+
+        if num_workers > 1 and self.use_processes:
+            import mmap
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            # Anonymous shared memory is inherited by the forked workers and written to in place.
+            nbytes = int(self.totngals_all_files) * self.projected_dtype.itemsize
+            shared_buffer = mmap.mmap(-1, max(nbytes, 1))
+
+            with ProcessPoolExecutor(max_workers=num_workers,
+                                     mp_context=multiprocessing.get_context("fork"),
+                                     initializer=_init_shared_gals_buffer,
+                                     initargs=(shared_buffer,)) as executor:
+                futures = [executor.submit(_read_file_into_shared_gals, self.projected_dtype, *args)
+                           for args in work]
+                for future in futures:
+                    future.result()
+
+            return np.frombuffer(shared_buffer, dtype=self.projected_dtype,
+                                 count=int(self.totngals_all_files))
+
+        # Initialize an empty array.
+        gals = np.empty(self.totngals_all_files, dtype=self.projected_dtype)
+
+        if num_workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+
+            # Reading from disk releases the GIL so threads can fill their slices concurrently.
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(_read_file_into_gals, gals, *args) for args in work]
+                for future in futures:
+                    future.result()
+        else:
+            for args in work:
+                _read_file_into_gals(gals, *args)
+
+        return gals
+
+
+class Hdf5Sage(object):
+    """
+    Reads the galaxies from a HDF5 master file written by SAGE.  This is the counterpart to
+    :py:class:`~BinarySage`.
+
+    The master file links to the file written by each core (``Core_N``) through external
+    links.  The group of each core and snapshot, its datasets and their data types are
+    resolved once and cached so that repeated reads neither traverse the links nor reopen the
+    datasets again.  Fields are read directly into arrays of their native data type.
+
+    The snapshot keys, redshifts and number of galaxies are taken from the metadata index (see
+    :py:func:`~load_hdf5_metadata`), so the HDF5 files are only opened once a field is read.
+    """
+
+    def __init__(self, filename, ignored_fields=None, fields=None, multidim_fields=None):
+        """
+        Set up instance variables
+
+        ``fields`` restricts the fields that are read.  If ``None``, all fields are read.
+
+        ``multidim_fields`` are the fields that are saved as separate ``<Field>x``,
+        ``<Field>y`` and ``<Field>z`` datasets.  These are read into Nx3 arrays.
+        """
+        self.filename = filename
+        self._hdf5_file = None
+
+        # SAGE could have been run in parallel in which the HDF5 master file will have
+        # multiple core datasets.
+        self.metadata = load_hdf5_metadata(filename)
+        self.ncores = self.metadata["ncores"]
+
+        if multidim_fields is None:
+            multidim_fields = ["Pos", "Vel", "Spin"]
+        self.multidim_fields = multidim_fields
+
+        if not ignored_fields:
+            ignored_fields = []
+        self.ignored_fields = ignored_fields
+        self.fields = fields
+
+        self.core_groups = {}
+        self.snap_groups = {}
+        self.snap_datasets = {}
+        self.field_dtypes = {}
+        self.snap_fields = {}
+        self.tree_index = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    @property
+    def hdf5_file(self):
+        """
+        The HDF5 master file.  Only opened on first access.
+        """
+        import h5py
+
+        if self._hdf5_file is None:
+            self._hdf5_file = h5py.File(self.filename, "r")
+
+        return self._hdf5_file
+
+
+    def close(self):
+        if self._hdf5_file is not None:
+            self._hdf5_file.close()
+            self._hdf5_file = None
+
+        # The cached groups and datasets are invalid once the file is closed.
+        self.core_groups = {}
+        self.snap_groups = {}
+        self.snap_datasets = {}
+
+
+    def get_core_group(self, core_idx):
+        """
+        Returns the root group of the file of core ``core_idx``.  The external link is only
+        resolved on the first call.
+        """
+
+        if core_idx not in self.core_groups:
+            self.core_groups[core_idx] = self.hdf5_file["Core_{0}".format(core_idx)]
+
+        return self.core_groups[core_idx]
+
+
+    def get_core_groups(self):
+        """
+        Returns the root group of each core's file (see :py:meth:`~get_core_group`).
+        """
+
+        return [self.get_core_group(core_idx) for core_idx in range(self.ncores)]
+
+
+    def get_snap_groups(self, snap_key):
+        """
+        Returns the ``snap_key`` group of each core.
+        """
+
+        if snap_key not in self.snap_groups:
+            self.snap_groups[snap_key] = [core_group[snap_key]
+                                          for core_group in self.get_core_groups()]
+
+        return self.snap_groups[snap_key]
+
+
+    def get_snap_datasets(self, snap_key, core_idx):
+        """
+        Returns the datasets of the ``snap_key`` group of core ``core_idx``, keyed by their
+        name.  The datasets are only opened on the first call.  Only the external link to this
+        core is resolved.
+        """
+
+        if (snap_key, core_idx) not in self.snap_datasets:
+
+            if snap_key in self.snap_groups:
+                group = self.snap_groups[snap_key][core_idx]
+            else:
+                group = self.get_core_group(core_idx)[snap_key]
+
+            self.snap_datasets[(snap_key, core_idx)] = dict((name, group[name])
+                                                            for name in group.keys())
+
+        return self.snap_datasets[(snap_key, core_idx)]
+
+
+    def determine_num_gals_per_core(self, snap_key):
+        """
+        Returns the number of galaxies each core saved at snapshot ``snap_key``.
+        """
+
+        return np.array(self.metadata["snapshots"][snap_key]["num_gals_per_core"],
+                        dtype=np.int64)
+
+
+    def determine_num_gals_at_snap(self, snap_key):
+        return int(self.determine_num_gals_per_core(snap_key).sum())
+
+
+    def determine_snap_from_redshift(self, redshift, verbose=False):
+        return determine_snap_from_metadata(self.metadata, redshift, verbose=verbose)
+
+
+    def determine_fields(self, snap_key):
+        """
+        Returns the fields available at snapshot ``snap_key`` (restricted to ``self.fields``, if
+        specified).  Multi-dimensional fields are returned under their base name (e.g., ``Pos``).
+        The fields are only listed once per snapshot.
+        """
+
+        if snap_key not in self.snap_fields:
+
+            fields = []
+            for name in self.get_snap_datasets(snap_key, 0):
+                if name[:-1] in self.multidim_fields:
+                    name = name[:-1]
+                if name in fields or name in self.ignored_fields:
+                    continue
+                if self.fields is not None and name not in self.fields:
+                    continue
+                fields.append(name)
+
+            self.snap_fields[snap_key] = fields
+
+        return list(self.snap_fields[snap_key])
+
+
+    def read_field(self, snap_key, key):
+        """
+        Reads the field ``key`` at snapshot ``snap_key`` from every core and stitches them into a
+        single array of the field's native data type.
+
+        Multi-dimensional fields are read directly into the columns of an Nx3 array.
+        """
+
+        num_gals_per_core = self.determine_num_gals_per_core(snap_key)
+
+        data = self.allocate_field(snap_key, key, num_gals_per_core.sum())
+
+        # Iterate through all the cores and read the data straight into its slice.
+        offset = 0
+        for core_idx, num_gals_this_file in enumerate(num_gals_per_core):
+
+            if num_gals_this_file == 0:
+                continue
+
+            self.read_field_slice(self.get_snap_datasets(snap_key, core_idx), key, 0,
+                                  num_gals_this_file, data, offset)
+            offset += num_gals_this_file
+
+        return data
+
+
+    def determine_dataset_names(self, key):
+
+        if key in self.multidim_fields:
+            # In the HDF5 file, the fields are named <BaseKey><x/y/z>.
+            return ["{0}{1}".format(key, dim_name) for dim_name in ["x", "y", "z"]]
+
+        return [key]
+
+
+    def allocate_field(self, snap_key, key, num_gals):
+        """
+        Returns an uninitialized array for ``num_gals`` galaxies of field ``key`` in the field's
+        native data type.  The data type is only looked up once per snapshot and field.
+        """
+
+        if (snap_key, key) not in self.field_dtypes:
+            dataset_name = self.determine_dataset_names(key)[0]
+            self.field_dtypes[(snap_key, key)] = \
+                self.get_snap_datasets(snap_key, 0)[dataset_name].dtype
+        dtype = self.field_dtypes[(snap_key, key)]
+
+        if key in self.multidim_fields:
+            return np.empty((num_gals, 3), dtype=dtype)
+
+        return np.empty(num_gals, dtype=dtype)
+
+
+    def read_field_slice(self, datasets, key, start, num_gals, data, dest_offset):
+        """
+        Reads galaxies ``[start, start + num_gals)`` of field ``key`` from ``datasets``, the
+        datasets of a snapshot group of one core (see :py:meth:`~get_snap_datasets`), into
+        ``data[dest_offset:dest_offset + num_gals]``.
+        """
+
+        source_sel = np.s_[start:start+num_gals]
+
+        for dim_num, name in enumerate(self.determine_dataset_names(key)):
+            if key in self.multidim_fields:
+                dest_sel = np.s_[dest_offset:dest_offset+num_gals, dim_num]
+            else:
+                dest_sel = np.s_[dest_offset:dest_offset+num_gals]
+
+            if num_gals <= hdf5_sliced_read_max_gals:
+                data[dest_sel] = datasets[name][source_sel]
+            else:
+                datasets[name].read_direct(data, source_sel, dest_sel)
+
+
+    def determine_snap_key(self, snap):
+        """
+        Returns the group name of ``snap``, which may either be a snapshot number or a key.
+        """
+
+        if isinstance(snap, str):
+            return snap
+
+        return "Snap_{0}".format(snap)
+
+
+    def get_tree_index(self, snap):
+        """
+        Returns the tree index (see ``hdf5_tree_index_dtype``) at snapshot ``snap``.
+
+        The index is built from the ``TreeInfo/Snap_N/NumGalsPerTreePerSnap`` dataset of each
+        core.  Trees are numbered globally, i.e., the trees of ``Core_1`` follow those of
+        ``Core_0``.
+        """
+
+        snap_key = self.determine_snap_key(snap)
+
+        if snap_key not in self.tree_index:
+
+            tree_indices = []
+            for core_idx, core_group in enumerate(self.get_core_groups()):
+                ngals_per_tree = core_group["TreeInfo"][snap_key]["NumGalsPerTreePerSnap"][:]
+
+                num_gals = self.metadata["snapshots"][snap_key]["num_gals_per_core"][core_idx]
+                if ngals_per_tree.sum() != num_gals:
+                    msg = "The number of galaxies per tree of core {0} at snapshot '{1}' sums "\
+                          "to {2} but the core has {3} galaxies.".format(core_idx, snap_key,
+                                                                         ngals_per_tree.sum(),
+                                                                         num_gals)
+                    raise ValueError(msg)
+
+                tree_index = np.empty(len(ngals_per_tree), dtype=hdf5_tree_index_dtype)
+                tree_index["core_idx"] = core_idx
+                tree_index["ngals"] = ngals_per_tree
+                tree_index["gal_offset"][0:1] = 0
+                np.cumsum(ngals_per_tree[:-1], out=tree_index["gal_offset"][1:])
+
+                tree_indices.append(tree_index)
+
+            self.tree_index[snap_key] = np.concatenate(tree_indices)
+
+        return self.tree_index[snap_key]
+
+
+    def read_tree(self, treenum, snap):
+        """
+        Reads the galaxies of the global tree number ``treenum`` at snapshot ``snap``.  Only
+        the galaxies of the tree are read from the file, using the datasets, data types and
+        fields cached by the first read (see :py:meth:`~get_snap_datasets`).
+
+        Returns a dictionary keyed by the field name or ``None`` if the tree has no galaxies at
+        this snapshot.
+        """
+
+        snap_key = self.determine_snap_key(snap)
+        tree_index = self.get_tree_index(snap_key)
 
-        # then compute the cumulative sum across the sizes to
-        # get an offset to any tree
-        # However, tmp here will show the offset to the 0'th
-        # tree as the size of the 0'th tree. What we want is the
-        # offset to the 1st tree as the size of the 0'th tree
-        tmp = bytes_offset_per_tree.cumsum()
+        if treenum < 0 or treenum >= len(tree_index):
+            msg = "The requested tree index = {0} should be within [0, {1})"\
+                .format(treenum, len(tree_index))
+            raise ValueError(msg)
 
-        # Now assign the cumulative sum of sizes for 0:last-1 (inclusive)
-        # as the offsets to 1:last
-        bytes_offset_per_tree[1:-1] = tmp[0:-2]
+        core_idx, gal_offset, ngals = tree_index[treenum]
+        if ngals == 0:
+            return None
 
-        # And set the offset of the 0'th tree as 0
-        bytes_offset_per_tree[0] = 0
+        datasets = self.get_snap_datasets(snap_key, int(core_idx))
 
-        # Now add the initial offset that we need to get to the
-        # 0'th tree -- i.e., the size of the headers
-        header_size  = 4 + 4 + totntrees*4
-        bytes_offset_per_tree[:] += header_size
+        gals = {}
+        for key in self.determine_fields(snap_key):
+            gals[key] = self.allocate_field(snap_key, key, ngals)
+            self.read_field_slice(datasets, key, gal_offset, ngals, gals[key], 0)
 
-        # Now assign to the instance variable
-        self.bytes_offset_per_tree = bytes_offset_per_tree
+        return gals
 
 
-    def read_tree(self, treenum, fp=None):
+    def iter_trees(self, snap=None, chunk_size=1000000):
         """
-        Read a single tree specified by the tree number.
+        Iterates over the trees at snapshot ``snap`` (or at every snapshot if ``snap`` is
+        ``None``) yielding ``(snap_key, treenum, gals)`` where ``gals`` is a dictionary keyed
+        by the field name.  Trees without any galaxies at the snapshot are skipped.
 
-        If ``trenum`` is ``None``, all trees are read.
+        Adjacent trees are read together in a single hyperslab of at most ``chunk_size``
+        galaxies (or a single tree if that is larger) and ``gals`` are views into it.
         """
 
-        close_file = False
-        if fp is None:
-            fp = open(self.filename, "rb")
-            close_file = True
+        if snap is None:
+            snap_keys = self.metadata["snap_keys"]
+        else:
+            snap_keys = [self.determine_snap_key(snap)]
 
-        if self.totntrees is None:
-            self.read_header(fp)
+        for snap_key in snap_keys:
 
-        if treenum is not None:
-            if treenum < 0 or treenum >= self.totntrees:
-                msg = "The requested tree index = {0} should be within [0, {2})"\
-                    .format(treenum, self.totntrees)
-                raise ValueError(msg)
+            tree_index = self.get_tree_index(snap_key)
+            fields = self.determine_fields(snap_key)
 
-        if treenum is not None:
-            ngal = self.ngal_per_tree[treenum]
-        else:
-            ngal = self.totngals
+            treenum = 0
+            while treenum < len(tree_index):
 
-        if ngal == 0:
-            return None
+                # Gather the trees on this core that fit within a single chunk.
+                core_idx = tree_index["core_idx"][treenum]
+                start_tree = treenum
+                num_gals = 0
+                while treenum < len(tree_index) and \
+                      tree_index["core_idx"][treenum] == core_idx and \
+                      (treenum == start_tree or
+                       num_gals + tree_index["ngals"][treenum] <= chunk_size):
+                    num_gals += tree_index["ngals"][treenum]
+                    treenum += 1
 
-        # This assumes sequential reads
-        tree = np.fromfile(fp, dtype=self.dtype, count=ngal)
+                if num_gals == 0:
+                    continue
 
-        # If we had to open up the file, close it.
-        if close_file:
-            fp.close()
+                gal_offset = tree_index["gal_offset"][start_tree]
+                chunk = {}
+                for key in fields:
+                    chunk[key] = self.allocate_field(snap_key, key, num_gals)
+                    self.read_field_slice(self.get_snap_datasets(snap_key, int(core_idx)), key,
+                                          gal_offset, num_gals, chunk[key], 0)
 
-        return tree
+                offset = 0
+                for chunk_treenum in range(start_tree, treenum):
+                    ngals = tree_index["ngals"][chunk_treenum]
+                    if ngals == 0:
+                        continue
 
+                    yield snap_key, chunk_treenum, \
+                        dict((key, chunk[key][offset:offset+ngals]) for key in fields)
+                    offset += ngals
 
-    def update_metadata(self):
+
+    def read_gals(self, snap_key):
         """
-        The binary galaxies can be split up over multiple files.  In this method, we
-        iterate over the files and collect info that is spread across them.
+        Reads all the fields (see :py:meth:`~determine_fields`) at snapshot ``snap_key``.
+        Returns a dictionary keyed by the field name.
         """
 
-        self.totntrees_all_files = 0
-        self.totngals_all_files = 0
-        self.ngal_per_tree_all_files = []
-
-        for file_idx in range(self.num_files):
+        return dict((key, self.read_field(snap_key, key))
+                    for key in self.determine_fields(snap_key))
 
-            # Cut off the number at the end of the file.
-            fname_base = self.filename[:-2]
 
-            # Then append this file number.
-            fname = "{0}_{1}".format(fname_base, file_idx)
+    def select(self, snap, predicates=None, box=None, chunk_size=1000000,
+               return_indices=False):
+        """
+        Selects the galaxies at snapshot ``snap`` that satisfy the ``predicates`` and lie
+        inside ``box`` (see :py:func:`~evaluate_selection`).
+
+        Each core is processed in chunks of ``chunk_size`` galaxies.  Only the fields needed
+        by the selection are read for every chunk; the remaining fields (see
+        :py:meth:`~determine_fields`) are only read for chunks that contain selected galaxies.
+        Returns a dictionary keyed by the field name, or the indices of the selected galaxies
+        (as ordered by :py:meth:`~read_field`) if ``return_indices`` is ``True``.
+        """
 
-            # Open and read the header.
-            with open(fname, "rb") as fp:
+        snap_key = self.determine_snap_key(snap)
+        selection_fields = determine_selection_fields(predicates, box)
+        fields = self.determine_fields(snap_key)
 
-                self.read_header(fp)
+        selected = []
+        selected_gals = dict((key, []) for key in fields)
 
-                # Then update the global parameters.
-                self.totntrees_all_files += self.totntrees
-                self.totngals_all_files += self.totngals
-                self.ngal_per_tree_all_files.extend(self.ngal_per_tree)
+        offset = 0
+        for core_idx, num_gals_this_file in enumerate(self.determine_num_gals_per_core(snap_key)):
 
+            datasets = self.get_snap_datasets(snap_key, core_idx)
+            for start in range(0, num_gals_this_file, chunk_size):
 
-    def read_gals(self):
+                num_gals_chunk = min(chunk_size, num_gals_this_file - start)
 
-        # Initialize an empty array.
-        gals = np.empty(self.totngals_all_files, dtype=self.dtype)
+                chunk = {}
+                for key in selection_fields:
+                    chunk[key] = self.allocate_field(snap_key, key, num_gals_chunk)
+                    self.read_field_slice(datasets, key, start, num_gals_chunk, chunk[key], 0)
 
-        # Then slice all the galaxies in.
-        offset = 0
-        for file_idx in range(self.num_files):
+                mask = evaluate_selection(chunk, num_gals_chunk, predicates, box)
 
-            fname_base = self.filename[:-2]
-            fname = "{0}_{1}".format(fname_base, file_idx)
+                if return_indices:
+                    selected.append(np.flatnonzero(mask) + offset + start)
+                    continue
 
-            with open(fname, "rb") as fp:
+                if not mask.any():
+                    continue
 
-                self.read_header(fp)
-                gals_file = self.read_tree(None, fp)
+                for key in fields:
+                    if key not in chunk:
+                        chunk[key] = self.allocate_field(snap_key, key, num_gals_chunk)
+                        self.read_field_slice(datasets, key, start, num_gals_chunk,
+                                              chunk[key], 0)
+                    selected_gals[key].append(chunk[key][mask])
 
-                gals_this_file = len(gals_file)
+            offset += num_gals_this_file
 
-                gals[offset:offset+gals_this_file] = gals_file
-                offset += gals_this_file
+        if return_indices:
+            if not selected:
+                return np.empty(0, dtype=np.int64)
+            return np.concatenate(selected)
 
-        return gals
+        return dict((key, np.concatenate(selected_gals[key]) if selected_gals[key]
+                     else self.allocate_field(snap_key, key, 0))
+                    for key in fields)
 
 
 def compare_catalogs(fname1, num_files_file1, fname2, num_files_file2, mode, ignored_fields, multidim_fields=None,
-                     rtol=1e-9, atol=5e-5):
+                     rtol=1e-9, atol=5e-5, memmap=False, fields=None, num_workers=1, chunk_size=None,
+                     mismatch_dir=None, use_processes=False):
     """
     Compares two SAGE catalogs exactly
+
+    If ``fields`` is specified, only these fields are read and compared.  ``num_workers``
+    files of each binary catalog are read concurrently, by a process pool if
+    ``use_processes`` is ``True`` and by threads otherwise (see :py:class:`~BinarySage`).
+
+    If ``chunk_size`` is specified, binary catalogs are compared in chunks of this many
+    galaxies (see :py:func:`~compare_binary_catalogs_streaming`).  This is only supported in
+    ``binary-binary`` mode.
+
+    If ``mismatch_dir`` is specified, the mismatched values of each failed field are saved to
+    ``.npz`` files in this directory.
     """
-    import h5py
+    if chunk_size and mode != "binary-binary":
+        msg = "Comparing in chunks of 'chunk_size' galaxies is only supported in "\
+              "'binary-binary' mode, not '{0}'.".format(mode)
+        raise ValueError(msg)
 
     # For both modes, the first file will be binary.  So lets initialize it.
-    g1 = BinarySage(fname1, ignored_fields, num_files_file1)
+    g1 = BinarySage(fname1, ignored_fields, num_files_file1, memmap=memmap, fields=fields,
+                    num_workers=num_workers, use_processes=use_processes)
 
     # The second file will be either binary or HDF5.
     if mode == "binary-binary":
-        g2 = BinarySage(fname2, ignored_fields, num_files_file2)
-        compare_binary_catalogs(g1, g2, rtol, atol)
+        g2 = BinarySage(fname2, ignored_fields, num_files_file2, memmap=memmap, fields=fields,
+                        num_workers=num_workers, use_processes=use_processes)
+        if chunk_size:
+            compare_binary_catalogs_streaming(g1, g2, rtol, atol, chunk_size,
+                                              mismatch_dir=mismatch_dir)
+        else:
+            compare_binary_catalogs(g1, g2, rtol, atol, mismatch_dir=mismatch_dir)
     else:
-        with h5py.File(fname2, "r") as hdf5_file:
-            compare_binary_hdf5_catalogs(g1, hdf5_file, multidim_fields,
-                                         rtol, atol)
+        with Hdf5Sage(fname2, ignored_fields, fields=fields,
+                      multidim_fields=multidim_fields) as g2:
+            compare_binary_hdf5_catalogs(g1, g2, rtol, atol, mismatch_dir=mismatch_dir)
+
+
+def determine_mismatch_fname(mismatch_dir, fname, field_name):
+    """
+    Determines the name of the ``.npz`` file the mismatched values of ``field_name`` are saved
+    to when comparing the catalog ``fname``.  Returns ``None`` if ``mismatch_dir`` is ``None``.
+    """
+
+    if mismatch_dir is None:
+        return None
+
+    return os.path.join(mismatch_dir, "{0}_{1}_mismatches.npz".format(os.path.basename(fname),
+                                                                     field_name))
 
 
 def determine_binary_redshift(fname):
 
     # We assume the file name for the binary file is of the form
-    # /base/path/<ModelPrefix>_zW.XYZ.
+    # /base/path/<ModelPrefix>_zW.XYZ, optionally followed by a file number (e.g., _0).
 
     # First pull out the model name fully.
     model_name = fname.split("/")[-1]
 
-    # Then get the redshift in string form.
-    redshift_string = model_name.split("z")[-1]
+    # Then get the redshift in string form, cutting off any file number.
+    redshift_string = model_name.split("z")[-1].split("_")[0]
 
     # Cast and return.
     redshift = float(redshift_string)
@@ -264,27 +1297,30 @@ def determine_binary_redshift(fname):
     return redshift
 
 
-def compare_binary_hdf5_catalogs(g1, hdf5_file, multidim_fields, rtol=1e-9,
-                                 atol=5e-5, verbose=False):
+def compare_binary_hdf5_catalogs(g1, g2, rtol=1e-9, atol=5e-5, verbose=False,
+                                 mismatch_dir=None):
+
+    if not (isinstance(g1, BinarySage) and
+            isinstance(g2, Hdf5Sage)):
+        msg = "The inputs must be objects of the class 'BinarySage' and 'Hdf5Sage'. "\
+            "type(Object1) = {0} type(Object2) = {1}\n"\
+            .format(type(g1), type(g2))
+        raise ValueError(msg)
 
     # We need to first determine the snapshot that corresponds to the redshift we're
     # checking.  This is because the HDF5 file will contain multiple snapshots of data
     # whereas we only passed a single redshift binary file.
     binary_redshift = determine_binary_redshift(g1.filename)
-    _, snap_key = determine_snap_from_binary_z(hdf5_file,
-                                               binary_redshift,
-                                               verbose=verbose)
-
-    # SAGE could have been run in parallel in which the HDF5 master file will have
-    # multiple core datasets.
-    ncores = hdf5_file["Header"]["Misc"].attrs["num_cores"]
+    _, snap_key = g2.determine_snap_from_redshift(binary_redshift, verbose=verbose)
 
-    # Load all the galaxies from all trees in the binary file.
-    binary_gals = g1.read_tree(None)
+    # Load all the galaxies from all trees in the binary file(s).  Only the projected fields are
+    # read.
+    g1.update_metadata()
+    binary_gals = g1.read_gals()
 
     # Check that number of galaxies is equal.
-    ngals_binary = g1.totngals
-    ngals_hdf5 = determine_num_gals_at_snap(hdf5_file, ncores, snap_key)
+    ngals_binary = g1.totngals_all_files
+    ngals_hdf5 = g2.determine_num_gals_at_snap(snap_key)
 
     if ngals_binary != ngals_hdf5:
         print("The binary file had {0} galaxies whereas the HDF5 file had {1} galaxies. "
@@ -293,44 +1329,20 @@ def compare_binary_hdf5_catalogs(g1, hdf5_file, multidim_fields, rtol=1e-9,
               ngals_hdf5, binary_redshift, snap_key))
         raise ValueError
 
+    # Used to identify mismatched galaxies (if it was read).
+    galaxy_index = binary_gals["GalaxyIndex"] if "GalaxyIndex" in g1.fields else None
+
     # We will key via the binary file because the HDF5 file has some multidimensional
     # fields split across mutliple datasets.
-    dim_names = ["x", "y", "z"]
     failed_fields = []
 
-    for key in g1.dtype.names:
+    # Only the datasets for the projected fields are read from the HDF5 file.
+    for key in g1.fields:
 
         if key in g1.ignored_fields:
             continue
 
-        offset = 0
-
-        # Create an array to hold all the HDF5 data.  This may need to be an Nx3 array...
-        if key in multidim_fields:
-            hdf5_data = np.zeros((ngals_hdf5, 3))
-        else:
-            hdf5_data = np.zeros((ngals_hdf5))
-
-        # Iterate through all the core groups and slice the data into the array.
-        for core_idx in range(ncores):
-
-            core_name = "Core_{0}".format(core_idx)
-            num_gals_this_file = hdf5_file[core_name][snap_key].attrs["num_gals"]
-
-            if key in multidim_fields:
-                # In the HDF5 file, the fields are named <BaseKey><x/y/z>.
-                for dim_num, dim_name in enumerate(dim_names):
-                    hdf5_name = "{0}{1}".format(key, dim_name)
-
-                    data_this_file = hdf5_file[core_name][snap_key][hdf5_name][:]
-                    hdf5_data[offset:offset+num_gals_this_file, dim_num] = data_this_file
-
-            else:
-                data_this_file = hdf5_file[core_name][snap_key][key][:]
-
-                hdf5_data[offset:offset+num_gals_this_file] = data_this_file
-
-            offset += num_gals_this_file
+        hdf5_data = g2.read_field(snap_key, key)
 
         binary_data = binary_gals[key]
 
@@ -341,7 +1353,10 @@ def compare_binary_hdf5_catalogs(g1, hdf5_file, multidim_fields, rtol=1e-9,
                   "of {2}".format(key, binary_data.shape, hdf5_data.shape))
             raise ValueError
 
-        return_value = compare_field_equality(binary_data, hdf5_data, key, rtol, atol)
+        return_value = compare_field_equality(binary_data, hdf5_data, key, rtol, atol,
+                                              galaxy_index=galaxy_index,
+                                              mismatch_fname=determine_mismatch_fname(
+                                                  mismatch_dir, g1.filename, key))
 
         if not return_value:
             failed_fields.append(key)
@@ -351,26 +1366,298 @@ def compare_binary_hdf5_catalogs(g1, hdf5_file, multidim_fields, rtol=1e-9,
         raise ValueError
 
 
-def determine_num_gals_at_snap(hdf5_file, ncores, snap_key):
+def find_binary_redshift_files(binary_prefix):
+    """
+    Finds the binary files of every redshift output for the model ``binary_prefix`` (e.g.,
+    ``/base/path/<ModelPrefix>``).
 
-    num_gals = 0
+    Files are named ``<ModelPrefix>_zW.XYZ``, or ``<ModelPrefix>_zW.XYZ_N`` if the catalog is
+    split over multiple files.  In the latter case, only the 0th file is returned for each
+    redshift.  The files are sorted by redshift.
+    """
+    import glob
 
-    for core_idx in range(ncores):
+    fnames = []
+    for fname in glob.glob("{0}_z*".format(binary_prefix)):
 
-        core_key = "Core_{0}".format(core_idx)
-        num_gals += hdf5_file[core_key][snap_key].attrs["num_gals"]
+        parts = fname[len(binary_prefix) + 2:].split("_")
 
-    return num_gals
+        if len(parts) > 2 or (len(parts) == 2 and parts[1] != "0"):
+            continue
+
+        try:
+            float(parts[0])
+        except ValueError:
+            continue
 
+        fnames.append(fname)
 
-def determine_snap_from_binary_z(hdf5_file, redshift, verbose=False):
+    return sorted(fnames, key=determine_binary_redshift)
+
+
+def determine_binary_snapshots(binary_prefix, num_files, skip_empty=False):
+    """
+    Finds the binary files of every redshift output of the model ``binary_prefix`` (split over
+    ``num_files`` files).
+
+    Returns a list of ``(snap_key, redshift, binary_fnames)`` sorted by redshift, where
+    ``binary_fnames`` is a list of ``(file_idx, fname)``.  The binary format does not store
+    the snapshot number in its header, so it is taken from the ``SnapNum`` of the first galaxy
+    at each redshift.
+
+    By default, a ``ValueError`` is raised if a file is missing, if a redshift does not
+    contain any galaxies or if no redshift outputs are found.  If ``skip_empty`` is set, only
+    the files that exist are included and redshifts without any galaxies (yet) are skipped, so
+    that partially written output directories can be analyzed.
+    """
+
+    snapshots = []
+
+    for fname in find_binary_redshift_files(binary_prefix):
+
+        g = BinarySage(fname, num_files=num_files)
+
+        binary_fnames = []
+        for file_idx in range(num_files):
+            binary_fname = g.determine_file_name(file_idx)
+            if os.path.exists(binary_fname):
+                binary_fnames.append((file_idx, binary_fname))
+            elif not skip_empty:
+                msg = "The binary file '{0}' does not exist.".format(binary_fname)
+                raise ValueError(msg)
+
+        snap_key = None
+        for _, binary_fname in binary_fnames:
+            gals = next(BinarySage(binary_fname, memmap=True, fields=["SnapNum"]).iter_gals(1),
+                        None)
+            if gals is not None:
+                snap_key = "Snap_{0}".format(gals["SnapNum"][0])
+                break
+
+        if snap_key is None:
+            if skip_empty:
+                continue
+            msg = "The binary files '{0}' do not contain any galaxies, hence the snapshot "\
+                  "number cannot be determined.".format(fname)
+            raise ValueError(msg)
+
+        snapshots.append((snap_key, determine_binary_redshift(fname), binary_fnames))
+
+    if not snapshots and not skip_empty:
+        msg = "Could not find any binary files matching '{0}_z*'".format(binary_prefix)
+        raise ValueError(msg)
+
+    return snapshots
+
+
+# Each worker process of :py:func:`~compare_binary_hdf5_all_snapshots` keeps its HDF5 reader
+# (and its resolved groups) open across comparisons.  The readers are opened by the pool
+# initializer and keyed on the master file, the stamps of its files and the multi-dimensional
+# fields, so that a rewritten file or different fields never reuse a stale reader.
+_worker_hdf5_readers = {}
+
+
+def determine_worker_hdf5_reader_key(hdf5_fname, metadata, multidim_fields):
+    """
+    Returns the key of the reader of ``hdf5_fname`` (with index ``metadata``) in
+    ``_worker_hdf5_readers``.
+    """
+    stamps = determine_hdf5_metadata_stamps(hdf5_fname, metadata)
+
+    return (hdf5_fname, tuple(tuple(stamp) for stamp in stamps), tuple(multidim_fields))
+
+
+def _init_worker_hdf5_reader(reader_key):
+    hdf5_fname, _, multidim_fields = reader_key
+    _worker_hdf5_readers[reader_key] = Hdf5Sage(hdf5_fname, multidim_fields=list(multidim_fields))
+
+
+def _compare_binary_hdf5_field_in_worker(reader_key, *args):
+    return _compare_binary_hdf5_field(_worker_hdf5_readers[reader_key], *args)
+
+
+def _compare_binary_hdf5_field(g2, binary_fname, num_binary_files, snap_key, key, rtol, atol,
+                               mismatch_dir=None):
+    """
+    Compares a single field of a binary catalog against snapshot ``snap_key`` of the HDF5
+    master file read by ``g2`` using :py:func:`~compare_field_equality`.
+
+    Returns whether the field passed, whether it was bitwise identical and the report printed
+    by :py:func:`~compare_field_equality` (captured so that the reports of concurrent workers
+    are not interleaved).
+    """
+    import contextlib
+    import io
+
+    # Only this field (and the ``GalaxyIndex`` used to identify mismatches) is paged in from
+    # the binary files.
+    binary_fields = [key] if key == "GalaxyIndex" else [key, "GalaxyIndex"]
+    g1 = BinarySage(binary_fname, num_files=num_binary_files, memmap=True, fields=binary_fields)
+    binary_gals = g1.read_gals()
+    binary_data = binary_gals[key]
+
+    hdf5_data = g2.read_field(snap_key, key)
+
+    if binary_data.shape != hdf5_data.shape:
+        report = "For field {0}, the binary shape {1} does not match the HDF5 shape {2}\n"\
+                 .format(key, binary_data.shape, hdf5_data.shape)
+        return False, False, report
+
+    if np.array_equal(binary_data, hdf5_data):
+        return True, True, ""
+
+    report = io.StringIO()
+    with contextlib.redirect_stderr(report):
+        passed = compare_field_equality(binary_data, hdf5_data, key, rtol, atol,
+                                        galaxy_index=binary_gals["GalaxyIndex"],
+                                        mismatch_fname=determine_mismatch_fname(
+                                            mismatch_dir, binary_fname, key))
+
+    return passed, False, report.getvalue()
+
+
+def compare_binary_hdf5_all_snapshots(binary_prefix, num_binary_files, hdf5_fname, ignored_fields,
+                                      multidim_fields, rtol=1e-9, atol=5e-5, fields=None,
+                                      num_workers=None, verbose=False, mismatch_dir=None):
+    """
+    Compares every redshift output of the binary model ``binary_prefix`` against the matching
+    snapshot of the HDF5 master file ``hdf5_fname`` in a single invocation.
+
+    The HDF5 snapshots are scanned once.  Each (snapshot, field) pair is then compared by a
+    pool of ``num_workers`` processes (defaults to the number of CPUs) using
+    :py:func:`~compare_field_equality`, whose reports are printed in order.  If
+    ``mismatch_dir`` is specified, the mismatched values of each failed field are saved to
+    ``.npz`` files in this directory.
+
+    The result of each binary file is printed on a line of the form ``Result: <binary_fname>
+    <snap_key> <status>``, where the status is ``identical`` (every field is bitwise
+    identical), ``passed`` or ``failed``, and returned as a dictionary keyed by the binary
+    file name.  Raises a ``ValueError`` if any comparison failed.
+    """
+    binary_fnames = find_binary_redshift_files(binary_prefix)
+    if not binary_fnames:
+        msg = "Could not find any binary files matching '{0}_z*'".format(binary_prefix)
+        raise ValueError(msg)
+
+    # Maps each comparison to the arguments passed to ``_compare_binary_hdf5_field`` after the
+    # HDF5 reader.
+    tasks = []
+    failures = []
+    snap_keys = {}
+
+    with Hdf5Sage(hdf5_fname, multidim_fields=multidim_fields) as g2:
+
+        for binary_fname in binary_fnames:
+
+            binary_redshift = determine_binary_redshift(binary_fname)
+            _, snap_key = g2.determine_snap_from_redshift(binary_redshift, verbose=verbose)
+            snap_keys[binary_fname] = snap_key
+
+            g = BinarySage(binary_fname, ignored_fields, num_binary_files, fields=fields)
+            g.update_metadata()
+
+            ngals_hdf5 = g2.determine_num_gals_at_snap(snap_key)
+            if g.totngals_all_files != ngals_hdf5:
+                failures.append((binary_fname, snap_key, "num_gals",
+                                 "binary has {0} galaxies whereas HDF5 has {1} "
+                                 "galaxies".format(g.totngals_all_files, ngals_hdf5)))
+                continue
+
+            for key in g.fields:
+                if key in g.ignored_fields:
+                    continue
+                tasks.append((binary_fname, num_binary_files, snap_key, key, rtol, atol,
+                              mismatch_dir))
+
+        reader_key = determine_worker_hdf5_reader_key(hdf5_fname, g2.metadata, multidim_fields)
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+
+    if num_workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker_hdf5_reader,
+                                 initargs=(reader_key,)) as executor:
+            futures = [executor.submit(_compare_binary_hdf5_field_in_worker, reader_key, *task)
+                       for task in tasks]
+            results = [future.result() for future in futures]
+    else:
+        with Hdf5Sage(hdf5_fname, multidim_fields=multidim_fields) as g2:
+            results = [_compare_binary_hdf5_field(g2, *task) for task in tasks]
+
+    # The binary files with a field that passed without being bitwise identical.
+    inexact_fnames = set()
+    for task, (passed, is_identical, report) in zip(tasks, results):
+        if report:
+            print(report, end="", file=sys.stderr)
+        if not passed:
+            failures.append((task[0], task[2], task[3], "mis-matched values"))
+        elif not is_identical:
+            inexact_fnames.add(task[0])
+
+    print("Compared {0} fields across {1} binary files against {2} using {3} "
+          "workers.".format(len(tasks), len(binary_fnames), hdf5_fname, num_workers))
+
+    failed_fnames = set(failure[0] for failure in failures)
+    statuses = {}
+    for binary_fname in binary_fnames:
+        if binary_fname in failed_fnames:
+            statuses[binary_fname] = "failed"
+        elif binary_fname in inexact_fnames:
+            statuses[binary_fname] = "passed"
+        else:
+            statuses[binary_fname] = "identical"
+        print("Result: {0} {1} {2}".format(binary_fname, snap_keys[binary_fname],
+                                           statuses[binary_fname]))
+
+    if failures:
+        print("#######################################", file=sys.stderr)
+        for (binary_fname, snap_key, key, result) in failures:
+            print("{0} ({1}): {2}: {3}".format(binary_fname, snap_key, key, result),
+                  file=sys.stderr)
+        print("#######################################\n", file=sys.stderr)
+
+        failed_snapshots = sorted(set(failure[1] for failure in failures))
+        print("The following snapshots failed: {0}".format(failed_snapshots))
+        raise ValueError
+
+    return statuses
+
+
+# Bump whenever the layout of the metadata index changes so that stale indices are rebuilt.
+hdf5_metadata_version = 1
+
+
+def determine_hdf5_metadata_fname(fname):
+    """
+    Returns the name of the sidecar metadata index of the HDF5 master file ``fname``.
+    """
+    return "{0}.metadata.json".format(fname)
+
+
+def build_hdf5_metadata(hdf5_file, fname):
+    """
+    Scans the HDF5 master file ``fname`` and returns the snapshot keys, redshifts and the number
+    of galaxies (and the offset) of each core at each snapshot.
+    """
+    import h5py
+
+    ncores = int(hdf5_file["Header"]["Misc"].attrs["num_cores"])
+
+    # The core files are linked from the master file.  Record their names (relative to the
+    # master file) so that the index can be validated without opening any HDF5 file.
+    core_fnames = []
+    for core_idx in range(ncores):
+        link = hdf5_file.get("Core_{0}".format(core_idx), getlink=True)
+        if isinstance(link, h5py.ExternalLink):
+            core_fnames.append(link.filename)
 
-    hdf5_snap_keys = []
-    hdf5_redshifts = []
+    snapshots = {}
+    snap_keys = []
 
     # We're handling the HDF5 master file. Hence let's look at the Core_0 group because
     # it's guaranteed to always be present.
-
     for key in hdf5_file["Core_0"].keys():
 
         # We need to be careful here. We have a "Header" group that we don't
@@ -378,12 +1665,99 @@ def determine_snap_from_binary_z(hdf5_file, redshift, verbose=False):
         if 'Snap' not in key:
             continue
 
-        hdf5_snap_keys.append(key)
-        hdf5_redshifts.append(hdf5_file["Core_0"][key].attrs["redshift"])
+        num_gals_per_core = [int(hdf5_file["Core_{0}".format(core_idx)][key].attrs["num_gals"])
+                             for core_idx in range(ncores)]
+        core_offsets = list(itertools.accumulate([0] + num_gals_per_core[:-1]))
+
+        snap_keys.append(key)
+        snapshots[key] = {"redshift": float(hdf5_file["Core_0"][key].attrs["redshift"]),
+                          "num_gals_per_core": num_gals_per_core,
+                          "core_offsets": core_offsets}
+
+    metadata = {"version": hdf5_metadata_version,
+                "ncores": ncores,
+                "core_fnames": core_fnames,
+                "snap_keys": snap_keys,
+                "snapshots": snapshots}
+
+    return metadata
+
+
+def determine_hdf5_metadata_stamps(fname, metadata):
+    dirname = os.path.dirname(fname)
+    fnames = [fname] + [os.path.join(dirname, core_fname)
+                        for core_fname in metadata["core_fnames"]]
+
+    return determine_file_stamps(fnames)
+
+
+def load_hdf5_metadata(fname, hdf5_file=None):
+    """
+    Returns the metadata (see :py:func:`~build_hdf5_metadata`) of the HDF5 master file
+    ``fname``.
+
+    The metadata is cached in a sidecar JSON file next to the master file.  The cache is
+    rebuilt if the modification time or size of the master file or of any core file has
+    changed.  If the sidecar cannot be written (e.g., a read-only directory), the metadata is
+    rebuilt on every call.
+
+    ``hdf5_file`` is an already opened master file that is used if the index must be rebuilt.
+    """
+
+    metadata_fname = determine_hdf5_metadata_fname(fname)
+
+    try:
+        with open(metadata_fname, "r") as f:
+            metadata = json.load(f)
+        if metadata.get("version") == hdf5_metadata_version and \
+           metadata["stamps"] == determine_hdf5_metadata_stamps(fname, metadata):
+            return metadata
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    if hdf5_file is None:
+        import h5py
+        with h5py.File(fname, "r") as f:
+            metadata = build_hdf5_metadata(f, fname)
+    else:
+        metadata = build_hdf5_metadata(hdf5_file, fname)
+
+    metadata["stamps"] = determine_hdf5_metadata_stamps(fname, metadata)
+
+    # Write to a temporary file first so that concurrent readers never see a partial index.
+    tmp_fname = "{0}.{1}.tmp".format(metadata_fname, os.getpid())
+    try:
+        with open(tmp_fname, "w") as f:
+            json.dump(metadata, f)
+        os.rename(tmp_fname, metadata_fname)
+    except (IOError, OSError):
+        pass
+
+    return metadata
+
+
+def determine_num_gals_at_snap(hdf5_file, ncores, snap_key):
+
+    metadata = load_hdf5_metadata(hdf5_file.filename, hdf5_file)
+
+    return sum(metadata["snapshots"][snap_key]["num_gals_per_core"][:ncores])
 
-    # Find the snapshot that is closest to the redshift.
-    z_array = np.array(hdf5_redshifts)
-    idx = (np.abs(z_array - redshift)).argmin()
+
+def determine_snap_from_binary_z(hdf5_file, redshift, verbose=False):
+
+    metadata = load_hdf5_metadata(hdf5_file.filename, hdf5_file)
+
+    return determine_snap_from_metadata(metadata, redshift, verbose=verbose)
+
+
+def determine_snap_from_metadata(metadata, redshift, verbose=False):
+
+    hdf5_snap_keys = metadata["snap_keys"]
+    hdf5_redshifts = [metadata["snapshots"][key]["redshift"] for key in hdf5_snap_keys]
+
+    # Find the snapshot that is closest to the redshift.  Only the metadata is needed here, so
+    # avoid importing numpy.
+    idx = min(range(len(hdf5_redshifts)), key=lambda i: abs(hdf5_redshifts[i] - redshift))
     snap_key = hdf5_snap_keys[idx]
     snap_num = snap_key_to_snap_num(snap_key)
 
@@ -463,7 +1837,11 @@ please check that this is correct.
     return int(snapnum)  # Cast as integer before returning.
 
 
-def compare_binary_catalogs(g1, g2, rtol=1e-9, atol=5e-5):
+def compare_binary_metadata(g1, g2):
+    """
+    Checks that two binary catalogs have the same number of trees, galaxies and galaxies per
+    tree.  Raises a ``ValueError`` if they do not.
+    """
 
     if not (isinstance(g1, BinarySage) and
             isinstance(g2, BinarySage)):
@@ -499,6 +1877,17 @@ def compare_binary_catalogs(g1, g2, rtol=1e-9, atol=5e-5):
                    "galaxies\n".format(n1, n2)
             raise ValueError(msg)
 
+
+def compare_binary_catalogs(g1, g2, rtol=1e-9, atol=5e-5, mismatch_dir=None):
+    """
+    Compares two binary catalogs field by field.
+
+    If ``mismatch_dir`` is specified, the mismatched values of each failed field are saved to
+    ``.npz`` files in this directory.
+    """
+
+    compare_binary_metadata(g1, g2)
+
     ignored_fields = [a for a in g1.ignored_fields if a in g2.ignored_fields]
     failed_fields = []
 
@@ -506,14 +1895,20 @@ def compare_binary_catalogs(g1, g2, rtol=1e-9, atol=5e-5):
     gals1 = g1.read_gals()
     gals2 = g2.read_gals()
 
-    for field in g1.dtype.names:
-        if field in ignored_fields:
+    # Used to identify mismatched galaxies (if it was read).
+    galaxy_index = gals1["GalaxyIndex"] if "GalaxyIndex" in g1.fields else None
+
+    for field in g1.fields:
+        if field in ignored_fields or field not in g2.fields:
             continue
 
         field1 = gals1[field]
         field2 = gals2[field]
 
-        return_value = compare_field_equality(field1, field2, field, rtol, atol)
+        return_value = compare_field_equality(field1, field2, field, rtol, atol,
+                                              galaxy_index=galaxy_index,
+                                              mismatch_fname=determine_mismatch_fname(
+                                                  mismatch_dir, g1.filename, field))
 
         if not return_value:
             failed_fields.append(field)
@@ -523,7 +1918,159 @@ def compare_binary_catalogs(g1, g2, rtol=1e-9, atol=5e-5):
         raise ValueError
 
 
-def compare_field_equality(field1, field2, field_name, rtol, atol):
+def compare_binary_catalogs_streaming(g1, g2, rtol=1e-9, atol=5e-5, chunk_size=1000000,
+                                      mismatch_dir=None):
+    """
+    Compares two binary catalogs without loading either of them fully into memory.
+
+    Both catalogs are walked in aligned chunks of at most ``chunk_size`` galaxies and the number
+    of mismatched galaxies is accumulated for each field.  Hence the memory required is
+    proportional to ``chunk_size`` rather than the size of the catalogs.
+
+    If ``mismatch_dir`` is specified, the mismatched values of each chunk are saved to a
+    ``.npz`` file in this directory, named after the field and the index of the first galaxy
+    of the chunk (see :py:func:`~save_mismatches`).
+
+    Returns a dictionary containing the number of mismatched galaxies and the index of the
+    first mismatched galaxy for each field that failed.  Raises a ``ValueError`` if any field
+    failed.
+    """
+
+    compare_binary_metadata(g1, g2)
+
+    ignored_fields = [a for a in g1.ignored_fields if a in g2.ignored_fields]
+    fields = [field for field in g1.fields if field not in ignored_fields and field in g2.fields]
+
+    num_mismatched = dict((field, 0) for field in fields)
+    first_mismatched = {}
+
+    # The two catalogs could be split over a different number of files, so the chunks of each
+    # catalog won't necessarily line up.  Hence we compare the overlap of the current chunks and
+    # carry over whatever remains.
+    chunks1 = g1.iter_gals(chunk_size)
+    chunks2 = g2.iter_gals(chunk_size)
+    chunk1 = chunk2 = None
+    offset = 0
+
+    while True:
+        if chunk1 is None or len(chunk1) == 0:
+            chunk1 = next(chunks1, None)
+        if chunk2 is None or len(chunk2) == 0:
+            chunk2 = next(chunks2, None)
+        if chunk1 is None or chunk2 is None:
+            break
+
+        ngals = min(len(chunk1), len(chunk2))
+
+        for field in fields:
+            field1 = chunk1[field][:ngals]
+            field2 = chunk2[field][:ngals]
+
+            if np.array_equal(field1, field2):
+                continue
+
+            # Multi-dimensional fields (e.g., ``Pos``) fail if any of their components fail.
+            bad_mask = determine_mismatched_galaxies(field1, field2, rtol, atol)
+
+            num_bad = np.count_nonzero(bad_mask)
+            if num_bad == 0:
+                continue
+
+            if field not in first_mismatched:
+                first_mismatched[field] = offset + int(np.argmax(bad_mask))
+            num_mismatched[field] += num_bad
+
+            if mismatch_dir is not None:
+                bad_idx = np.flatnonzero(bad_mask)
+                galaxy_index = None
+                if "GalaxyIndex" in chunk1.dtype.names:
+                    galaxy_index = chunk1["GalaxyIndex"][bad_idx]
+                save_mismatches(determine_mismatch_fname(mismatch_dir, g1.filename,
+                                                         "{0}_{1}".format(field, offset)),
+                                offset + bad_idx, galaxy_index, field1[bad_idx],
+                                field2[bad_idx])
+
+        chunk1 = chunk1[ngals:]
+        chunk2 = chunk2[ngals:]
+        offset += ngals
+
+    failed = dict((field, (num_mismatched[field], first_mismatched[field]))
+                  for field in first_mismatched)
+
+    if failed:
+        print("#######################################", file=sys.stderr)
+        print("# field       num_mismatched       first_mismatched_index", file=sys.stderr)
+        for field in fields:
+            if field in failed:
+                print("{0} {1} {2}".format(field, failed[field][0], failed[field][1]),
+                      file=sys.stderr)
+        print("------ Compared {0} galaxies ------".format(offset), file=sys.stderr)
+        print("#######################################\n", file=sys.stderr)
+
+        print("The following fields failed: {0}".format([f for f in fields if f in failed]))
+        raise ValueError
+
+    return failed
+
+
+def determine_mismatched_galaxies(field1, field2, rtol, atol):
+    """
+    Returns a boolean mask that is ``True`` for every galaxy whose value of ``field1`` is not
+    close to the corresponding value of ``field2``.  Multi-dimensional fields (e.g., ``Pos``)
+    are mismatched if any of their components are.
+    """
+
+    # `isclose` is True for all elements of `field1` that are close to the corresponding
+    # element in `field2`.
+    close_mask = np.isclose(field1, field2, rtol=rtol, atol=atol)
+
+    return ~close_mask.reshape(len(close_mask), -1).all(axis=1)
+
+
+def determine_mismatch_errors(bad_field1, bad_field2):
+    """
+    Returns the absolute and relative errors of the mismatched values ``bad_field1`` and
+    ``bad_field2``.  For multi-dimensional fields, the largest error across all the components
+    is taken.
+    """
+
+    abs_diff = np.abs(bad_field1.astype(np.float64) - bad_field2).reshape(len(bad_field1), -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_diff = abs_diff / np.abs(bad_field2.astype(np.float64)).reshape(len(bad_field1), -1)
+
+    return abs_diff.max(axis=1), rel_diff.max(axis=1)
+
+
+def save_mismatches(mismatch_fname, bad_idx, bad_galaxy_index, bad_field1, bad_field2):
+    """
+    Saves the mismatched values ``bad_field1`` and ``bad_field2`` of the galaxies ``bad_idx``
+    (identified by their ``GalaxyIndex``, ``bad_galaxy_index``, which may be ``None``), along
+    with their absolute and relative errors, to the ``.npz`` file ``mismatch_fname``.
+    """
+
+    bad_field1 = np.asarray(bad_field1)
+    bad_field2 = np.asarray(bad_field2)
+    if bad_galaxy_index is None:
+        bad_galaxy_index = np.full(len(bad_idx), -1, dtype=np.int64)
+
+    abs_err, rel_err = determine_mismatch_errors(bad_field1, bad_field2)
+    np.savez_compressed(mismatch_fname, index=bad_idx, galaxy_index=bad_galaxy_index,
+                        field1=bad_field1, field2=bad_field2, abs_err=abs_err, rel_err=rel_err)
+    print("# Saved all mis-matched values to {0}".format(mismatch_fname), file=sys.stderr)
+
+
+def compare_field_equality(field1, field2, field_name, rtol, atol, galaxy_index=None,
+                           num_worst=10, mismatch_fname=None):
+    """
+    Checks that ``field1`` and ``field2`` are equal to within the tolerances ``rtol`` and
+    ``atol``.
+
+    If they are not, summary statistics of the mismatched values (the number of mismatches,
+    maximum absolute and relative errors and error quantiles) and the ``num_worst`` worst
+    mismatches are printed.  ``galaxy_index`` (e.g., the ``GalaxyIndex`` field) is used to
+    identify the worst mismatches.  If ``mismatch_fname`` is specified, every mismatched value is
+    also saved to this ``.npz`` file.
+    """
 
     if np.array_equal(field1, field2):
         return True
@@ -533,27 +2080,45 @@ def compare_field_equality(field1, field2, field_name, rtol, atol):
     if np.allclose(field1, field2, rtol=rtol,  atol=atol):
         return True
 
-    # If control reaches here, then the arrays are not equal
-    print("Printing values that were different side-by side\n",
-          file=sys.stderr)
+    # If control reaches here, then the arrays are not equal.  Compute everything in a single
+    # vectorized pass rather than printing each mismatched value.
+    bad_mask = determine_mismatched_galaxies(field1, field2, rtol, atol)
+    bad_idx = np.flatnonzero(bad_mask)
+
+    bad_field1 = np.asarray(field1[bad_idx])
+    bad_field2 = np.asarray(field2[bad_idx])
+    abs_err, rel_err = determine_mismatch_errors(bad_field1, bad_field2)
+
+    quantiles = [50, 90, 99]
+    abs_err_quantiles = np.percentile(abs_err, quantiles)
+
+    if galaxy_index is not None:
+        bad_galaxy_index = np.asarray(galaxy_index[bad_idx])
+    else:
+        bad_galaxy_index = np.full(len(bad_idx), -1, dtype=np.int64)
+
     print("#######################################", file=sys.stderr)
-    print("# index          {0}1          {0}2       Diff".format(field_name),
+    print("# Field {0}: found {1} mis-matched values out of a total of {2}".format(
+          field_name, len(bad_idx), len(field1)), file=sys.stderr)
+    print("# Max absolute error {0:.6e}. Max relative error {1:.6e}".format(
+          abs_err.max(), np.nanmax(rel_err)), file=sys.stderr)
+    print("# Absolute error quantiles: {0}".format(", ".join(
+          "{0}%: {1:.6e}".format(q, value) for q, value in zip(quantiles, abs_err_quantiles))),
           file=sys.stderr)
 
-    # `isclose` is True for all elements of `field1` that are close to the corresponding
-    # element in `field2`.
-    bool_mask = np.bool(np.isclose(field1, field2, rtol=rtol, atol=atol))
+    # Sort the worst mismatches by decreasing absolute error.
+    worst = np.argsort(abs_err)[::-1][:num_worst]
 
-    bad_field1 = field1[bool_mask == False]
-    bad_field2 = field2[bool_mask == False]
+    print("# The {0} worst mis-matched values".format(len(worst)), file=sys.stderr)
+    print("# index     GalaxyIndex          {0}1          {0}2       AbsErr       "
+          "RelErr".format(field_name), file=sys.stderr)
+    for idx in worst:
+        print("{0} {1} {2} {3} {4:.6e} {5:.6e}".format(bad_idx[idx], bad_galaxy_index[idx],
+              bad_field1[idx], bad_field2[idx], abs_err[idx], rel_err[idx]), file=sys.stderr)
 
-    for idx, (field1_val, field2_val) in enumerate(zip(bad_field1, bad_field2)):
-        print("{0} {1} {2} {3}".format(idx, field1_val, field2_val,
-              field1_val-field2_val), file=sys.stderr)
+    if mismatch_fname is not None:
+        save_mismatches(mismatch_fname, bad_idx, bad_galaxy_index, bad_field1, bad_field2)
 
-    # printed out the offending values
-    print("------ Found {0} mis-matched values out of a total of {1} "
-          "------".format(len(bad_field1), len(field1)), file=sys.stderr)
     print("#######################################\n", file=sys.stderr)
 
     return False
@@ -577,6 +2142,27 @@ if __name__ == '__main__':
 
     parser.add_argument("verbose", metavar="verbose", type=bool, default=False,
                         nargs='?', help="print lots of info messages.")
+    parser.add_argument("--memmap", action="store_true",
+                        help="memory-map the binary files rather than reading them into RAM.")
+    parser.add_argument("--fields", metavar="FIELD", nargs="+", default=None,
+                        help="only read and compare these galaxy fields (default: all fields).")
+    parser.add_argument("--num_workers", metavar="NUM_WORKERS", type=int, default=None,
+                        help="number of binary files to read concurrently (default: 1).  With "
+                             "'--all_snapshots', the number of worker processes (default: the "
+                             "number of CPUs).")
+    parser.add_argument("--use_processes", action="store_true",
+                        help="read the binary files with a pool of '--num_workers' processes "
+                             "writing into shared memory rather than with threads.")
+    parser.add_argument("--chunk_size", metavar="CHUNK_SIZE", type=int, default=None,
+                        help="compare binary catalogs in chunks of this many galaxies rather "
+                             "than loading them fully into memory.")
+    parser.add_argument("--mismatch_dir", metavar="DIR", default=None,
+                        help="save the mis-matched values of each failed field to a .npz file "
+                             "in this directory.")
+    parser.add_argument("--all_snapshots", action="store_true",
+                        help="in 'binary-hdf5' mode, treat FILE1 as the model prefix "
+                             "(say, /path/to/model1) and compare every redshift file against "
+                             "the matching snapshot of the HDF5 file.")
 
     args = parser.parse_args()
 
@@ -610,8 +2196,25 @@ if __name__ == '__main__':
                                        args.mode, args.num_files_file1,
                                        args.num_files_file2))
 
-    compare_catalogs(args.file1, args.num_files_file1, args.file2, args.num_files_file2,
-                     args.mode, ignored_fields, multidim_fields, rtol, atol)
+    if args.chunk_size and (args.mode != "binary-binary" or args.all_snapshots):
+        print("'--chunk_size' is only supported in 'binary-binary' mode.")
+        raise ValueError
+
+    if args.all_snapshots:
+        if args.mode != "binary-hdf5":
+            print("'--all_snapshots' is only supported in 'binary-hdf5' mode.")
+            raise ValueError
+
+        compare_binary_hdf5_all_snapshots(args.file1, args.num_files_file1, args.file2,
+                                          ignored_fields, multidim_fields, rtol, atol,
+                                          fields=args.fields, num_workers=args.num_workers,
+                                          verbose=args.verbose, mismatch_dir=args.mismatch_dir)
+    else:
+        compare_catalogs(args.file1, args.num_files_file1, args.file2, args.num_files_file2,
+                         args.mode, ignored_fields, multidim_fields, rtol, atol,
+                         memmap=args.memmap, fields=args.fields,
+                         num_workers=args.num_workers or 1, chunk_size=args.chunk_size,
+                         mismatch_dir=args.mismatch_dir, use_processes=args.use_processes)
 
     print("========================")
     print("All tests passed for files {0} and {1}. Yay!".format(args.file1, args.file2))
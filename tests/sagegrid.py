@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sys
+import time
+
+from sagestats import ResultCache, compute_history_from_parameter_file, history_version
+from sageutils import determine_file_stamps, read_parameter_file, run_tasks
+
+# The number of lines of the log of a failed run that are reported.
+num_log_lines = 20
+
+
+def expand_parameter_grid(grid):
+    """
+    Expands ``grid``, a dictionary of the values of each parameter (e.g., ``{"SfrEfficiency":
+    ["0.03", "0.05"], "RadioModeEfficiency": ["0.08", "0.1"]}``), into a list of dictionaries
+    holding every combination.  The parameters are varied in the order of their names, the
+    last one fastest.
+    """
+    import itertools
+
+    names = sorted(grid)
+    combinations = itertools.product(*[grid[name] for name in names])
+
+    return [dict(zip(names, [str(value) for value in values])) for values in combinations]
+
+
+def parse_parameter_grid(grid_specs):
+    """
+    Parses the command line grid specification ``grid_specs``, a list of
+    ``Parameter=value1,value2,...``, into a dictionary of the values of each parameter.
+    """
+
+    grid = {}
+    for spec in grid_specs:
+        name, sep, values = spec.partition("=")
+        if not sep or not name or not values:
+            msg = "The grid specification '{0}' is not of the form "\
+                  "'Parameter=value1,value2,...'.".format(spec)
+            raise ValueError(msg)
+        grid[name] = values.split(",")
+
+    return grid
+
+
+def write_parameter_file(base_param_fname, overrides, param_fname):
+    """
+    Writes a copy of the SAGE parameter file ``base_param_fname`` to ``param_fname`` with the
+    values of the parameters in ``overrides`` replaced.  Parameters that are not set in the
+    base file are appended.  Comments and the layout of the base file are kept.
+    """
+
+    remaining = dict(overrides)
+    lines = []
+
+    with open(base_param_fname, "r") as f:
+        for line in f:
+            parts = line.split(None, 1)
+            if parts and not parts[0].startswith("%") and parts[0] in remaining:
+                line = "{0}    {1}\n".format(parts[0], remaining.pop(parts[0]))
+            lines.append(line)
+
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    for name in sorted(remaining):
+        lines.append("{0}    {1}\n".format(name, remaining[name]))
+
+    with open(param_fname, "w") as f:
+        f.writelines(lines)
+
+
+def determine_input_fnames(params):
+    """
+    Returns the (absolute) names of the files read by SAGE with the parameters ``params``: the
+    merger trees of the ``TreeType`` and the ``FileWithSnapList``.
+
+    Relative paths are resolved against the current directory, from which SAGE is launched
+    (see :py:func:`~run_grid_point`).
+    """
+
+    tree_type = params.get("TreeType", "lhalo_binary")
+    simulation_dir = params["SimulationDir"]
+
+    if tree_type in ("lhalo_binary", "lhalo_hdf5"):
+        # Follows ``get_forests_filename_lht_binary`` and its HDF5 counterpart.
+        tree_extension = ".hdf5" if tree_type == "lhalo_hdf5" else ""
+        fnames = [os.path.join(simulation_dir, "{0}.{1}{2}".format(params["TreeName"], filenr,
+                                                                   tree_extension))
+                  for filenr in range(int(params["FirstFile"]), int(params["LastFile"]) + 1)]
+    elif tree_type == "genesis_hdf5":
+        fnames = [os.path.join(simulation_dir, "{0}.hdf5".format(params["TreeName"]))]
+    else:
+        # Consistent-trees forests are spread over the files listed in ``locations.dat``.
+        locations_fname = os.path.join(simulation_dir, "locations.dat")
+        fnames = [locations_fname, os.path.join(simulation_dir, "forests.list")]
+        if os.path.exists(locations_fname):
+            tree_fnames = set()
+            with open(locations_fname, "r") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 4 and not line.startswith("#"):
+                        tree_fnames.add(parts[3])
+            fnames += [os.path.join(simulation_dir, tree_fname)
+                       for tree_fname in sorted(tree_fnames)]
+
+    fnames.append(params["FileWithSnapList"])
+
+    return [os.path.abspath(fname) for fname in fnames]
+
+
+def determine_run_key(base_param_fname, overrides, sage_executable, history_redshifts):
+    """
+    Returns the cache key of the run of ``sage_executable`` with the parameters of
+    ``base_param_fname`` modified by ``overrides``.
+
+    The key is the hash of every parameter value (except the ``OutputDir``, which is specific
+    to each run), the analysis settings and the modification time and size of the executable
+    and of the input files (see :py:func:`~determine_input_fnames`), so that a rebuilt
+    executable or regenerated trees are run again.  Input files that do not exist are hashed
+    as such; SAGE fails on them and failed runs are not cached.
+    """
+
+    params = read_parameter_file(base_param_fname)
+    params.update(overrides)
+    params.pop("OutputDir", None)
+
+    inputs = [[fname] + (determine_file_stamps([fname])[0] if os.path.exists(fname) else [None])
+              for fname in determine_input_fnames(params)]
+
+    description = {"calculation": "grid_run",
+                   "version": history_version,
+                   "parameters": params,
+                   "history_redshifts": history_redshifts,
+                   "executable": determine_file_stamps([sage_executable]),
+                   "inputs": inputs}
+
+    return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def determine_num_mpi_procs(mpi_run_command):
+    """
+    Returns the number of processors used by ``mpi_run_command`` (e.g., ``mpirun -np 4``).  As
+    in ``test_sage.sh``, this is the last word of the command.
+    """
+
+    if not mpi_run_command:
+        return 1
+
+    try:
+        return max(int(mpi_run_command.split()[-1]), 1)
+    except ValueError:
+        return 1
+
+
+def run_grid_point(sage_executable, base_param_fname, overrides, work_dir, mpi_run_command=None,
+                   history_redshifts="All", keep_output=False):
+    """
+    Runs ``sage_executable`` with the parameters of ``base_param_fname`` modified by
+    ``overrides`` and reduces its output to the SMF, SMD and SFRD histories (see
+    :py:func:`~sagestats.compute_history_from_parameter_file`).
+
+    The parameter file and the output of the run are written to a new directory in
+    ``work_dir``.  Unless ``keep_output`` is ``True``, the directory is removed as soon as the
+    output has been reduced so that the disk usage of a grid stays bounded.
+
+    If ``mpi_run_command`` (e.g., ``mpirun -np 4``) is given, SAGE is launched through it.
+
+    Returns a dictionary holding the ``history``, the wall time of the run in ``seconds`` and
+    the ``run_dir`` (if kept).  If SAGE fails, the ``error`` and the end of the ``log`` are
+    returned instead.
+    """
+    import shlex
+    import shutil
+    import subprocess
+    import tempfile
+
+    run_dir = tempfile.mkdtemp(prefix="sagegrid", dir=work_dir)
+    output_dir = os.path.join(run_dir, "output")
+    os.makedirs(output_dir)
+
+    param_fname = os.path.join(run_dir, "run.par")
+    write_parameter_file(base_param_fname, dict(overrides, OutputDir=output_dir), param_fname)
+
+    command = shlex.split(mpi_run_command or "") + [sage_executable, param_fname]
+    log_fname = os.path.join(run_dir, "run.log")
+
+    start = time.time()
+    with open(log_fname, "w") as log:
+        returncode = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+    seconds = time.time() - start
+
+    try:
+        if returncode != 0:
+            with open(log_fname, "r") as log:
+                log_lines = log.readlines()[-num_log_lines:]
+            return {"error": "'{0}' exited with status {1}.".format(" ".join(command),
+                                                                   returncode),
+                    "log": "".join(log_lines),
+                    "seconds": seconds}
+
+        history = compute_history_from_parameter_file(param_fname, history_redshifts,
+                                                      num_workers=1)
+    finally:
+        if not keep_output:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    result = {"history": [dict(snapshot, SMF=snapshot["SMF"].tolist()) for snapshot in history],
+              "seconds": seconds}
+    if keep_output:
+        result["run_dir"] = run_dir
+
+    return result
+
+
+def run_parameter_grid(sage_executable, base_param_fname, grid, work_dir, num_workers=None,
+                       mpi_run_command=None, history_redshifts="All", cache=None,
+                       keep_output=False):
+    """
+    Runs SAGE at every point of the parameter ``grid`` (see :py:func:`~expand_parameter_grid`)
+    and returns the result of each point (see :py:func:`~run_grid_point`), in the order of the
+    expanded grid.
+
+    The runs are scheduled over ``num_workers`` processes.  It defaults to the number of CPUs
+    divided by the number of processors used by each run (see
+    :py:func:`~determine_num_mpi_procs`).
+
+    If ``cache`` (a :py:class:`~sagestats.ResultCache`) is specified, points whose parameter
+    values were already run (see :py:func:`~determine_run_key`) are taken from the cache.
+    Successful runs are added to the cache.
+
+    Each result also holds the ``parameters`` of the point, its cache ``key`` and whether it
+    was ``cached``.
+    """
+
+    if num_workers is None:
+        num_workers = max((os.cpu_count() or 1) // determine_num_mpi_procs(mpi_run_command), 1)
+
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    sage_executable = os.path.abspath(sage_executable)
+    points = expand_parameter_grid(grid)
+
+    results = [None] * len(points)
+    keys = []
+    pending = []
+    for point_idx, overrides in enumerate(points):
+        key = determine_run_key(base_param_fname, overrides, sage_executable, history_redshifts)
+        keys.append(key)
+
+        result = cache.get(key) if cache is not None else None
+        if result is not None:
+            results[point_idx] = dict(result, cached=True)
+        else:
+            pending.append(point_idx)
+
+    tasks = [(sage_executable, base_param_fname, points[point_idx], work_dir, mpi_run_command,
+              history_redshifts, keep_output) for point_idx in pending]
+
+    for point_idx, result in zip(pending, run_tasks(run_grid_point, tasks, num_workers)):
+        if cache is not None and "error" not in result:
+            cache.put(keys[point_idx], result)
+        results[point_idx] = dict(result, cached=False)
+
+    for point_idx, overrides in enumerate(points):
+        results[point_idx]["parameters"] = overrides
+        results[point_idx]["key"] = keys[point_idx]
+
+    return results
+
+
+if __name__ == '__main__':
+
+    import argparse
+    from sagestats import default_cache_dir, default_cache_max_size
+
+    description = "Run SAGE over a grid of parameter values and reduce each run to its "\
+                  "stellar mass function, stellar mass density and star formation rate "\
+                  "density histories"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("param_fname", metavar="PARAM_FILE",
+                        help="the base SAGE parameter file (say, input/millennium.par).")
+    parser.add_argument("--grid", metavar="PARAMETER=VALUES", nargs="+", required=True,
+                        help="the comma separated values of each varied parameter (say, "
+                             "SfrEfficiency=0.03,0.05 RadioModeEfficiency=0.05,0.08).")
+    parser.add_argument("--sage", metavar="EXECUTABLE", default="./sage",
+                        help="the SAGE executable (default: ./sage).")
+    parser.add_argument("--mpi_run_command", metavar="COMMAND",
+                        default=os.environ.get("MPI_RUN_COMMAND"),
+                        help="launch each run through this command (say, 'mpirun -np 4'; "
+                             "default: the MPI_RUN_COMMAND environment variable).")
+    parser.add_argument("--num_workers", metavar="NUM_WORKERS", type=int, default=None,
+                        help="number of concurrent runs (default: the number of CPUs divided by "
+                             "the number of processors of each run).")
+    parser.add_argument("--history_redshifts", metavar="REDSHIFT", nargs="+", default=["All"],
+                        help="the redshifts to compute the histories at (default: All).")
+    parser.add_argument("--work_dir", metavar="DIR", default=None,
+                        help="write the parameter files and outputs of the runs to this "
+                             "directory (default: a temporary directory).")
+    parser.add_argument("--keep_output", action="store_true",
+                        help="keep the output of each run rather than removing it once it has "
+                             "been reduced.")
+    parser.add_argument("--cache_dir", metavar="DIR", default=default_cache_dir,
+                        help="cache the results of each run in this directory (default: "
+                             "{0}).".format(default_cache_dir))
+    parser.add_argument("--cache_max_size", metavar="BYTES", type=int,
+                        default=default_cache_max_size,
+                        help="evict the least recently used results once the cache exceeds "
+                             "this size.")
+    parser.add_argument("--no_cache", action="store_true",
+                        help="neither read nor write the result cache.")
+    parser.add_argument("--output", metavar="FILE", default=None,
+                        help="also save the results as JSON to this file.")
+
+    args = parser.parse_args()
+
+    history_redshifts = args.history_redshifts
+    if history_redshifts == ["All"]:
+        history_redshifts = "All"
+    else:
+        history_redshifts = [float(redshift) for redshift in history_redshifts]
+
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_dir, args.cache_max_size)
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        import tempfile
+        work_dir = tempfile.mkdtemp(prefix="sagegrid")
+
+    results = run_parameter_grid(args.sage, args.param_fname,
+                                 parse_parameter_grid(args.grid), work_dir, args.num_workers,
+                                 args.mpi_run_command, history_redshifts, cache,
+                                 args.keep_output)
+
+    failed = []
+    for result in results:
+        parameters = " ".join("{0}={1}".format(name, value)
+                              for name, value in sorted(result["parameters"].items()))
+        if "error" in result:
+            failed.append(result)
+            print("{0}: FAILED. {1}".format(parameters, result["error"]))
+            continue
+
+        status = "cached" if result["cached"] else "{0:.1f} seconds".format(result["seconds"])
+        print("{0} ({1}):".format(parameters, status))
+        for snapshot in result["history"]:
+            print("  {0} (z = {1:.3f}): SMD = {2:.4e}, SFRD = {3:.4e}".format(
+                snapshot["snap_key"], snapshot["redshift"], snapshot["SMD"],
+                snapshot["SFRD"]))
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if failed:
+        print("{0} of {1} runs failed.".format(len(failed), len(results)), file=sys.stderr)
+        for result in failed:
+            print(result["log"], file=sys.stderr)
+        sys.exit(1)
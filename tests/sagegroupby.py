@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+
+from sagediff import BinarySage, Hdf5Sage, determine_binary_snapshots, \
+    determine_selection_fields, evaluate_selection, find_binary_redshift_files
+from sagestats import determine_num_binary_files
+from sageutils import determine_file_stamps, lazy_import, run_tasks
+
+np = lazy_import("numpy")
+
+# The fields that galaxies can be grouped by.
+group_key_fields = ["CentralGalaxyIndex", "SAGEHaloIndex"]
+
+# The multiplication factor of the forest number in ``GalaxyIndex`` (``ForestNr_Mulfac`` in the
+# tree readers).  Used to make ``SAGEHaloIndex``, which is local to each forest, unique.
+forestnr_mulfac = 1000000000
+
+# The supported reductions, mapped to the numpy ufunc used for the segmented reduction.
+# Partial results of each reduction are merged with the same ufunc.
+group_reductions = {"sum": "add",
+                    "min": "minimum",
+                    "max": "maximum"}
+
+# Bump whenever the layout of the cached grouping changes so that stale caches are rebuilt.
+groupby_version = 1
+
+
+class GroupBy(object):
+    """
+    Groups rows by a key using a single (stable) argsort.
+
+    ``order`` sorts the rows by key and ``group_starts`` is the position (within the sorted
+    rows) of the first row of each group, whose key is ``group_keys``.  Every reduction is then
+    a segmented ``reduceat`` over the sorted rows, so the grouping is computed once and reused
+    for every field.
+    """
+
+    def __init__(self, order, group_starts, group_keys):
+        """
+        Set up instance variables
+        """
+
+        self.order = order
+        self.group_starts = group_starts
+        self.group_keys = group_keys
+
+
+    @property
+    def num_groups(self):
+        return len(self.group_keys)
+
+
+    def count(self, mask=None):
+        """
+        Returns the number of rows in each group.  If ``mask`` is given, only the rows where
+        ``mask`` is ``True`` are counted.
+        """
+
+        if mask is None:
+            group_ends = np.concatenate([self.group_starts[1:], [len(self.order)]])
+            return (group_ends - self.group_starts).astype(np.int64)
+
+        return self.reduce(np.asarray(mask, dtype=np.int64), "sum")
+
+
+    def reduce(self, values, reduction="sum", mask=None):
+        """
+        Reduces ``values`` (one per row, in the original row order) over each group with the
+        ``reduction`` (see ``group_reductions``).
+
+        If ``mask`` is given, only the rows where ``mask`` is ``True`` contribute.  Groups
+        without any such row get the identity of the reduction (0 for ``"sum"``, the largest
+        value for ``"min"`` and the smallest value for ``"max"``).
+        """
+
+        if reduction not in group_reductions:
+            msg = "Reduction '{0}' is not supported. The supported reductions are "\
+                  "{1}".format(reduction, sorted(group_reductions))
+            raise ValueError(msg)
+
+        # Sums are accumulated in 64-bit so that large groups do not lose precision.
+        values = np.asarray(values)
+        if reduction == "sum" and values.dtype.kind in "biu":
+            values = values.astype(np.int64)
+        elif reduction == "sum" and values.dtype.kind == "f":
+            values = values.astype(np.float64)
+
+        if self.num_groups == 0:
+            return np.empty((0, ) + values.shape[1:], dtype=values.dtype)
+
+        sorted_values = values[self.order]
+
+        if mask is not None:
+            identity = determine_reduction_identity(reduction, values.dtype)
+            sorted_mask = np.asarray(mask, dtype=bool)[self.order]
+            sorted_values[~sorted_mask] = identity
+
+        return getattr(np, group_reductions[reduction]).reduceat(sorted_values,
+                                                                 self.group_starts, axis=0)
+
+
+    def aggregate(self, gals, fields, reductions=("sum", ), mask=None):
+        """
+        Aggregates the ``fields`` of ``gals`` (anything indexable by the field names) over each
+        group with each of the ``reductions``.
+
+        Returns a dictionary holding the ``keys`` and ``count`` of each group and, for each
+        field and reduction, ``<field>_<reduction>`` (e.g., ``StellarMass_sum``).  Only the rows
+        where ``mask`` is ``True`` (if given) are counted and reduced.
+        """
+
+        aggregates = {"keys": self.group_keys,
+                      "count": self.count(mask)}
+
+        for field in fields:
+            values = np.asarray(gals[field])
+            for reduction in reductions:
+                aggregates["{0}_{1}".format(field, reduction)] = \
+                    self.reduce(values, reduction, mask)
+
+        return aggregates
+
+
+def determine_reduction_identity(reduction, dtype):
+    """
+    Returns the identity of the ``reduction`` for values of type ``dtype``.
+    """
+
+    if reduction == "sum":
+        return 0
+
+    if dtype.kind == "f":
+        largest = np.inf
+    else:
+        largest = np.iinfo(dtype).max
+
+    if reduction == "min":
+        return largest
+
+    return -largest if dtype.kind == "f" else np.iinfo(dtype).min
+
+
+def build_groupby(keys):
+    """
+    Returns the :py:class:`~GroupBy` grouping the rows by ``keys``.
+    """
+
+    keys = np.asarray(keys)
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    is_start = np.ones(len(keys), dtype=bool)
+    is_start[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    group_starts = np.flatnonzero(is_start)
+
+    return GroupBy(order, group_starts, sorted_keys[group_starts])
+
+
+def determine_group_key_fields(key_field):
+    """
+    Returns the galaxy fields needed to compute the group keys of ``key_field``.
+    """
+
+    if key_field not in group_key_fields:
+        msg = "Galaxies can only be grouped by {0}, not '{1}'.".format(group_key_fields,
+                                                                      key_field)
+        raise ValueError(msg)
+
+    if key_field == "SAGEHaloIndex":
+        return ["GalaxyIndex", "SAGEHaloIndex"]
+
+    return [key_field]
+
+
+def determine_group_keys(gals, key_field):
+    """
+    Returns the group key of each galaxy in ``gals``.
+
+    ``CentralGalaxyIndex`` is unique across the whole catalog.  ``SAGEHaloIndex`` is the index
+    of the halo within its forest, so it is combined with the forest (and file) number encoded
+    in ``GalaxyIndex``.
+    """
+
+    if key_field == "SAGEHaloIndex":
+        forest_ids = np.asarray(gals["GalaxyIndex"], dtype=np.int64) // forestnr_mulfac
+        return forest_ids * forestnr_mulfac + np.asarray(gals["SAGEHaloIndex"], dtype=np.int64)
+
+    return np.asarray(gals[key_field], dtype=np.int64)
+
+
+def merge_group_aggregates(partials):
+    """
+    Merges the aggregates (see :py:meth:`~GroupBy.aggregate`) of several files or cores.
+    Groups that appear in several of them are combined.
+    """
+
+    partials = [partial for partial in partials if partial is not None]
+    if len(partials) == 1:
+        return partials[0]
+
+    groupby = build_groupby(np.concatenate([partial["keys"] for partial in partials]))
+
+    merged = {"keys": groupby.group_keys}
+    for name in partials[0]:
+        if name == "keys":
+            continue
+
+        reduction = "sum" if name == "count" else name.rsplit("_", 1)[1]
+        merged[name] = groupby.reduce(np.concatenate([partial[name] for partial in partials]),
+                                      reduction)
+
+    return merged
+
+
+def determine_groupby_fname(unit_fname, key_field, snap_key=None, core_idx=None):
+    """
+    Returns the name of the cached grouping of a single binary file or HDF5 core.  The
+    grouping is saved next to the catalog.
+    """
+
+    if snap_key is None:
+        return "{0}.{1}.groups.npz".format(unit_fname, key_field)
+
+    return "{0}.{1}.Core_{2}.{3}.groups.npz".format(unit_fname, snap_key, core_idx, key_field)
+
+
+def load_groupby(groupby_fname, stamps, read_key_gals, key_field):
+    """
+    Returns the cached :py:class:`~GroupBy` in ``groupby_fname`` if it was built from files
+    with the same (modification time, size) ``stamps``.  Otherwise, the grouping is built from
+    the galaxies returned by ``read_key_gals()`` and cached.  If the cache cannot be written,
+    the grouping is rebuilt on every call.
+    """
+
+    try:
+        with np.load(groupby_fname) as cached:
+            if int(cached["version"]) == groupby_version and \
+               cached["stamps"].tolist() == stamps:
+                return GroupBy(cached["order"], cached["group_starts"], cached["group_keys"])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    groupby = build_groupby(determine_group_keys(read_key_gals(), key_field))
+
+    # Write to a temporary file first so that concurrent readers never see a partial cache.
+    tmp_fname = "{0}.{1}.tmp".format(groupby_fname, os.getpid())
+    try:
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, version=groupby_version, stamps=np.array(stamps),
+                     order=groupby.order, group_starts=groupby.group_starts,
+                     group_keys=groupby.group_keys)
+        os.rename(tmp_fname, groupby_fname)
+    except (IOError, OSError):
+        pass
+
+    return groupby
+
+
+def aggregate_binary_file(binary_fname, key_field, fields, reductions, predicates=None):
+    """
+    Returns the aggregates (see :py:meth:`~GroupBy.aggregate`) of the galaxies in a single
+    binary file, or ``None`` if the file has no galaxies.  Only the galaxies satisfying the
+    ``predicates`` (see :py:func:`~sagediff.evaluate_selection`) are counted and reduced.
+
+    Only the key fields (if the grouping is not cached), ``fields`` and the fields of the
+    ``predicates`` are read.
+    """
+
+    def read_gals(read_fields):
+        return BinarySage(binary_fname, memmap=True, fields=read_fields).read_gals()
+
+    gals = read_gals(list(set(fields) | set(determine_selection_fields(predicates))))
+    if len(gals) == 0:
+        return None
+
+    groupby = load_groupby(determine_groupby_fname(binary_fname, key_field),
+                           determine_file_stamps([binary_fname]),
+                           lambda: read_gals(determine_group_key_fields(key_field)), key_field)
+
+    mask = None
+    if predicates:
+        mask = evaluate_selection(gals, len(gals), predicates)
+
+    return groupby.aggregate(gals, fields, reductions, mask)
+
+
+def aggregate_hdf5_core(hdf5_fname, core_idx, snap_key, key_field, fields, reductions,
+                        predicates=None):
+    """
+    Returns the aggregates (see :py:meth:`~GroupBy.aggregate`) of the galaxies written by core
+    ``core_idx`` at snapshot ``snap_key``, or ``None`` if there are no such galaxies.  See
+    :py:func:`~aggregate_binary_file`.
+    """
+
+    with Hdf5Sage(hdf5_fname) as g:
+
+        num_gals = g.metadata["snapshots"][snap_key]["num_gals_per_core"][core_idx]
+        if num_gals == 0:
+            return None
+
+        datasets = g.get_snap_datasets(snap_key, core_idx)
+
+        def read_gals(read_fields):
+            gals = {}
+            for key in read_fields:
+                gals[key] = g.allocate_field(snap_key, key, num_gals)
+                g.read_field_slice(datasets, key, 0, num_gals, gals[key], 0)
+            return gals
+
+        gals = read_gals(list(set(fields) | set(determine_selection_fields(predicates))))
+
+        core_fname = os.path.join(os.path.dirname(hdf5_fname),
+                                  g.metadata["core_fnames"][core_idx])
+        groupby = load_groupby(determine_groupby_fname(hdf5_fname, key_field, snap_key,
+                                                       core_idx),
+                               determine_file_stamps([core_fname]),
+                               lambda: read_gals(determine_group_key_fields(key_field)),
+                               key_field)
+
+    mask = None
+    if predicates:
+        mask = evaluate_selection(gals, num_gals, predicates)
+
+    return groupby.aggregate(gals, fields, reductions, mask)
+
+
+def group_catalog(catalog_fname, snap, key_field, fields, reductions=("sum", ), predicates=None,
+                  num_files=None, num_workers=None):
+    """
+    Aggregates the ``fields`` of the galaxies at snapshot ``snap`` (number or key) of the
+    catalog ``catalog_fname`` (the model prefix of a ``sage_binary`` catalog or a
+    ``sage_hdf5`` master file) by ``key_field`` (see ``group_key_fields``).
+
+    Each binary file (or HDF5 core) is grouped by its own process (``num_workers`` defaults to
+    the number of CPUs) and the partial results are then merged (see
+    :py:func:`~merge_group_aggregates`).  The grouping of each file is cached, so further
+    aggregations of the same snapshot only need to read the aggregated fields.
+
+    Returns the aggregates (see :py:meth:`~GroupBy.aggregate`) sorted by the group key.
+    """
+
+    determine_group_key_fields(key_field)
+    for reduction in reductions:
+        if reduction not in group_reductions:
+            msg = "Reduction '{0}' is not supported. The supported reductions are "\
+                  "{1}".format(reduction, sorted(group_reductions))
+            raise ValueError(msg)
+
+    snap_key = snap if isinstance(snap, str) else "Snap_{0}".format(snap)
+
+    if catalog_fname.endswith(".hdf5"):
+        with Hdf5Sage(catalog_fname) as g:
+            if snap_key not in g.metadata["snap_keys"]:
+                msg = "Snapshot '{0}' is not in '{1}'.".format(snap_key, catalog_fname)
+                raise ValueError(msg)
+            ncores = g.ncores
+
+        func = aggregate_hdf5_core
+        tasks = [(catalog_fname, core_idx, snap_key, key_field, fields, reductions, predicates)
+                 for core_idx in range(ncores)]
+    else:
+        if num_files is None:
+            binary_fnames = find_binary_redshift_files(catalog_fname)
+            num_files = determine_num_binary_files(binary_fnames[0]) if binary_fnames else 1
+
+        snapshots = dict((snapshot[0], snapshot[2])
+                         for snapshot in determine_binary_snapshots(catalog_fname, num_files,
+                                                                    skip_empty=True))
+        if snap_key not in snapshots:
+            msg = "Snapshot '{0}' is not in '{1}'.".format(snap_key, catalog_fname)
+            raise ValueError(msg)
+
+        func = aggregate_binary_file
+        tasks = [(binary_fname, key_field, fields, reductions, predicates)
+                 for _, binary_fname in snapshots[snap_key]]
+
+    partials = [partial for partial in run_tasks(func, tasks, num_workers)
+                if partial is not None]
+    if not partials:
+        groupby = build_groupby(np.empty(0, dtype=np.int64))
+        return groupby.aggregate(dict((field, np.empty(0)) for field in fields), fields,
+                                 reductions)
+
+    return merge_group_aggregates(partials)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    description = "Aggregate the galaxies of a SAGE snapshot by central galaxy or halo"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("catalog", metavar="CATALOG",
+                        help="the binary model prefix (say, /path/to/model) or the HDF5 "
+                             "master file.")
+    parser.add_argument("snap", metavar="SNAP", type=int,
+                        help="the snapshot number.")
+    parser.add_argument("--key", metavar="FIELD", default="CentralGalaxyIndex",
+                        choices=group_key_fields,
+                        help="group the galaxies by this field (default: CentralGalaxyIndex).")
+    parser.add_argument("--fields", metavar="FIELD", nargs="+",
+                        default=["StellarMass", "ColdGas"],
+                        help="the galaxy fields to aggregate.")
+    parser.add_argument("--reductions", metavar="REDUCTION", nargs="+", default=["sum"],
+                        choices=sorted(group_reductions),
+                        help="the reductions applied to each field (default: sum).")
+    parser.add_argument("--satellites_only", action="store_true",
+                        help="only count and aggregate satellite galaxies (Type > 0).")
+    parser.add_argument("--num_files", metavar="NUM_FILES", type=int, default=None,
+                        help="for binary catalogs, number of files each redshift is split over "
+                             "(default: determined from the files on disk).")
+    parser.add_argument("--num_workers", metavar="NUM_WORKERS", type=int, default=None,
+                        help="number of worker processes (default: the number of CPUs).")
+    parser.add_argument("--num_largest", metavar="NUM", type=int, default=10,
+                        help="number of the groups with the most members to print.")
+    parser.add_argument("--output", metavar="FILE", default=None,
+                        help="save the aggregates of every group to this .npz file.")
+
+    args = parser.parse_args()
+
+    predicates = [("Type", ">", 0)] if args.satellites_only else None
+    aggregates = group_catalog(args.catalog, args.snap, args.key, args.fields, args.reductions,
+                               predicates, args.num_files, args.num_workers)
+
+    print("Found {0} groups by {1}.".format(len(aggregates["keys"]), args.key))
+
+    columns = sorted(name for name in aggregates if name not in ["keys", "count"])
+    print(" ".join(["{0:>20}".format(args.key), "{0:>8}".format("count")] +
+                   ["{0:>20}".format(name) for name in columns]))
+    for idx in np.argsort(-aggregates["count"], kind="stable")[:args.num_largest]:
+        print(" ".join(["{0:>20}".format(aggregates["keys"][idx]),
+                        "{0:>8}".format(aggregates["count"][idx])] +
+                       ["{0:>20.6g}".format(aggregates[name][idx]) for name in columns]))
+
+    if args.output is not None:
+        np.savez(args.output, **aggregates)
@@ -0,0 +1,521 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import json
+import os
+
+from sagediff import BinarySage, Hdf5Sage, determine_binary_snapshots, \
+    determine_hdf5_metadata_stamps, find_binary_redshift_files, snap_key_to_snap_num
+from sagestats import determine_num_binary_files
+from sageutils import determine_file_stamps, lazy_import
+
+np = lazy_import("numpy")
+
+# Bump whenever the layout of the cached index changes so that stale indices are rebuilt.
+history_index_version = 1
+
+# The arrays stored for each snapshot of the index (see :py:class:`~GalaxyHistoryIndex`).
+history_index_arrays = ["sorted_ids", "sorted_rows", "progenitor_rows", "merge_rows",
+                        "merge_snaps"]
+
+
+class GalaxyHistoryIndex(object):
+    """
+    Joins the galaxies of a catalog across its snapshots.
+
+    The snapshots are ordered from the latest to the earliest.  Galaxies are referred to by
+    their row, i.e., their position in the snapshot as read by ``BinarySage.read_gals`` or
+    ``Hdf5Sage.read_field``.  For the snapshot ``snap_idx``:
+
+    * ``sorted_ids[snap_idx]`` is the sorted ``GalaxyIndex`` and ``sorted_rows[snap_idx]`` the
+      row of each of them.
+    * ``progenitor_rows[snap_idx]`` is the row of each galaxy (i.e., of the same
+      ``GalaxyIndex``) at the next earlier snapshot, or -1.
+    * ``merge_snaps[snap_idx]`` and ``merge_rows[snap_idx]`` are the snapshot (index) and row of
+      the galaxy that each galaxy merged into (``mergeIntoSnapNum`` and ``mergeIntoID``), or -1
+      if the galaxy did not merge or the target snapshot was not output.
+    """
+
+    def __init__(self, snap_keys, sorted_ids, sorted_rows, progenitor_rows, merge_rows,
+                 merge_snaps):
+        """
+        Set up instance variables
+        """
+
+        self.snap_keys = list(snap_keys)
+        self.sorted_ids = sorted_ids
+        self.sorted_rows = sorted_rows
+        self.progenitor_rows = progenitor_rows
+        self.merge_rows = merge_rows
+        self.merge_snaps = merge_snaps
+
+
+    def determine_snap_idx(self, snap):
+        """
+        Returns the position of the snapshot ``snap`` (the snapshot number or key) in the index.
+        """
+
+        if not isinstance(snap, str):
+            snap = "Snap_{0}".format(snap)
+
+        if snap not in self.snap_keys:
+            msg = "Snapshot '{0}' is not part of the index. The indexed snapshots are "\
+                  "{1}".format(snap, self.snap_keys)
+            raise ValueError(msg)
+
+        return self.snap_keys.index(snap)
+
+
+    def find_rows(self, snap, galaxy_indices):
+        """
+        Returns the row of each of ``galaxy_indices`` at snapshot ``snap``, or -1 if the galaxy
+        does not exist at that snapshot.
+        """
+
+        snap_idx = self.determine_snap_idx(snap)
+
+        return lookup_rows(self.sorted_ids[snap_idx], self.sorted_rows[snap_idx],
+                           galaxy_indices)
+
+
+    def main_branch_rows(self, galaxy_indices, snap=None):
+        """
+        Follows each of ``galaxy_indices`` from snapshot ``snap`` (defaults to the latest) back
+        to the earliest snapshot.
+
+        Returns an array of shape ``(num_snaps, num_galaxies)`` with the row of each galaxy at
+        each snapshot, or -1 where the galaxy does not exist (including all the snapshots later
+        than ``snap``).
+        """
+
+        start_idx = 0 if snap is None else self.determine_snap_idx(snap)
+        galaxy_indices = np.atleast_1d(np.asarray(galaxy_indices, dtype=np.int64))
+
+        rows = np.full((len(self.snap_keys), len(galaxy_indices)), -1, dtype=np.int64)
+        rows[start_idx] = self.find_rows(self.snap_keys[start_idx], galaxy_indices)
+
+        for snap_idx in range(start_idx, len(self.snap_keys) - 1):
+            found = rows[snap_idx] >= 0
+            rows[snap_idx + 1][found] = self.progenitor_rows[snap_idx][rows[snap_idx][found]]
+
+        return rows
+
+
+    def merge_targets(self, rows):
+        """
+        Returns the snapshot (index) and row of the galaxy that each galaxy in ``rows`` (as
+        returned by :py:meth:`~main_branch_rows`) merged into.  Both are -1 where there was no
+        merger.
+        """
+
+        merge_snaps = np.full(rows.shape, -1, dtype=np.int32)
+        merge_rows = np.full(rows.shape, -1, dtype=np.int64)
+
+        for snap_idx in range(len(self.snap_keys)):
+            found = rows[snap_idx] >= 0
+            merge_snaps[snap_idx][found] = self.merge_snaps[snap_idx][rows[snap_idx][found]]
+            merge_rows[snap_idx][found] = self.merge_rows[snap_idx][rows[snap_idx][found]]
+
+        return merge_snaps, merge_rows
+
+
+def lookup_rows(sorted_ids, sorted_rows, galaxy_indices):
+    """
+    Returns the row of each of ``galaxy_indices`` using the sorted ``GalaxyIndex`` array
+    ``sorted_ids`` (and the matching ``sorted_rows``), or -1 if it is not present.
+    """
+
+    galaxy_indices = np.atleast_1d(np.asarray(galaxy_indices, dtype=np.int64))
+    rows = np.full(len(galaxy_indices), -1, dtype=np.int64)
+
+    if len(sorted_ids) == 0:
+        return rows
+
+    pos = np.searchsorted(sorted_ids, galaxy_indices)
+    pos = np.minimum(pos, len(sorted_ids) - 1)
+    found = sorted_ids[pos] == galaxy_indices
+    rows[found] = sorted_rows[pos[found]]
+
+    return rows
+
+
+def determine_history_snapshots(catalog_fname, num_files=None, hdf5_reader=None):
+    """
+    Returns the snapshots of the catalog ``catalog_fname`` (the model prefix of a
+    ``sage_binary`` catalog or a ``sage_hdf5`` master file) as a list of ``(snap_key,
+    reader)``, ordered from the latest to the earliest snapshot.
+
+    For binary catalogs, ``num_files`` is determined from the files on disk if not given.  For
+    HDF5 catalogs, the snapshots are read through ``hdf5_reader`` if given, so that the caller
+    can close it.  Otherwise, a new :py:class:`~sagediff.Hdf5Sage` is opened and the caller
+    must close it.
+    """
+
+    if catalog_fname.endswith(".hdf5"):
+        reader = hdf5_reader if hdf5_reader is not None else Hdf5Sage(catalog_fname)
+        snapshots = [(snap_key, reader) for snap_key in reader.metadata["snap_keys"]]
+    else:
+        binary_fnames = find_binary_redshift_files(catalog_fname)
+        if binary_fnames and num_files is None:
+            num_files = determine_num_binary_files(binary_fnames[0])
+
+        snapshots = [(snap_key, BinarySage(binary_fnames[0][1], num_files=num_files, memmap=True))
+                     for snap_key, _, binary_fnames
+                     in determine_binary_snapshots(catalog_fname, num_files)]
+
+    return sorted(snapshots, key=lambda snapshot: snap_key_to_snap_num(snapshot[0]),
+                  reverse=True)
+
+
+def read_snapshot_field(reader, snap_key, field):
+    """
+    Reads the field ``field`` of every galaxy at snapshot ``snap_key``.  Only that field is
+    copied into memory.
+    """
+
+    if isinstance(reader, Hdf5Sage):
+        return reader.read_field(snap_key, field)
+
+    return np.array(reader.read_gals()[field])
+
+
+def read_snapshot_rows(reader, snap_key, field, rows):
+    """
+    Reads the field ``field`` of the galaxies at ``rows`` of snapshot ``snap_key``.
+
+    For binary catalogs, only the pages of the memory-mapped files holding these galaxies are
+    read.  For HDF5 catalogs, only these galaxies are read from the dataset(s) of ``field`` of
+    each core.
+    """
+
+    rows = np.asarray(rows, dtype=np.int64)
+
+    if isinstance(reader, Hdf5Sage):
+        core_offsets = np.array(reader.metadata["snapshots"][snap_key]["core_offsets"],
+                                dtype=np.int64)
+        core_idx_per_row = np.searchsorted(core_offsets, rows, side="right") - 1
+
+        values = reader.allocate_field(snap_key, field, len(rows))
+        for core_idx in np.unique(core_idx_per_row):
+            in_core = np.flatnonzero(core_idx_per_row == core_idx)
+
+            # h5py only accepts increasing (and unique) indices.
+            core_rows, inverse = np.unique(rows[in_core] - core_offsets[core_idx],
+                                           return_inverse=True)
+
+            datasets = reader.get_snap_datasets(snap_key, int(core_idx))
+            for dim_num, name in enumerate(reader.determine_dataset_names(field)):
+                core_values = datasets[name][core_rows][inverse]
+                if field in reader.multidim_fields:
+                    values[in_core, dim_num] = core_values
+                else:
+                    values[in_core] = core_values
+
+        return values
+
+    if reader.tree_index is None:
+        reader.update_metadata()
+
+    file_offsets = np.concatenate([[0], np.cumsum(reader.ngals_per_file)])
+    file_idx_per_row = np.searchsorted(file_offsets, rows, side="right") - 1
+
+    values = None
+    for file_idx in np.unique(file_idx_per_row):
+        in_file = file_idx_per_row == file_idx
+        file_values = reader.memmap_file(int(file_idx))[field][rows[in_file] -
+                                                              file_offsets[file_idx]]
+        if values is None:
+            values = np.empty((len(rows), ) + file_values.shape[1:], dtype=file_values.dtype)
+        values[in_file] = file_values
+
+    if values is None:
+        values = np.empty((0, ) + reader.dtype[field].shape, dtype=reader.dtype[field].base)
+
+    return values
+
+
+def determine_tree_offsets(reader, snap_key):
+    """
+    Returns the row of the first galaxy of each tree at snapshot ``snap_key``.  Trees are
+    numbered in the same way at every snapshot.
+    """
+
+    if isinstance(reader, Hdf5Sage):
+        tree_index = reader.get_tree_index(snap_key)
+        core_offsets = np.array(reader.metadata["snapshots"][snap_key]["core_offsets"],
+                                dtype=np.int64)
+        return core_offsets[tree_index["core_idx"]] + tree_index["gal_offset"]
+
+    if reader.tree_index is None:
+        reader.update_metadata()
+
+    ngals = reader.tree_index["ngals"].astype(np.int64)
+
+    return np.cumsum(ngals) - ngals
+
+
+def build_history_index(snapshots):
+    """
+    Builds the :py:class:`~GalaxyHistoryIndex` of the ``snapshots`` (see
+    :py:func:`~determine_history_snapshots`).  Only the ``GalaxyIndex``, ``mergeType``,
+    ``mergeIntoID`` and ``mergeIntoSnapNum`` fields are read.
+    """
+
+    snap_keys = [snap_key for snap_key, _ in snapshots]
+    snap_nums = [snap_key_to_snap_num(snap_key) for snap_key in snap_keys]
+
+    all_ids = []
+    sorted_ids = []
+    sorted_rows = []
+    tree_offsets = []
+    num_gals = []
+
+    for snap_key, reader in snapshots:
+        ids = read_snapshot_field(reader, snap_key, "GalaxyIndex").astype(np.int64)
+        order = np.argsort(ids, kind="stable")
+
+        all_ids.append(ids)
+        sorted_ids.append(ids[order])
+        sorted_rows.append(order.astype(np.int64))
+        tree_offsets.append(determine_tree_offsets(reader, snap_key))
+        num_gals.append(len(ids))
+
+    # The same galaxy keeps its ``GalaxyIndex`` across snapshots.
+    progenitor_rows = []
+    for snap_idx in range(len(snapshots)):
+        if snap_idx + 1 < len(snapshots):
+            progenitor_rows.append(lookup_rows(sorted_ids[snap_idx + 1],
+                                               sorted_rows[snap_idx + 1], all_ids[snap_idx]))
+        else:
+            progenitor_rows.append(np.full(num_gals[snap_idx], -1, dtype=np.int64))
+
+    # ``mergeIntoID`` is the position of the merger target amongst the galaxies of the same tree
+    # at snapshot ``mergeIntoSnapNum``.
+    merge_rows = []
+    merge_snaps = []
+    for snap_idx, (snap_key, reader) in enumerate(snapshots):
+
+        merge_type = read_snapshot_field(reader, snap_key, "mergeType")
+        merge_into_id = read_snapshot_field(reader, snap_key, "mergeIntoID").astype(np.int64)
+        merge_into_snap_num = read_snapshot_field(reader, snap_key, "mergeIntoSnapNum")
+
+        rows = np.full(num_gals[snap_idx], -1, dtype=np.int64)
+        target_snaps = np.full(num_gals[snap_idx], -1, dtype=np.int32)
+
+        treenums = np.searchsorted(tree_offsets[snap_idx], np.arange(num_gals[snap_idx]),
+                                   side="right") - 1
+        merged = (merge_type > 0) & (merge_into_id >= 0)
+
+        for target_idx, snap_num in enumerate(snap_nums):
+            is_target = merged & (merge_into_snap_num == snap_num)
+            if not np.any(is_target):
+                continue
+
+            target_offsets = np.concatenate([tree_offsets[target_idx], [num_gals[target_idx]]])
+            target_treenums = treenums[is_target]
+            target_rows = target_offsets[target_treenums] + merge_into_id[is_target]
+
+            # Ignore pointers that fall outside the tree.
+            valid = target_rows < target_offsets[target_treenums + 1]
+            rows[np.flatnonzero(is_target)[valid]] = target_rows[valid]
+            target_snaps[np.flatnonzero(is_target)[valid]] = target_idx
+
+        merge_rows.append(rows)
+        merge_snaps.append(target_snaps)
+
+    return GalaxyHistoryIndex(snap_keys, sorted_ids, sorted_rows, progenitor_rows, merge_rows,
+                              merge_snaps)
+
+
+def determine_history_index_dirname(catalog_fname):
+    """
+    Returns the name of the directory holding the cached history index of the catalog
+    ``catalog_fname``.  The index is saved next to the catalog.
+    """
+    return "{0}.history".format(catalog_fname)
+
+
+def determine_history_stamps(snapshots):
+    """
+    Returns the (modification time, size) of every file of the ``snapshots``.
+    """
+
+    if snapshots and isinstance(snapshots[0][1], Hdf5Sage):
+        reader = snapshots[0][1]
+        return determine_hdf5_metadata_stamps(reader.filename, reader.metadata)
+
+    stamps = []
+    for _, reader in snapshots:
+        stamps.extend(determine_file_stamps([reader.determine_file_name(file_idx)
+                                             for file_idx in range(reader.num_files)]))
+
+    return stamps
+
+
+def save_history_index(index, dirname, stamps):
+    """
+    Saves ``index`` to the directory ``dirname`` as one ``.npy`` file per array and snapshot.
+    """
+    import shutil
+
+    # Write to a temporary directory first so that concurrent readers never see a partial
+    # index.
+    tmp_dirname = "{0}.{1}.tmp".format(dirname, os.getpid())
+    os.makedirs(tmp_dirname)
+
+    for snap_idx in range(len(index.snap_keys)):
+        for name in history_index_arrays:
+            np.save(os.path.join(tmp_dirname, "{0}_{1}.npy".format(name, snap_idx)),
+                    getattr(index, name)[snap_idx])
+
+    with open(os.path.join(tmp_dirname, "index.json"), "w") as f:
+        json.dump({"version": history_index_version,
+                   "stamps": stamps,
+                   "snap_keys": index.snap_keys}, f)
+
+    if os.path.exists(dirname):
+        shutil.rmtree(dirname)
+    os.rename(tmp_dirname, dirname)
+
+
+def load_history_index(catalog_fname, num_files=None, hdf5_reader=None):
+    """
+    Returns the :py:class:`~GalaxyHistoryIndex` of the catalog ``catalog_fname`` and its
+    snapshots (see :py:func:`~determine_history_snapshots` for ``hdf5_reader``).
+
+    The index is cached next to the catalog (see :py:func:`~determine_history_index_dirname`)
+    and memory-mapped when loaded, so lookups only read the parts of the index they touch.  It
+    is rebuilt if the modification time or size of any catalog file has changed.  If the cache
+    cannot be written, the index is rebuilt on every call.
+    """
+    import shutil
+
+    snapshots = determine_history_snapshots(catalog_fname, num_files, hdf5_reader)
+    snap_keys = [snap_key for snap_key, _ in snapshots]
+    stamps = determine_history_stamps(snapshots)
+
+    dirname = determine_history_index_dirname(catalog_fname)
+
+    try:
+        with open(os.path.join(dirname, "index.json"), "r") as f:
+            cached = json.load(f)
+        if cached["version"] == history_index_version and cached["stamps"] == stamps and \
+           cached["snap_keys"] == snap_keys:
+            arrays = dict((name, [np.load(os.path.join(dirname, "{0}_{1}.npy".format(name,
+                                                                                   snap_idx)),
+                                          mmap_mode="r")
+                                  for snap_idx in range(len(snap_keys))])
+                          for name in history_index_arrays)
+            return GalaxyHistoryIndex(snap_keys, **arrays), snapshots
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    index = build_history_index(snapshots)
+
+    try:
+        save_history_index(index, dirname, stamps)
+    except (IOError, OSError):
+        shutil.rmtree("{0}.{1}.tmp".format(dirname, os.getpid()), ignore_errors=True)
+
+    return index, snapshots
+
+
+def read_main_branch_histories(catalog_fname, galaxy_indices, fields, snap=None, num_files=None,
+                               hdf5_reader=None):
+    """
+    Returns the main-branch histories of the galaxies ``galaxy_indices``, followed from
+    snapshot ``snap`` (defaults to the latest) back to the earliest snapshot of the catalog
+    ``catalog_fname`` (see :py:func:`~determine_history_snapshots`).
+
+    Returns a dictionary holding:
+
+    * ``snap_keys``: the snapshots, from the latest to the earliest.
+    * ``rows``: the row of each galaxy at each snapshot, or -1 (see
+      :py:meth:`~GalaxyHistoryIndex.main_branch_rows`).
+    * ``merge_snaps`` and ``merge_rows``: the snapshot (index into ``snap_keys``) and row of
+      the galaxy that each galaxy merged into, or -1 (see
+      :py:meth:`~GalaxyHistoryIndex.merge_targets`).
+    * Each of ``fields``: an array of shape ``(num_snaps, num_galaxies)`` (followed by the
+      field dimensions, e.g., 3 for ``Pos``).  Missing values are NaN for floating point
+      fields and -1 otherwise.
+
+    Only the requested fields are read, and only at the snapshots where at least one of the
+    galaxies exists.  HDF5 catalogs are read through ``hdf5_reader`` if given, and through a
+    :py:class:`~sagediff.Hdf5Sage` that is closed on return otherwise.
+    """
+
+    if catalog_fname.endswith(".hdf5") and hdf5_reader is None:
+        with Hdf5Sage(catalog_fname) as hdf5_reader:
+            return read_main_branch_histories(catalog_fname, galaxy_indices, fields, snap,
+                                              num_files, hdf5_reader)
+
+    index, snapshots = load_history_index(catalog_fname, num_files, hdf5_reader)
+
+    rows = index.main_branch_rows(galaxy_indices, snap)
+    merge_snaps, merge_rows = index.merge_targets(rows)
+
+    histories = {"snap_keys": list(index.snap_keys),
+                 "rows": rows,
+                 "merge_snaps": merge_snaps,
+                 "merge_rows": merge_rows}
+
+    for field in fields:
+        values = None
+
+        for snap_idx, (snap_key, reader) in enumerate(snapshots):
+            found = rows[snap_idx] >= 0
+            if not np.any(found):
+                continue
+
+            snap_values = read_snapshot_rows(reader, snap_key, field, rows[snap_idx][found])
+            if values is None:
+                fill_value = np.nan if snap_values.dtype.kind == "f" else -1
+                values = np.full(rows.shape + snap_values.shape[1:], fill_value,
+                                 dtype=snap_values.dtype)
+            values[snap_idx][found] = snap_values
+
+        histories[field] = values
+
+    return histories
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    description = "Print the main-branch histories of SAGE galaxies"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("catalog", metavar="CATALOG",
+                        help="the binary model prefix (say, /path/to/model) or the HDF5 "
+                             "master file.")
+    parser.add_argument("galaxy_indices", metavar="GALAXY_INDEX", type=int, nargs="+",
+                        help="the GalaxyIndex of each galaxy.")
+    parser.add_argument("--fields", metavar="FIELD", nargs="+",
+                        default=["StellarMass", "Mvir", "CentralGalaxyIndex"],
+                        help="the galaxy fields to print.")
+    parser.add_argument("--snap", metavar="SNAP", type=int, default=None,
+                        help="the snapshot to start from (default: the latest).")
+    parser.add_argument("--num_files", metavar="NUM_FILES", type=int, default=None,
+                        help="for binary catalogs, number of files each redshift is split over "
+                             "(default: determined from the files on disk).")
+
+    args = parser.parse_args()
+
+    histories = read_main_branch_histories(args.catalog, args.galaxy_indices, args.fields,
+                                           args.snap, args.num_files)
+
+    for gal_idx, galaxy_index in enumerate(args.galaxy_indices):
+        print("GalaxyIndex {0}:".format(galaxy_index))
+        for snap_idx, snap_key in enumerate(histories["snap_keys"]):
+            if histories["rows"][snap_idx][gal_idx] < 0:
+                continue
+
+            values = " ".join("{0}={1}".format(field, histories[field][snap_idx][gal_idx])
+                              for field in args.fields)
+            merge_snap_idx = histories["merge_snaps"][snap_idx][gal_idx]
+            if merge_snap_idx >= 0:
+                values += " (merged into row {0} of {1})".format(
+                    histories["merge_rows"][snap_idx][gal_idx],
+                    histories["snap_keys"][merge_snap_idx])
+
+            print("  {0}: {1}".format(snap_key, values))
@@ -0,0 +1,447 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+
+from sagediff import Hdf5Sage, determine_hdf5_metadata_stamps
+from sageutils import determine_file_stamps, lazy_import, read_parameter_file
+
+np = lazy_import("numpy")
+
+# When the number of cells is not specified, each cell holds this many galaxies on average.
+num_gals_per_cell = 8
+
+# Caps the grid at max_cells_per_dim^3 cells.
+max_cells_per_dim = 256
+
+# Bump whenever the layout of the cached index changes so that stale indices are rebuilt.
+spatial_index_version = 1
+
+# The auto pair counts compute the separations of at most this many pairs at once.
+max_pairs_per_chunk = 1 << 22
+
+
+class PeriodicGrid(object):
+    """
+    A chained-mesh over the positions of galaxies in a periodic box of side ``box_size``.
+
+    The box is split into ``cells_per_dim``^3 cubic cells and the galaxies are sorted by their
+    cell.  The galaxies in cell ``c`` are ``sorted_idx[cell_start[c]:cell_start[c+1]]`` (with
+    positions ``sorted_pos[cell_start[c]:cell_start[c+1]]``).  Separations follow the minimum
+    image convention.
+
+    Use :py:func:`~build_periodic_grid` to build the grid from positions.
+    """
+
+    def __init__(self, sorted_pos, sorted_idx, cell_start, box_size, cells_per_dim):
+        """
+        Set up instance variables
+        """
+
+        self.sorted_pos = sorted_pos
+        self.sorted_idx = sorted_idx
+        self.cell_start = cell_start
+        self.box_size = float(box_size)
+        self.cells_per_dim = int(cells_per_dim)
+        self.cell_size = self.box_size / self.cells_per_dim
+
+
+    def __len__(self):
+        return len(self.sorted_idx)
+
+
+    def determine_cell_coords(self, points):
+        """
+        Returns the (integer) cell coordinates of each of the Nx3 ``points``.
+        """
+
+        coords = np.floor(np.asarray(points, dtype=np.float64) / self.cell_size).astype(np.int64)
+
+        return np.mod(coords, self.cells_per_dim)
+
+
+    def determine_cell_ids(self, coords):
+        return (coords[..., 0] * self.cells_per_dim + coords[..., 1]) * self.cells_per_dim \
+            + coords[..., 2]
+
+
+    def determine_reach(self, radius):
+        """
+        Returns the number of cells (along each dimension) that must be searched either side of
+        a cell to find every galaxy within ``radius`` of a point inside the cell.
+        """
+
+        return int(np.ceil(radius / self.cell_size))
+
+
+    def determine_neighbour_cells(self, coord, reach):
+        """
+        Returns the ids of the cells within ``reach`` cells of the cell at ``coord``, wrapping
+        around the periodic boundaries.  Each cell is returned once, even if ``reach`` spans the
+        entire box.
+        """
+
+        if 2 * reach + 1 >= self.cells_per_dim:
+            offsets = [np.arange(self.cells_per_dim)] * 3
+        else:
+            offsets = [np.mod(np.arange(c - reach, c + reach + 1), self.cells_per_dim)
+                       for c in coord]
+
+        coords = np.stack(np.meshgrid(*offsets, indexing="ij"), axis=-1).reshape(-1, 3)
+
+        return self.determine_cell_ids(coords)
+
+
+    def determine_candidates(self, cell_ids):
+        """
+        Returns the indices (into ``sorted_pos``) of all the galaxies in the cells ``cell_ids``.
+        """
+
+        starts = self.cell_start[cell_ids]
+        lengths = self.cell_start[cell_ids + 1] - starts
+
+        # Each galaxy index is the start of its cell plus its position within the cell.
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+    def determine_separations(self, points, candidates):
+        """
+        Returns the periodic separations between each of the Nx3 ``points`` and each of the
+        ``candidates`` (indices into ``sorted_pos``) as an NxM array.
+        """
+
+        delta = points[:, np.newaxis, :] - self.sorted_pos[candidates][np.newaxis, :, :]
+        delta -= self.box_size * np.round(delta / self.box_size)
+
+        return np.sqrt(np.sum(delta * delta, axis=-1))
+
+
+    def iter_query_cells(self, points):
+        """
+        Groups the Nx3 ``points`` by their cell, yielding the cell coordinates and the indices
+        of the points inside that cell.
+        """
+
+        coords = self.determine_cell_coords(points)
+        cell_ids = self.determine_cell_ids(coords)
+
+        order = np.argsort(cell_ids, kind="stable")
+        _, starts = np.unique(cell_ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        for start, end in zip(starts, ends):
+            yield coords[order[start]], order[start:end]
+
+
+    def query_radius(self, points, radius, return_distances=False):
+        """
+        Finds the galaxies within ``radius`` of each of the ``points`` (Nx3, or a single
+        point).
+
+        Returns a list with the galaxy indices (ordered by increasing separation) for each
+        point, or a single array if a single point was passed.  If ``return_distances`` is
+        ``True``, the separations are returned alongside.
+        """
+
+        points = np.asarray(points, dtype=np.float64)
+        is_single = points.ndim == 1
+        points = np.atleast_2d(points)
+
+        reach = self.determine_reach(radius)
+
+        indices = [None] * len(points)
+        distances = [None] * len(points)
+        for coord, query_idx in self.iter_query_cells(points):
+
+            candidates = self.determine_candidates(self.determine_neighbour_cells(coord, reach))
+            separations = self.determine_separations(points[query_idx], candidates)
+
+            for row, point_idx in enumerate(query_idx):
+                within = np.flatnonzero(separations[row] <= radius)
+                within = within[np.argsort(separations[row][within], kind="stable")]
+
+                indices[point_idx] = self.sorted_idx[candidates[within]]
+                distances[point_idx] = separations[row][within]
+
+        if is_single:
+            indices = indices[0]
+            distances = distances[0]
+
+        if return_distances:
+            return indices, distances
+
+        return indices
+
+
+    def query_knn(self, points, k):
+        """
+        Finds the ``k`` nearest galaxies of each of the ``points`` (Nx3, or a single point).
+
+        Returns the separations and the galaxy indices as two Nxk arrays (ordered by increasing
+        separation), or as two arrays of length ``k`` if a single point was passed.
+        """
+
+        if k > len(self):
+            msg = "Requested the {0} nearest neighbours but the grid only contains {1} "\
+                  "galaxies.".format(k, len(self))
+            raise ValueError(msg)
+
+        points = np.asarray(points, dtype=np.float64)
+        is_single = points.ndim == 1
+        points = np.atleast_2d(points)
+
+        knn_distances = np.empty((len(points), k), dtype=np.float64)
+        knn_indices = np.empty((len(points), k), dtype=np.int64)
+
+        for coord, query_idx in self.iter_query_cells(points):
+
+            # Grow the search until the kth neighbour of every point is closer than the
+            # distance out to which the searched cells are guaranteed to be complete.
+            reach = 1
+            while True:
+                candidates = self.determine_candidates(self.determine_neighbour_cells(coord,
+                                                                                     reach))
+                covers_box = 2 * reach + 1 >= self.cells_per_dim
+
+                if len(candidates) >= k:
+                    separations = self.determine_separations(points[query_idx], candidates)
+                    kth_separation = np.partition(separations, k - 1, axis=1)[:, k - 1]
+
+                    if covers_box or np.all(kth_separation <= reach * self.cell_size):
+                        break
+
+                reach += 1
+
+            nearest = np.argpartition(separations, k - 1, axis=1)[:, :k]
+            nearest_separations = np.take_along_axis(separations, nearest, axis=1)
+            order = np.argsort(nearest_separations, axis=1, kind="stable")
+
+            knn_distances[query_idx] = np.take_along_axis(nearest_separations, order, axis=1)
+            knn_indices[query_idx] = self.sorted_idx[candidates[np.take_along_axis(nearest,
+                                                                                  order,
+                                                                                  axis=1)]]
+
+        if is_single:
+            return knn_distances[0], knn_indices[0]
+
+        return knn_distances, knn_indices
+
+
+    def pair_counts(self, bins, points=None):
+        """
+        Counts the pairs of galaxies with separations inside each of the ``bins`` (the edges,
+        as for ``np.histogram``).
+
+        If ``points`` is ``None``, each unique pair of galaxies in the grid is counted once.
+        Otherwise, the (point, galaxy) pairs between the Nx3 ``points`` and the grid are
+        counted.
+        """
+
+        bins = np.asarray(bins, dtype=np.float64)
+        reach = self.determine_reach(bins[-1])
+        counts = np.zeros(len(bins) - 1, dtype=np.int64)
+
+        if points is not None:
+            points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+            for coord, query_idx in self.iter_query_cells(points):
+                candidates = self.determine_candidates(self.determine_neighbour_cells(coord,
+                                                                                     reach))
+                separations = self.determine_separations(points[query_idx], candidates)
+                counts += np.histogram(separations, bins=bins)[0]
+
+            return counts
+
+        # Rather than looping over the cells, shift the cell of every galaxy by each offset of
+        # the stencil in turn and pair it with all the galaxies of the shifted cell.  The
+        # offsets cover each neighbouring cell once, even if ``reach`` spans the entire box.
+        cells_per_dim = self.cells_per_dim
+        if 2 * reach + 1 >= cells_per_dim:
+            offsets_1d = np.arange(cells_per_dim)
+        else:
+            offsets_1d = np.arange(-reach, reach + 1)
+        offsets = np.stack(np.meshgrid(offsets_1d, offsets_1d, offsets_1d, indexing="ij"),
+                           axis=-1).reshape(-1, 3)
+
+        gal_cells = np.repeat(np.arange(len(self.cell_start) - 1), np.diff(self.cell_start))
+        gal_coords = np.stack([gal_cells // (cells_per_dim * cells_per_dim),
+                               (gal_cells // cells_per_dim) % cells_per_dim,
+                               gal_cells % cells_per_dim], axis=-1)
+        gal_idx = np.arange(len(self))
+
+        for offset in offsets:
+            neighbour_cells = self.determine_cell_ids(np.mod(gal_coords + offset, cells_per_dim))
+
+            # Only count each pair once (and never a galaxy with itself) by pairing each galaxy
+            # with the galaxies that come after it in ``sorted_pos``.
+            starts = np.maximum(self.cell_start[neighbour_cells], gal_idx + 1)
+            lengths = np.maximum(self.cell_start[neighbour_cells + 1] - starts, 0)
+
+            # Bound the memory by pairing at most ``max_pairs_per_chunk`` at once.
+            pair_ends = np.concatenate([[0], np.cumsum(lengths)])
+            first = 0
+            while first < len(self):
+                last = np.searchsorted(pair_ends, pair_ends[first] + max_pairs_per_chunk,
+                                       side="right") - 1
+                last = min(max(last, first + 1), len(self))
+
+                chunk_lengths = lengths[first:last]
+                chunk_offsets = np.cumsum(chunk_lengths) - chunk_lengths
+                members = np.repeat(gal_idx[first:last], chunk_lengths)
+                candidates = np.repeat(starts[first:last] - chunk_offsets, chunk_lengths) \
+                    + np.arange(chunk_lengths.sum())
+
+                delta = self.sorted_pos[members] - self.sorted_pos[candidates]
+                delta -= self.box_size * np.round(delta / self.box_size)
+                separations = np.sqrt(np.sum(delta * delta, axis=-1))
+                counts += np.histogram(separations, bins=bins)[0]
+
+                first = last
+
+        return counts
+
+
+def build_periodic_grid(pos, box_size, cells_per_dim=None):
+    """
+    Builds a :py:class:`~PeriodicGrid` over the Nx3 positions ``pos``.  Positions outside of
+    ``[0, box_size)`` are wrapped into the box.
+
+    If ``cells_per_dim`` is ``None``, it is chosen so that each cell holds roughly
+    ``num_gals_per_cell`` galaxies.
+    """
+
+    pos = np.mod(np.asarray(pos, dtype=np.float64).reshape(-1, 3), box_size)
+
+    if cells_per_dim is None:
+        cells_per_dim = int((len(pos) / float(num_gals_per_cell)) ** (1.0 / 3.0))
+        cells_per_dim = max(1, min(max_cells_per_dim, cells_per_dim))
+
+    grid = PeriodicGrid(None, None, None, box_size, cells_per_dim)
+
+    cell_ids = grid.determine_cell_ids(grid.determine_cell_coords(pos))
+    grid.sorted_idx = np.argsort(cell_ids, kind="stable")
+    grid.sorted_pos = pos[grid.sorted_idx]
+
+    counts = np.bincount(cell_ids, minlength=cells_per_dim ** 3)
+    grid.cell_start = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=grid.cell_start[1:])
+
+    return grid
+
+
+def determine_spatial_index_fname(reader, snap_key=None):
+    """
+    Returns the name of the cached spatial index of the catalog read by ``reader``.  The
+    index is saved next to the catalog.
+    """
+
+    if isinstance(reader, Hdf5Sage):
+        return "{0}.{1}.grid.npz".format(reader.filename, snap_key)
+
+    return "{0}.grid.npz".format(reader.filename)
+
+
+def determine_catalog_stamps(reader):
+    """
+    Returns the (modification time, size) of every file of the catalog read by ``reader``.
+    """
+
+    if isinstance(reader, Hdf5Sage):
+        return determine_hdf5_metadata_stamps(reader.filename, reader.metadata)
+
+    return determine_file_stamps([reader.determine_file_name(file_idx)
+                                  for file_idx in range(reader.num_files)])
+
+
+def read_positions(reader, snap_key=None, chunk_size=1000000):
+    """
+    Reads the positions of all the galaxies in the catalog read by ``reader``.  Only the
+    ``Pos`` field is copied into memory.
+    """
+
+    if isinstance(reader, Hdf5Sage):
+        return reader.read_field(snap_key, "Pos")
+
+    pos = [np.array(chunk["Pos"]) for _, chunk in reader.iter_memmap_chunks(chunk_size)]
+    if not pos:
+        return np.empty((0, 3), dtype=np.float32)
+
+    return np.concatenate(pos)
+
+
+def determine_box_size(reader=None, param_fname=None):
+    """
+    Returns the ``BoxSize`` from the parameter file ``param_fname`` or, for HDF5 catalogs,
+    from the header of the master file.  Raises a ``ValueError`` if neither is available
+    (binary catalogs, or HDF5 catalogs converted from binary).
+    """
+
+    if param_fname is not None:
+        return float(read_parameter_file(param_fname)["BoxSize"])
+
+    if isinstance(reader, Hdf5Sage):
+        header = reader.hdf5_file["Header"]
+        if "Simulation" in header and "box_size" in header["Simulation"].attrs:
+            return float(header["Simulation"].attrs["box_size"])
+
+        # Catalogs converted from binary (see ``sageconvert``) have no simulation parameters.
+        msg = "The header of '{0}' does not contain the box size.  It must be specified "\
+              "(either directly or through the parameter file).".format(reader.filename)
+        raise ValueError(msg)
+
+    msg = "The box size must be specified (either directly or through the parameter file) "\
+          "for binary catalogs."
+    raise ValueError(msg)
+
+
+def load_spatial_index(reader, snap=None, box_size=None, param_fname=None, cells_per_dim=None):
+    """
+    Returns the :py:class:`~PeriodicGrid` of the galaxies read by ``reader`` (a
+    ``BinarySage`` or, at snapshot ``snap``, a ``Hdf5Sage``).
+
+    The grid is cached next to the catalog (see :py:func:`~determine_spatial_index_fname`)
+    and rebuilt if the modification time or size of any catalog file has changed, or if a
+    different ``box_size`` or ``cells_per_dim`` is requested.  If the cache cannot be written,
+    the grid is rebuilt on every call.
+
+    The box size is either ``box_size``, the ``BoxSize`` in ``param_fname`` or (for HDF5
+    catalogs) taken from the header.
+    """
+
+    snap_key = None
+    if isinstance(reader, Hdf5Sage):
+        snap_key = reader.determine_snap_key(snap)
+
+    if box_size is None:
+        box_size = determine_box_size(reader, param_fname)
+
+    index_fname = determine_spatial_index_fname(reader, snap_key)
+    stamps = determine_catalog_stamps(reader)
+
+    try:
+        with np.load(index_fname) as cached:
+            if int(cached["version"]) == spatial_index_version and \
+               cached["stamps"].tolist() == stamps and \
+               float(cached["box_size"]) == box_size and \
+               (cells_per_dim is None or int(cached["cells_per_dim"]) == cells_per_dim):
+                return PeriodicGrid(cached["sorted_pos"], cached["sorted_idx"],
+                                    cached["cell_start"], cached["box_size"],
+                                    cached["cells_per_dim"])
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+
+    grid = build_periodic_grid(read_positions(reader, snap_key), box_size, cells_per_dim)
+
+    # Write to a temporary file first so that concurrent readers never see a partial index.
+    tmp_fname = "{0}.{1}.tmp".format(index_fname, os.getpid())
+    try:
+        with open(tmp_fname, "wb") as f:
+            np.savez(f, version=spatial_index_version, stamps=np.array(stamps),
+                     box_size=grid.box_size, cells_per_dim=grid.cells_per_dim,
+                     sorted_pos=grid.sorted_pos, sorted_idx=grid.sorted_idx,
+                     cell_start=grid.cell_start)
+        os.rename(tmp_fname, index_fname)
+    except (IOError, OSError):
+        pass
+
+    return grid
@@ -0,0 +1,736 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+
+from sagediff import BinarySage, Hdf5Sage, determine_binary_snapshots, \
+    find_binary_redshift_files, load_hdf5_metadata
+from sageutils import determine_file_stamps, lazy_import, read_parameter_file, run_tasks
+
+np = lazy_import("numpy")
+
+# The (start, stop, step) of the default stellar mass bins (log10 Msun).  These match the bins
+# used by ``sage_analysis``.
+stellar_mass_bin_range = (8.0, 12.0 + 0.1, 0.1)
+
+# The only galaxy fields needed for the histories.
+history_fields = ["StellarMass", "SfrDisk", "SfrBulge"]
+
+# Bump whenever the calculation of the histories changes so that cached results are not reused.
+history_version = 1
+
+# Cached results are stored here unless another directory is specified.
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "sage")
+
+# Least recently used results are evicted once the cache exceeds this many bytes.
+default_cache_max_size = 512 * 1024 * 1024
+
+
+class ResultCache(object):
+    """
+    An on-disk, content-addressed cache of computed results.
+
+    Each result is a JSON file named by its key (see :py:func:`~determine_history_cache_key`).
+    Reading a result marks it as recently used; once the cache exceeds ``max_size`` bytes, the
+    least recently used results are evicted.
+    """
+
+    def __init__(self, cache_dir=None, max_size=None):
+        """
+        Set up instance variables
+        """
+
+        if cache_dir is None:
+            cache_dir = default_cache_dir
+        if max_size is None:
+            max_size = default_cache_max_size
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+
+    def determine_fname(self, key):
+        return os.path.join(self.cache_dir, "{0}.json".format(key))
+
+
+    def get(self, key):
+        """
+        Returns the result cached under ``key``, or ``None`` if there is no such result.
+        """
+
+        fname = self.determine_fname(key)
+
+        try:
+            with open(fname, "r") as f:
+                result = json.load(f)
+            os.utime(fname, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return result
+
+
+    def put(self, key, result):
+        """
+        Caches the JSON serializable ``result`` under ``key`` and evicts the least recently
+        used results if the cache has grown too large.  Failing to write is not an error.
+        """
+
+        fname = self.determine_fname(key)
+        tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(tmp_fname, "w") as f:
+                json.dump(result, f)
+            os.rename(tmp_fname, fname)
+        except (IOError, OSError):
+            return
+
+        self.evict()
+
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache holds at most ``max_size``
+        bytes.
+        """
+
+        entries = []
+        for fname in glob.glob(os.path.join(self.cache_dir, "*.json")):
+            try:
+                stat = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+
+        total_size = sum(size for (_, size, _) in entries)
+        for (_, size, fname) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(fname)
+            except OSError:
+                continue
+            total_size -= size
+
+
+class HistoryAccumulator(object):
+    """
+    Partial sums for the stellar mass function (SMF), stellar mass density (SMD) and star
+    formation rate density (SFRD) at a single snapshot.
+
+    Accumulators of disjoint sets of galaxies (e.g., different files or chunks) are combined
+    with ``+``.  As this is associative and commutative, the files can be processed in any
+    order (and in parallel) and then merged.  Only the sums are kept, so memory does not grow
+    with the number of galaxies.
+    """
+
+    def __init__(self, hubble_h, bins=None):
+        """
+        Set up instance variables
+        """
+
+        if bins is None:
+            bins = np.arange(*stellar_mass_bin_range)
+
+        self.hubble_h = hubble_h
+        self.bins = np.asarray(bins, dtype=np.float64)
+        self.smf = np.zeros(len(self.bins) - 1, dtype=np.int64)
+        self.stellar_mass_sum = 0.0
+        self.sfr_sum = 0.0
+        self.num_gals = 0
+
+
+    def add_gals(self, gals):
+        """
+        Adds the galaxies ``gals`` (anything indexable by the field names in
+        ``history_fields``) to the sums.
+        """
+
+        stellar_mass = np.asarray(gals["StellarMass"])
+        stellar_mass = stellar_mass[stellar_mass > 0.0].astype(np.float64) * 1.0e10 / \
+            self.hubble_h
+
+        self.smf += np.histogram(np.log10(stellar_mass), bins=self.bins)[0]
+        self.stellar_mass_sum += np.sum(stellar_mass)
+        self.sfr_sum += np.sum(gals["SfrDisk"], dtype=np.float64) + \
+            np.sum(gals["SfrBulge"], dtype=np.float64)
+        self.num_gals += len(gals["StellarMass"])
+
+
+    def __add__(self, other):
+
+        if self.hubble_h != other.hubble_h or not np.array_equal(self.bins, other.bins):
+            msg = "Can only merge accumulators with the same 'hubble_h' and bins."
+            raise ValueError(msg)
+
+        merged = HistoryAccumulator(self.hubble_h, self.bins)
+        merged.smf = self.smf + other.smf
+        merged.stellar_mass_sum = self.stellar_mass_sum + other.stellar_mass_sum
+        merged.sfr_sum = self.sfr_sum + other.sfr_sum
+        merged.num_gals = self.num_gals + other.num_gals
+
+        return merged
+
+
+    def normalize(self, volume):
+        """
+        Returns the SMF (per dex), SMD and SFRD normalized by the ``volume`` (in (Mpc/h)^3)
+        that the galaxies were drawn from.
+        """
+
+        volume = volume / pow(self.hubble_h, 3)
+        bin_widths = self.bins[1:] - self.bins[:-1]
+
+        return {"SMF": self.smf / volume / bin_widths,
+                "SMD": self.stellar_mass_sum / volume,
+                "SFRD": self.sfr_sum / volume,
+                "num_gals": self.num_gals}
+
+
+    def to_dict(self):
+        """
+        Returns the sums as a JSON serializable dictionary (see
+        :py:func:`~accumulator_from_dict`).
+        """
+
+        return {"hubble_h": self.hubble_h,
+                "bins": self.bins.tolist(),
+                "smf": self.smf.tolist(),
+                "stellar_mass_sum": self.stellar_mass_sum,
+                "sfr_sum": self.sfr_sum,
+                "num_gals": self.num_gals}
+
+
+def accumulator_from_dict(sums):
+    """
+    Rebuilds the :py:class:`~HistoryAccumulator` saved by
+    :py:meth:`~HistoryAccumulator.to_dict`.
+    """
+
+    accumulator = HistoryAccumulator(sums["hubble_h"], sums["bins"])
+    accumulator.smf = np.array(sums["smf"], dtype=np.int64)
+    accumulator.stellar_mass_sum = sums["stellar_mass_sum"]
+    accumulator.sfr_sum = sums["sfr_sum"]
+    accumulator.num_gals = sums["num_gals"]
+
+    return accumulator
+
+
+def accumulate_binary_file(binary_fname, hubble_h, bins, chunk_size):
+    """
+    Returns the :py:class:`~HistoryAccumulator` of the galaxies in a single binary file.
+    Only ``history_fields`` are read, in chunks of ``chunk_size`` galaxies.
+    """
+
+    accumulator = HistoryAccumulator(hubble_h, bins)
+
+    g = BinarySage(binary_fname, memmap=True, fields=history_fields)
+    for gals in g.iter_gals(chunk_size):
+        accumulator.add_gals(gals)
+
+    return accumulator
+
+
+def accumulate_hdf5_core(hdf5_fname, core_idx, snap_key, hubble_h, bins, chunk_size):
+    """
+    Returns the :py:class:`~HistoryAccumulator` of the galaxies written by core ``core_idx``
+    at snapshot ``snap_key``.  Only ``history_fields`` are read, in chunks of ``chunk_size``
+    galaxies.
+    """
+
+    accumulator = HistoryAccumulator(hubble_h, bins)
+
+    with Hdf5Sage(hdf5_fname, fields=history_fields) as g:
+
+        num_gals = g.metadata["snapshots"][snap_key]["num_gals_per_core"][core_idx]
+        if num_gals == 0:
+            return accumulator
+
+        datasets = g.get_snap_datasets(snap_key, core_idx)
+
+        for start in range(0, num_gals, chunk_size):
+
+            num_gals_chunk = min(chunk_size, num_gals - start)
+
+            gals = {}
+            for key in history_fields:
+                gals[key] = g.allocate_field(snap_key, key, num_gals_chunk)
+                g.read_field_slice(datasets, key, start, num_gals_chunk, gals[key], 0)
+
+            accumulator.add_gals(gals)
+
+    return accumulator
+
+
+def determine_num_binary_files(binary_fname):
+    """
+    Returns the number of files that the binary catalog with 0th file ``binary_fname`` is
+    split over.  A catalog that is not split (i.e., without a file number) is a single file.
+    """
+
+    if not binary_fname.endswith("_0"):
+        return 1
+
+    return len([fname for fname in glob.glob("{0}_*".format(binary_fname[:-2]))
+                if fname[len(binary_fname) - 1:].isdigit()])
+
+
+def select_history_snapshots(snapshots, history_redshifts):
+    """
+    Returns the ``snapshots`` (a list of ``(snap_key, redshift, ...)``) closest to each of the
+    ``history_redshifts``, or all of them if ``history_redshifts`` is ``"All"``.
+    """
+
+    if history_redshifts == "All":
+        return list(snapshots)
+
+    redshifts = np.array([snapshot[1] for snapshot in snapshots])
+
+    selected = []
+    for redshift in history_redshifts:
+        snapshot = snapshots[np.abs(redshifts - redshift).argmin()]
+        if snapshot not in selected:
+            selected.append(snapshot)
+
+    return selected
+
+
+def determine_history_tasks(output_fname, output_format, hubble_h, history_redshifts="All",
+                            bins=None, num_files=None, chunk_size=1000000):
+    """
+    Splits the history calculation of the catalog ``output_fname`` (the model prefix for
+    ``sage_binary`` or the master file for ``sage_hdf5``) into one task per file and snapshot.
+
+    Returns a list of ``(snap_key, redshift, file_idx, func, args)``; ``func(*args)`` returns
+    the :py:class:`~HistoryAccumulator` of that file at that snapshot.
+    """
+
+    if bins is None:
+        bins = np.arange(*stellar_mass_bin_range)
+
+    tasks = []
+
+    if output_format == "sage_binary":
+
+        if num_files is None:
+            binary_fnames = find_binary_redshift_files(output_fname)
+            num_files = determine_num_binary_files(binary_fnames[0]) if binary_fnames else 1
+
+        snapshots = determine_binary_snapshots(output_fname, num_files, skip_empty=True)
+
+        for snap_key, redshift, binary_fnames in select_history_snapshots(snapshots,
+                                                                          history_redshifts):
+            for file_idx, binary_fname in binary_fnames:
+                tasks.append((snap_key, redshift, file_idx, accumulate_binary_file,
+                              (binary_fname, hubble_h, bins, chunk_size)))
+
+    elif output_format == "sage_hdf5":
+
+        # The snapshot keys are in the (lexicographic) order of the groups.  Sort them by
+        # redshift, as the binary files are, so that both formats give the same history.
+        with Hdf5Sage(output_fname) as g:
+            snapshots = sorted([(snap_key, g.metadata["snapshots"][snap_key]["redshift"])
+                                for snap_key in g.metadata["snap_keys"]],
+                               key=lambda snapshot: snapshot[1])
+            ncores = g.ncores
+
+        for snap_key, redshift in select_history_snapshots(snapshots, history_redshifts):
+            for core_idx in range(ncores):
+                tasks.append((snap_key, redshift, core_idx, accumulate_hdf5_core,
+                              (output_fname, core_idx, snap_key, hubble_h, bins, chunk_size)))
+
+    else:
+        msg = "Output format '{0}' is not supported. Use either 'sage_binary' or "\
+              "'sage_hdf5'.".format(output_format)
+        raise ValueError(msg)
+
+    return tasks
+
+
+def determine_catalog_fnames(output_fname, output_format, num_files=None):
+    """
+    Returns the name of every file of the catalog ``output_fname`` (see
+    :py:func:`~determine_history_tasks`) without reading any galaxies.
+    """
+
+    if output_format == "sage_hdf5":
+        metadata = load_hdf5_metadata(output_fname)
+        return [output_fname] + [os.path.join(os.path.dirname(output_fname), core_fname)
+                                 for core_fname in metadata["core_fnames"]]
+
+    fnames = []
+    for binary_fname in find_binary_redshift_files(output_fname):
+        num_files_this_redshift = num_files or determine_num_binary_files(binary_fname)
+        g = BinarySage(binary_fname, num_files=num_files_this_redshift)
+        fnames.extend(g.determine_file_name(file_idx)
+                      for file_idx in range(num_files_this_redshift))
+
+    return fnames
+
+
+def determine_history_cache_key(param_fname, model, history_redshifts, bins, num_files,
+                                incremental=False):
+    """
+    Returns the cache key of the histories of the model described by ``param_fname``.
+
+    The key is a hash of the contents of the parameter file, the modification time and size
+    of every catalog file, and the arguments of the calculation.
+
+    If ``incremental`` is ``True``, the catalog files are not part of the key.  This is the key
+    of the state of the incremental analysis (see :py:func:`~analyze_models`), which tracks
+    the catalog files itself.
+    """
+
+    with open(param_fname, "rb") as f:
+        param_contents = f.read()
+
+    if bins is None:
+        bins = np.arange(*stellar_mass_bin_range)
+
+    if history_redshifts != "All":
+        history_redshifts = [float(redshift) for redshift in history_redshifts]
+
+    description = {"calculation": "history",
+                   "version": history_version,
+                   "incremental": incremental,
+                   "history_redshifts": history_redshifts,
+                   "bins": np.asarray(bins, dtype=np.float64).tolist(),
+                   "num_files": num_files}
+
+    if not incremental:
+        catalog_fnames = determine_catalog_fnames(model["output_fname"],
+                                                  model["output_format"], num_files)
+        description["catalog_fnames"] = catalog_fnames
+        description["catalog_stamps"] = determine_file_stamps(catalog_fnames)
+
+    key = hashlib.sha256(param_contents)
+    key.update(json.dumps(description, sort_keys=True).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def determine_task_fname(model, task):
+    """
+    Returns the file read by the work unit ``task`` (see :py:func:`~determine_history_tasks`).
+    """
+
+    snap_key, _, file_idx, _, args = task
+
+    if model["output_format"] == "sage_hdf5":
+        core_fname = load_hdf5_metadata(model["output_fname"])["core_fnames"][file_idx]
+        return os.path.join(os.path.dirname(model["output_fname"]), core_fname)
+
+    return args[0]
+
+
+def _run_work_unit(func, args):
+    """
+    Runs a single work unit, returning its result and how long it took (in seconds).
+    """
+
+    start = time.time()
+    result = func(*args)
+
+    return result, time.time() - start
+
+
+def reduce_history(tasks, accumulators):
+    """
+    Merges the ``accumulators`` of the ``tasks`` (see :py:func:`~determine_history_tasks`)
+    into a list of ``(snap_key, redshift, HistoryAccumulator)``.
+
+    The accumulators are always merged in the order of ``tasks`` (rather than the order in
+    which they finished) so that the floating point sums are reproducible.
+    """
+
+    history = []
+    for (snap_key, redshift, _, _, _), accumulator in zip(tasks, accumulators):
+        if history and history[-1][0] == snap_key:
+            history[-1] = (snap_key, redshift, history[-1][2] + accumulator)
+        else:
+            history.append((snap_key, redshift, accumulator))
+
+    return history
+
+
+def compute_history(output_fname, output_format, hubble_h, history_redshifts="All", bins=None,
+                    num_files=None, chunk_size=1000000, num_workers=None):
+    """
+    Computes the SMF, SMD and SFRD histories of the catalog ``output_fname`` (see
+    :py:func:`~determine_history_tasks`).
+
+    Every file is processed at every snapshot by a pool of ``num_workers`` processes (defaults
+    to the number of CPUs) and the per-file accumulators are merged.  Returns a list of
+    ``(snap_key, redshift, HistoryAccumulator)`` ordered as the snapshots.
+    """
+
+    tasks = determine_history_tasks(output_fname, output_format, hubble_h, history_redshifts,
+                                    bins, num_files, chunk_size)
+
+    results = run_tasks(_run_work_unit, [(func, args) for (_, _, _, func, args) in tasks],
+                        num_workers)
+
+    return reduce_history(tasks, [accumulator for accumulator, _ in results])
+
+
+def read_model_parameters(param_fname):
+    """
+    Reads the location, format, ``Hubble_h`` and the volume of the model described by the
+    SAGE parameter file ``param_fname``.
+
+    The volume is the fraction of the box covered by the tree files that SAGE processed
+    (``FirstFile`` to ``LastFile`` out of ``NumSimulationTreeFiles``).
+    """
+
+    params = read_parameter_file(param_fname)
+
+    output_format = params["OutputFormat"]
+    output_fname = os.path.join(params["OutputDir"], params["FileNameGalaxies"])
+    if output_format == "sage_hdf5":
+        output_fname = "{0}.hdf5".format(output_fname)
+
+    frac_volume_processed = (int(params["LastFile"]) - int(params["FirstFile"]) + 1) / \
+        float(params["NumSimulationTreeFiles"])
+
+    return {"output_fname": output_fname,
+            "output_format": output_format,
+            "hubble_h": float(params["Hubble_h"]),
+            "volume": pow(float(params["BoxSize"]), 3) * frac_volume_processed}
+
+
+def analyze_models(param_fnames, history_redshifts="All", bins=None, num_files=None,
+                   chunk_size=1000000, num_workers=None, cache=None, incremental=False):
+    """
+    Computes the normalized SMF, SMD and SFRD histories of each model described by the SAGE
+    parameter files ``param_fnames``.
+
+    The work is split into (model, snapshot, file) units which are all fanned out over a
+    single pool of ``num_workers`` processes (defaults to the number of CPUs).  Each unit
+    returns its partial accumulator, which are then reduced in a deterministic order.
+
+    If ``cache`` (a :py:class:`~ResultCache`) is specified, the results of models whose
+    parameter file, catalog files and arguments are unchanged are taken from the cache without
+    reading any galaxies.  Newly computed results are added to the cache.
+
+    If ``incremental`` is also ``True``, the accumulator of every (snapshot, file) unit is
+    cached along with the modification time and size of its file.  Only the units whose file
+    is new or has changed since the last call are processed and merged with the cached
+    accumulators of the others.  This allows output directories to be analyzed while SAGE is
+    still writing them.
+
+    Returns the results of each model (a list of dictionaries with the ``snap_key``,
+    ``redshift``, ``SMF``, ``SMD`` and ``SFRD``) and the timing of each processed unit (a list
+    of ``(param_fname, snap_key, file_idx, seconds)``).
+    """
+
+    if incremental and cache is None:
+        msg = "The incremental analysis requires a cache."
+        raise ValueError(msg)
+
+    cached_results = {}
+    cache_keys = {}
+
+    models = []
+    units = []
+    for param_fname in param_fnames:
+
+        model = read_model_parameters(param_fname)
+
+        if cache is not None:
+            cache_keys[param_fname] = determine_history_cache_key(param_fname, model,
+                                                                  history_redshifts, bins,
+                                                                  num_files, incremental)
+
+        if cache is not None and not incremental:
+            results = cache.get(cache_keys[param_fname])
+            if results is not None:
+                for result in results:
+                    result["SMF"] = np.array(result["SMF"])
+                cached_results[param_fname] = results
+                continue
+
+        tasks = determine_history_tasks(model["output_fname"], model["output_format"],
+                                        model["hubble_h"], history_redshifts, bins,
+                                        num_files, chunk_size)
+
+        accumulators = [None] * len(tasks)
+        unit_keys = []
+        unit_stamps = []
+
+        if incremental:
+            state = cache.get(cache_keys[param_fname]) or {"units": {}}
+
+            for task_idx, task in enumerate(tasks):
+                unit_key = "{0}/{1}".format(task[0], task[2])
+                stamp = determine_file_stamps([determine_task_fname(model, task)])[0]
+
+                unit_state = state["units"].get(unit_key)
+                if unit_state is not None and unit_state["stamp"] == stamp:
+                    accumulators[task_idx] = accumulator_from_dict(unit_state["accumulator"])
+
+                unit_keys.append(unit_key)
+                unit_stamps.append(stamp)
+
+        pending = [task_idx for task_idx in range(len(tasks)) if accumulators[task_idx] is None]
+
+        models.append((param_fname, model, tasks, accumulators, unit_keys, unit_stamps,
+                       pending))
+        units.extend((tasks[task_idx][3], tasks[task_idx][4]) for task_idx in pending)
+
+    unit_results = run_tasks(_run_work_unit, units, num_workers)
+
+    computed_results = {}
+    timings = []
+    offset = 0
+    for param_fname, model, tasks, accumulators, unit_keys, unit_stamps, pending in models:
+
+        for task_idx in pending:
+            accumulator, seconds = unit_results[offset]
+            offset += 1
+
+            accumulators[task_idx] = accumulator
+            timings.append((param_fname, tasks[task_idx][0], tasks[task_idx][2], seconds))
+
+        history = reduce_history(tasks, accumulators)
+
+        results = []
+        for snap_key, redshift, accumulator in history:
+            result = accumulator.normalize(model["volume"])
+            result["snap_key"] = snap_key
+            result["redshift"] = redshift
+            results.append(result)
+        computed_results[param_fname] = results
+
+        if incremental:
+            if pending:
+                state = {"units": dict((unit_key, {"stamp": stamp,
+                                                   "accumulator": accumulator.to_dict()})
+                                       for unit_key, stamp, accumulator
+                                       in zip(unit_keys, unit_stamps, accumulators))}
+                cache.put(cache_keys[param_fname], state)
+        elif cache is not None:
+            cache.put(cache_keys[param_fname],
+                      [dict(result, SMF=result["SMF"].tolist()) for result in results])
+
+    results_per_model = [cached_results[param_fname] if param_fname in cached_results
+                         else computed_results[param_fname] for param_fname in param_fnames]
+
+    return results_per_model, timings
+
+
+def compute_history_from_parameter_file(param_fname, history_redshifts="All", bins=None,
+                                        num_files=None, chunk_size=1000000, num_workers=None,
+                                        cache=None, incremental=False):
+    """
+    Computes the normalized SMF, SMD and SFRD histories of the model described by the SAGE
+    parameter file ``param_fname`` (see :py:func:`~analyze_models`).
+    """
+
+    results_per_model, _ = analyze_models([param_fname], history_redshifts, bins, num_files,
+                                          chunk_size, num_workers, cache, incremental)
+
+    return results_per_model[0]
+
+
+def report_work_unit_timings(timings, num_slowest=5, straggler_factor=2.0):
+    """
+    Prints a summary of the work unit ``timings`` (see :py:func:`~analyze_models`) to stderr.
+    The ``num_slowest`` units are listed and units that took longer than ``straggler_factor``
+    times the median are flagged as stragglers.
+    """
+
+    if not timings:
+        return
+
+    seconds = np.array([timing[3] for timing in timings])
+    median = np.median(seconds)
+
+    print("Ran {0} work units taking {1:.3f} seconds in total (median {2:.3f}, max {3:.3f} "
+          "seconds).".format(len(timings), seconds.sum(), median, seconds.max()),
+          file=sys.stderr)
+
+    for idx in np.argsort(seconds, kind="stable")[::-1][:num_slowest]:
+        param_fname, snap_key, file_idx, unit_seconds = timings[idx]
+        flag = " (straggler)" if unit_seconds > straggler_factor * median else ""
+        print("  {0}: {1} file {2}: {3:.3f} seconds{4}".format(param_fname, snap_key, file_idx,
+                                                             unit_seconds, flag),
+              file=sys.stderr)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    description = "Compute the stellar mass function, stellar mass density and star "\
+                  "formation rate density histories of SAGE models in constant memory"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("param_fnames", metavar="PARAM_FILE", nargs="+",
+                        help="the SAGE parameter file of each model.")
+    parser.add_argument("--history_redshifts", metavar="REDSHIFT", nargs="+", default=["All"],
+                        help="the redshifts to compute the histories at (default: All).")
+    parser.add_argument("--num_files", metavar="NUM_FILES", type=int, default=None,
+                        help="for binary output, number of files each redshift is split over "
+                             "(default: determined from the files on disk).")
+    parser.add_argument("--chunk_size", metavar="CHUNK_SIZE", type=int, default=1000000,
+                        help="number of galaxies read at once.")
+    parser.add_argument("--num_workers", metavar="NUM_WORKERS", type=int, default=None,
+                        help="number of worker processes (default: the number of CPUs).")
+    parser.add_argument("--num_slowest", metavar="NUM", type=int, default=5,
+                        help="number of the slowest (model, snapshot, file) work units to "
+                             "report.")
+    parser.add_argument("--cache_dir", metavar="DIR", default=default_cache_dir,
+                        help="cache the histories in this directory (default: "
+                             "{0}).".format(default_cache_dir))
+    parser.add_argument("--cache_max_size", metavar="BYTES", type=int,
+                        default=default_cache_max_size,
+                        help="evict the least recently used histories once the cache exceeds "
+                             "this size (default: {0}).".format(default_cache_max_size))
+    parser.add_argument("--no_cache", action="store_true",
+                        help="always recompute the histories from the catalogs.")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only process the (snapshot, file) pairs that are new or have "
+                             "changed since the last call; useful while SAGE is still running.")
+    parser.add_argument("--output", metavar="FILE", default=None,
+                        help="save the histories to this JSON file.")
+
+    args = parser.parse_args()
+
+    history_redshifts = args.history_redshifts
+    if history_redshifts != ["All"]:
+        history_redshifts = [float(redshift) for redshift in history_redshifts]
+    else:
+        history_redshifts = "All"
+
+    cache = None
+    if not args.no_cache:
+        cache = ResultCache(args.cache_dir, args.cache_max_size)
+
+    results_per_model, timings = analyze_models(args.param_fnames, history_redshifts,
+                                                num_files=args.num_files,
+                                                chunk_size=args.chunk_size,
+                                                num_workers=args.num_workers, cache=cache,
+                                                incremental=args.incremental)
+
+    for param_fname, results in zip(args.param_fnames, results_per_model):
+        print(param_fname)
+        for result in results:
+            print("  {0} (z = {1:.3f}): {2} galaxies, SMD = {3:.4e}, SFRD = {4:.4e}"
+                  .format(result["snap_key"], result["redshift"], result["num_gals"],
+                          result["SMD"], result["SFRD"]))
+
+    report_work_unit_timings(timings, args.num_slowest)
+
+    if args.output is not None:
+        for results in results_per_model:
+            for result in results:
+                result["SMF"] = result["SMF"].tolist()
+        with open(args.output, "w") as f:
+            json.dump(dict(zip(args.param_fnames, results_per_model)), f, indent=4)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import glob
+import os
+
+from sageutils import lazy_import, read_parameter_file
+
+np = lazy_import("numpy")
+
+# The header of each forest timings file written by SAGE when compiled with
+# ``USE-FOREST-TIMING``.  Mirrors ``write_forest_timings()`` in ``sage.c``.
+timing_header_dtype = [("task", "<i4"),
+                       ("ntasks", "<i4"),
+                       ("nforests", "<i8"),
+                       ("task_seconds", "<f8")]
+
+# Each forest processed by the task.  Mirrors ``struct forest_timing`` in ``sage.c``.
+forest_timing_dtype = [("original_treenr", "<i8"),
+                       ("nhalos", "<i8"),
+                       ("filenr", "<i4"),
+                       ("ngals", "<i4"),
+                       ("seconds", "<f8")]
+
+# Forests that take longer than this fraction of the mean time of a task are flagged.  No
+# distribution of the forests over the tasks can balance the load much better than this.
+slow_forest_fraction = 0.1
+
+
+def determine_timing_fname(timing_prefix, task):
+    """
+    Returns the name of the forest timings file of ``task``.  As in ``sage.c``, this is
+    ``<OutputDir>/<FileNameGalaxies>_forest_timings_<task>``, with ``timing_prefix`` being
+    ``<OutputDir>/<FileNameGalaxies>``.
+    """
+
+    return "{0}_forest_timings_{1}".format(timing_prefix, task)
+
+
+def read_forest_timings(fname):
+    """
+    Reads the forest timings file ``fname``.
+
+    Returns the header (a dictionary with the ``task``, ``ntasks``, ``nforests`` and the wall
+    time of the task, ``task_seconds``) and the timings of each forest (a structured array of
+    ``forest_timing_dtype``).
+    """
+
+    with open(fname, "rb") as fp:
+        header = np.fromfile(fp, dtype=timing_header_dtype, count=1)
+        if len(header) != 1:
+            msg = "The forest timings file '{0}' is too small to hold a header.".format(fname)
+            raise ValueError(msg)
+        forests = np.fromfile(fp, dtype=forest_timing_dtype)
+
+    header = {name: header[name][0].item() for name in header.dtype.names}
+    if len(forests) != header["nforests"]:
+        msg = "The forest timings file '{0}' should hold {1} forests but it holds {2}."\
+              .format(fname, header["nforests"], len(forests))
+        raise ValueError(msg)
+
+    return header, forests
+
+
+def read_run_timings(timing_prefix):
+    """
+    Reads the forest timings files of every task of the SAGE run whose output is named
+    ``timing_prefix`` (see :py:func:`~determine_timing_fname`).
+
+    Tasks that were assigned no forests do not write a file.  They are included with no
+    forests and no time.
+
+    Returns the wall time of each task, ``task_seconds``, and the timings of every forest,
+    ``forests``, with an additional ``task`` field.
+    """
+
+    fnames = glob.glob(determine_timing_fname(timing_prefix, "*"))
+    if not fnames:
+        msg = "Could not find any forest timings files named '{0}'. Was SAGE compiled with "\
+              "USE-FOREST-TIMING?".format(determine_timing_fname(timing_prefix, "<task>"))
+        raise ValueError(msg)
+
+    header, _ = read_forest_timings(fnames[0])
+    ntasks = header["ntasks"]
+
+    task_seconds = np.zeros(ntasks)
+    task_forests = []
+    for task in range(ntasks):
+        fname = determine_timing_fname(timing_prefix, task)
+        if not os.path.exists(fname):
+            continue
+
+        header, forests = read_forest_timings(fname)
+        if header["task"] != task or header["ntasks"] != ntasks:
+            msg = "The forest timings file '{0}' was written by task {1} of {2}, but task {3} "\
+                  "of {4} was expected.".format(fname, header["task"], header["ntasks"], task,
+                                               ntasks)
+            raise ValueError(msg)
+
+        task_seconds[task] = header["task_seconds"]
+        task_forests.append((task, forests))
+
+    all_forests = np.empty(sum(len(forests) for _, forests in task_forests),
+                           dtype=forest_timing_dtype + [("task", "<i4")])
+    offset = 0
+    for task, forests in task_forests:
+        for name in forests.dtype.names:
+            all_forests[name][offset:offset + len(forests)] = forests[name]
+        all_forests["task"][offset:offset + len(forests)] = task
+        offset += len(forests)
+
+    return {"task_seconds": task_seconds,
+            "forests": all_forests}
+
+
+def summarize_task_imbalance(timings):
+    """
+    Summarizes the load of each task of the ``timings`` (see :py:func:`~read_run_timings`).
+
+    Returns the number of forests, halos and galaxies, the time spent processing forests and
+    the wall time of each task, along with the ``imbalance`` (the maximum wall time over the
+    mean wall time; 1 is perfectly balanced).
+    """
+
+    forests = timings["forests"]
+    task_seconds = timings["task_seconds"]
+    ntasks = len(task_seconds)
+
+    summary = {"nforests": np.bincount(forests["task"], minlength=ntasks),
+               "nhalos": np.bincount(forests["task"], forests["nhalos"], minlength=ntasks),
+               "ngals": np.bincount(forests["task"], forests["ngals"], minlength=ntasks),
+               "forest_seconds": np.bincount(forests["task"], forests["seconds"],
+                                             minlength=ntasks),
+               "task_seconds": task_seconds}
+
+    mean_seconds = task_seconds.mean()
+    summary["imbalance"] = task_seconds.max() / mean_seconds if mean_seconds > 0 else 1.0
+
+    return summary
+
+
+def compute_cost_against_size(forests, num_bins=10):
+    """
+    Bins the ``forests`` (see :py:func:`~read_run_timings`) logarithmically by their number of
+    halos and returns the edges of the bins, ``nhalos_edges``, and the number of forests,
+    ``nforests``, the total time, ``seconds``, and the mean time per halo,
+    ``seconds_per_halo``, of each bin.
+
+    Also returns the ``exponent`` of the power law fit of the time against the number of
+    halos.  This is the natural choice of ``ExponentForestDistributionScheme`` when the
+    forests are distributed with ``ForestDistributionScheme = exponent_in_nhalos``.
+    """
+
+    nhalos = forests["nhalos"]
+    seconds = forests["seconds"]
+
+    if len(forests) == 0:
+        nhalos_edges = np.array([1.0, 2.0])
+    else:
+        nhalos_edges = np.logspace(0.0, np.log10(nhalos.max() + 1.0), num_bins + 1)
+    bin_idx = np.clip(np.digitize(nhalos, nhalos_edges) - 1, 0, len(nhalos_edges) - 2)
+
+    cost = {"nhalos_edges": nhalos_edges,
+            "nforests": np.bincount(bin_idx, minlength=len(nhalos_edges) - 1),
+            "seconds": np.bincount(bin_idx, seconds, minlength=len(nhalos_edges) - 1)}
+
+    bin_nhalos = np.bincount(bin_idx, nhalos, minlength=len(nhalos_edges) - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cost["seconds_per_halo"] = np.where(bin_nhalos > 0, cost["seconds"] / bin_nhalos, 0.0)
+
+    # The timer resolution is a microsecond, so forests that took less are not fit.
+    w = (nhalos > 0) & (seconds > 1e-6)
+    if w.sum() > 1 and len(np.unique(nhalos[w])) > 1:
+        cost["exponent"] = np.polyfit(np.log10(nhalos[w]), np.log10(seconds[w]), 1)[0]
+    else:
+        cost["exponent"] = np.nan
+
+    return cost
+
+
+def find_slowest_forests(timings, num_slowest=10):
+    """
+    Returns the ``num_slowest`` slowest forests of the ``timings`` (see
+    :py:func:`~read_run_timings`), slowest first, and whether each is slow enough to limit the
+    load balance (see ``slow_forest_fraction``).
+    """
+
+    forests = timings["forests"]
+    slowest = forests[np.argsort(forests["seconds"], kind="stable")[::-1][:num_slowest]]
+
+    is_flagged = slowest["seconds"] > slow_forest_fraction * timings["task_seconds"].mean()
+
+    return slowest, is_flagged
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    description = "Summarize the per-forest timings written by SAGE when compiled with "\
+                  "USE-FOREST-TIMING: the load imbalance across the (MPI) tasks, the cost of "\
+                  "the forests against their size and the slowest forests"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("param_fname", metavar="PARAM_FILE",
+                        help="the SAGE parameter file of the run. The timings are located using "
+                             "its OutputDir and FileNameGalaxies.")
+    parser.add_argument("--num_bins", metavar="NUM_BINS", type=int, default=10,
+                        help="number of bins in forest size (default: 10).")
+    parser.add_argument("--num_slowest", metavar="NUM_SLOWEST", type=int, default=10,
+                        help="number of slowest forests listed (default: 10).")
+
+    args = parser.parse_args()
+
+    params = read_parameter_file(args.param_fname)
+    timing_prefix = os.path.join(params["OutputDir"], params["FileNameGalaxies"])
+
+    timings = read_run_timings(timing_prefix)
+    forests = timings["forests"]
+
+    summary = summarize_task_imbalance(timings)
+    print("Read the timings of {0} forests from {1} tasks.".format(len(forests),
+                                                                   len(summary["task_seconds"])))
+
+    print("{0:>6} {1:>10} {2:>12} {3:>12} {4:>12} {5:>12}".format(
+        "task", "nforests", "nhalos", "ngals", "forest_sec", "task_sec"))
+    for task in range(len(summary["task_seconds"])):
+        print("{0:>6} {1:>10} {2:>12} {3:>12} {4:>12.3f} {5:>12.3f}".format(
+            task, summary["nforests"][task], int(summary["nhalos"][task]),
+            int(summary["ngals"][task]), summary["forest_seconds"][task],
+            summary["task_seconds"][task]))
+    print("Load imbalance (max / mean task time): {0:.3f}".format(summary["imbalance"]))
+
+    cost = compute_cost_against_size(forests, args.num_bins)
+    print("")
+    print("{0:>22} {1:>10} {2:>12} {3:>16}".format("nhalos", "nforests", "seconds",
+                                                   "seconds_per_halo"))
+    for bin_idx in range(len(cost["nforests"])):
+        if cost["nforests"][bin_idx] == 0:
+            continue
+        print("{0:>10.0f} - {1:>9.0f} {2:>10} {3:>12.3f} {4:>16.3e}".format(
+            cost["nhalos_edges"][bin_idx], cost["nhalos_edges"][bin_idx + 1],
+            cost["nforests"][bin_idx], cost["seconds"][bin_idx],
+            cost["seconds_per_halo"][bin_idx]))
+    print("The time scales as nhalos^{0:.2f} (try 'ForestDistributionScheme "
+          "exponent_in_nhalos' with this ExponentForestDistributionScheme)."
+          .format(cost["exponent"]))
+
+    slowest, is_flagged = find_slowest_forests(timings, args.num_slowest)
+    print("")
+    print("{0:>6} {1:>8} {2:>12} {3:>12} {4:>10} {5:>12}".format(
+        "task", "filenr", "treenr", "nhalos", "ngals", "seconds"))
+    for forest, flagged in zip(slowest, is_flagged):
+        print("{0:>6} {1:>8} {2:>12} {3:>12} {4:>10} {5:>12.4f}{6}".format(
+            forest["task"], forest["filenr"], forest["original_treenr"], forest["nhalos"],
+            forest["ngals"], forest["seconds"], " *" if flagged else ""))
+
+    if is_flagged.any():
+        print("* Takes more than {0:.0%} of the mean task time. Splitting the work across more "
+              "tasks cannot balance the load much better than this forest allows."
+              .format(slow_forest_fraction))
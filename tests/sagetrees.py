@@ -0,0 +1,431 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+
+from sageutils import lazy_import, read_parameter_file, run_tasks
+
+np = lazy_import("numpy")
+
+# The halo structure of the LHalo binary trees.  Mirrors ``struct halo_data`` in
+# ``core_simulation.h`` (``Mvir`` is a union with ``M200c``).
+halo_desc = [
+    ("Descendant"                   , "<i4"),
+    ("FirstProgenitor"              , "<i4"),
+    ("NextProgenitor"               , "<i4"),
+    ("FirstHaloInFOFgroup"          , "<i4"),
+    ("NextHaloInFOFgroup"           , "<i4"),
+    ("Len"                          , "<i4"),
+    ("M_Mean200"                    , "<f4"),
+    ("Mvir"                         , "<f4"),
+    ("M_TopHat"                     , "<f4"),
+    ("Pos"                          , ("<f4", 3)),
+    ("Vel"                          , ("<f4", 3)),
+    ("VelDisp"                      , "<f4"),
+    ("Vmax"                         , "<f4"),
+    ("Spin"                         , ("<f4", 3)),
+    ("MostBoundID"                  , "<i8"),
+    ("SnapNum"                      , "<i4"),
+    ("FileNr"                       , "<i4"),
+    ("SubhaloIndex"                 , "<i4"),
+    ("SubHalfMass"                  , "<f4"),
+    ]
+
+# ``sizeof(struct halo_data)``.
+halo_data_size = 104
+
+# Each entry of the forest index describes where a single forest lives on disk.
+forest_index_dtype = [("file_idx", "<i4"),
+                      ("byte_offset", "<i8"),
+                      ("nhalos", "<i4")]
+
+# The merger tree pointers.  Each is the index of a halo within its forest, or -1.
+halo_pointer_fields = ["Descendant", "FirstProgenitor", "NextProgenitor",
+                       "FirstHaloInFOFgroup", "NextHaloInFOFgroup"]
+
+
+def determine_halo_dtype():
+    """
+    Returns the numpy dtype of ``struct halo_data``.
+    """
+
+    dtype = np.dtype(halo_desc, align=True)
+
+    if dtype.itemsize != halo_data_size:
+        msg = "The size of the halo dtype ({0} bytes) does not match the size of "\
+              "'struct halo_data' ({1} bytes).".format(dtype.itemsize, halo_data_size)
+        raise ValueError(msg)
+
+    return dtype
+
+
+def read_lhalo_header(fname):
+    """
+    Reads the header of the LHalo binary tree file ``fname``.
+
+    Returns the number of halos in each forest and the size (in bytes) of the header.  As in
+    ``read_tree_lhalo_binary.c``, the header is the number of forests, the total number of
+    halos and then the number of halos in each forest (all 32-bit integers).
+    """
+
+    with open(fname, "rb") as fp:
+        nforests, totnhalos = np.fromfile(fp, dtype=np.int32, count=2)
+        nhalos_per_forest = np.fromfile(fp, dtype=np.int32, count=nforests)
+
+    if len(nhalos_per_forest) != nforests or nhalos_per_forest.sum() != totnhalos:
+        msg = "The header of '{0}' is corrupt. It has {1} forests with {2} halos in total "\
+              "but the number of halos per forest sums to {3}."\
+              .format(fname, nforests, totnhalos, nhalos_per_forest.sum())
+        raise ValueError(msg)
+
+    header_size = 4 + 4 + 4 * int(nforests)
+
+    return nhalos_per_forest, header_size
+
+
+class LHaloTrees(object):
+    """
+    Reads the LHalo binary merger trees (``<SimulationDir>/<TreeName>.N``) used as input by
+    SAGE.
+
+    The files are memory-mapped, so forests are only read from disk when accessed.  Forests
+    are numbered consecutively across all the files, in the same order as SAGE.
+    """
+
+
+    def __init__(self, tree_prefix, num_files=1, first_file=0, tree_extension=""):
+        """
+        Set up instance variables
+
+        ``tree_prefix`` is ``<SimulationDir>/<TreeName>``.  The files ``first_file`` to
+        ``first_file + num_files - 1`` are read.
+        """
+
+        self.tree_prefix = tree_prefix
+        self.num_files = num_files
+        self.first_file = first_file
+        self.tree_extension = tree_extension
+        self.dtype = determine_halo_dtype()
+        self.forest_index = None
+        self.nhalos_per_file = None
+        self.header_size_per_file = None
+        self.forest_offsets_per_file = None
+        self._file_halos = {}
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        """
+        Releases the memory-maps of the files.
+        """
+        self._file_halos = {}
+
+
+    def determine_file_name(self, file_idx):
+        """
+        Returns the name of the ``file_idx``'th file read, following
+        ``get_forests_filename_lht_binary``.
+        """
+        return "{0}.{1}{2}".format(self.tree_prefix, self.first_file + file_idx,
+                                   self.tree_extension)
+
+
+    def update_metadata(self):
+        """
+        Reads the header of every file and builds the forest index, ``self.forest_index``
+        (see ``forest_index_dtype``).  It maps each global forest number to the file it is in,
+        the byte offset of its first halo and its number of halos.
+        """
+
+        forest_index = []
+        self.nhalos_per_file = np.zeros(self.num_files, dtype=np.int64)
+        self.header_size_per_file = np.zeros(self.num_files, dtype=np.int64)
+        self.forest_offsets_per_file = np.zeros(self.num_files + 1, dtype=np.int64)
+
+        for file_idx in range(self.num_files):
+
+            nhalos_per_forest, header_size = read_lhalo_header(self.determine_file_name(file_idx))
+
+            index_this_file = np.empty(len(nhalos_per_forest), dtype=forest_index_dtype)
+            index_this_file["file_idx"] = file_idx
+            index_this_file["nhalos"] = nhalos_per_forest
+            index_this_file["byte_offset"] = header_size + self.dtype.itemsize * \
+                (np.cumsum(nhalos_per_forest, dtype=np.int64) - nhalos_per_forest)
+
+            forest_index.append(index_this_file)
+            self.nhalos_per_file[file_idx] = nhalos_per_forest.sum(dtype=np.int64)
+            self.header_size_per_file[file_idx] = header_size
+            self.forest_offsets_per_file[file_idx + 1] = \
+                self.forest_offsets_per_file[file_idx] + len(nhalos_per_forest)
+
+        self.forest_index = np.concatenate(forest_index)
+
+
+    @property
+    def num_forests(self):
+        if self.forest_index is None:
+            self.update_metadata()
+        return len(self.forest_index)
+
+
+    def memmap_file(self, file_idx):
+        """
+        Returns a read-only, memory-mapped view of all the halos in the ``file_idx``'th file.
+        The memory-map is kept open until :py:meth:`~close` is called.
+        """
+
+        if self.forest_index is None:
+            self.update_metadata()
+
+        if file_idx not in self._file_halos:
+            nhalos = int(self.nhalos_per_file[file_idx])
+            if nhalos == 0:
+                halos = np.empty(0, dtype=self.dtype)
+            else:
+                halos = np.memmap(self.determine_file_name(file_idx), dtype=self.dtype,
+                                  mode="r", offset=int(self.header_size_per_file[file_idx]),
+                                  shape=(nhalos,))
+            self._file_halos[file_idx] = halos
+
+        return self._file_halos[file_idx]
+
+
+    def read_forest(self, forestnr):
+        """
+        Returns a read-only view of the halos of the global forest number ``forestnr``.  The
+        tree pointers (e.g., ``Descendant``) index into the returned array.
+        """
+
+        if forestnr < 0 or forestnr >= self.num_forests:
+            msg = "The requested forest number = {0} should be within [0, {1})"\
+                .format(forestnr, self.num_forests)
+            raise ValueError(msg)
+
+        file_idx, byte_offset, nhalos = self.forest_index[forestnr]
+        start = (int(byte_offset) - int(self.header_size_per_file[file_idx])) // \
+            self.dtype.itemsize
+
+        return self.memmap_file(int(file_idx))[start:start+int(nhalos)]
+
+
+    def read_forests(self, forestnrs):
+        """
+        Reads (copies) the halos of the global forest numbers ``forestnrs``, in that order.
+
+        Returns the halos and the offset of each forest within them.  The tree pointers are
+        left as indices within each forest.
+        """
+
+        forestnrs = np.atleast_1d(np.asarray(forestnrs, dtype=np.int64))
+        forests = [self.read_forest(forestnr) for forestnr in forestnrs]
+
+        nhalos = np.array([len(forest) for forest in forests], dtype=np.int64)
+        forest_offsets = np.cumsum(nhalos) - nhalos
+
+        if not forests:
+            return np.empty(0, dtype=self.dtype), forest_offsets
+
+        return np.concatenate(forests), forest_offsets
+
+
+    def iter_forests(self):
+        """
+        Iterates over every forest, yielding ``(forestnr, halos)`` where ``halos`` is a
+        read-only view of the forest.
+        """
+
+        for forestnr in range(self.num_forests):
+            yield forestnr, self.read_forest(forestnr)
+
+
+    def compute_snapshot_statistics(self, chunk_size=1000000, num_workers=None):
+        """
+        Computes the halo statistics at each snapshot (see
+        :py:func:`~compute_file_snapshot_statistics`) across all the files.
+
+        The files are processed in parallel by ``num_workers`` processes (defaults to the
+        number of CPUs).  Each process holds at most ``chunk_size`` halos in memory.
+        """
+
+        tasks = [(self.determine_file_name(file_idx), chunk_size)
+                 for file_idx in range(self.num_files)]
+        file_stats = run_tasks(compute_file_snapshot_statistics, tasks, num_workers)
+
+        return merge_snapshot_statistics(file_stats)
+
+
+def iter_forest_chunks(nhalos_per_forest, chunk_size):
+    """
+    Splits the forests with ``nhalos_per_forest`` halos into chunks of consecutive forests
+    holding at most ``chunk_size`` halos (a larger forest gets a chunk of its own).  Yields
+    ``(first_forest, last_forest + 1)``.
+    """
+
+    halo_offsets = np.cumsum(nhalos_per_forest, dtype=np.int64)
+
+    first_forest = 0
+    while first_forest < len(nhalos_per_forest):
+        start = halo_offsets[first_forest] - nhalos_per_forest[first_forest]
+        end_forest = np.searchsorted(halo_offsets, start + chunk_size, side="right")
+        end_forest = max(end_forest, first_forest + 1)
+
+        yield first_forest, end_forest
+        first_forest = end_forest
+
+
+def compute_file_snapshot_statistics(fname, chunk_size=1000000):
+    """
+    Computes the halo statistics at each snapshot of the LHalo binary tree file ``fname``.
+
+    Returns a dictionary of arrays indexed by the snapshot number:
+
+    * ``num_halos``: the number of halos.
+    * ``num_fof_groups``: the number of FoF groups, i.e., halos that are the first halo of
+      their FoF group.
+    * ``num_particles``: the summed ``Len``.
+    * ``Mvir_sum`` and ``Mvir_max``: the summed and the largest ``Mvir`` (1e10 Msun/h).
+    * ``num_bad_pointers``: the number of tree pointers that lie outside their forest.
+
+    The file is processed in forest-aligned chunks of at most ``chunk_size`` halos.
+    """
+
+    nhalos_per_forest, header_size = read_lhalo_header(fname)
+    totnhalos = int(nhalos_per_forest.sum(dtype=np.int64))
+
+    stats = {"num_halos": np.zeros(0, dtype=np.int64),
+             "num_fof_groups": np.zeros(0, dtype=np.int64),
+             "num_particles": np.zeros(0, dtype=np.int64),
+             "Mvir_sum": np.zeros(0, dtype=np.float64),
+             "Mvir_max": np.zeros(0, dtype=np.float64),
+             "num_bad_pointers": np.zeros(0, dtype=np.int64)}
+
+    if totnhalos == 0:
+        return stats
+
+    halos = np.memmap(fname, dtype=determine_halo_dtype(), mode="r", offset=header_size,
+                      shape=(totnhalos,))
+    forest_offsets = np.cumsum(nhalos_per_forest, dtype=np.int64) - nhalos_per_forest
+
+    for first_forest, end_forest in iter_forest_chunks(nhalos_per_forest, chunk_size):
+
+        start = forest_offsets[first_forest]
+        chunk_nhalos = nhalos_per_forest[first_forest:end_forest]
+        chunk = halos[start:start+chunk_nhalos.sum(dtype=np.int64)]
+
+        # The index of each halo within its forest, which is what the tree pointers refer to.
+        nhalos = np.repeat(chunk_nhalos.astype(np.int64), chunk_nhalos)
+        local_idx = np.arange(len(chunk)) - np.repeat(forest_offsets[first_forest:end_forest] -
+                                                      start, chunk_nhalos)
+
+        snap_num = np.asarray(chunk["SnapNum"], dtype=np.int64)
+        num_snaps = int(snap_num.max()) + 1
+        mvir = np.asarray(chunk["Mvir"], dtype=np.float64)
+
+        bad_pointers = np.zeros(len(chunk), dtype=np.int64)
+        for field in halo_pointer_fields:
+            pointer = chunk[field]
+            bad_pointers += (pointer < -1) | (pointer >= nhalos)
+
+        mvir_max = np.full(num_snaps, -np.inf)
+        np.maximum.at(mvir_max, snap_num, mvir)
+
+        chunk_stats = {"num_halos": np.bincount(snap_num, minlength=num_snaps),
+                       "num_fof_groups": np.bincount(
+                           snap_num[chunk["FirstHaloInFOFgroup"] == local_idx],
+                           minlength=num_snaps),
+                       "num_particles": np.bincount(snap_num, weights=chunk["Len"],
+                                                    minlength=num_snaps).astype(np.int64),
+                       "Mvir_sum": np.bincount(snap_num, weights=mvir, minlength=num_snaps),
+                       "Mvir_max": mvir_max,
+                       "num_bad_pointers": np.bincount(snap_num, weights=bad_pointers,
+                                                       minlength=num_snaps).astype(np.int64)}
+
+        stats = merge_snapshot_statistics([stats, chunk_stats])
+
+    return stats
+
+
+def merge_snapshot_statistics(all_stats):
+    """
+    Merges the per-snapshot statistics (see :py:func:`~compute_file_snapshot_statistics`) of
+    several files or chunks.  The statistics may span a different number of snapshots.
+    """
+
+    num_snaps = max(len(stats["num_halos"]) for stats in all_stats)
+
+    merged = {}
+    for key in all_stats[0]:
+        fill_value = -np.inf if key == "Mvir_max" else 0
+        merged[key] = np.full(num_snaps, fill_value, dtype=all_stats[0][key].dtype)
+
+        for stats in all_stats:
+            values = stats[key]
+            if key == "Mvir_max":
+                merged[key][:len(values)] = np.maximum(merged[key][:len(values)], values)
+            else:
+                merged[key][:len(values)] += values
+
+    return merged
+
+
+def load_trees_from_parameter_file(param_fname):
+    """
+    Returns a :py:class:`~LHaloTrees` reading all ``NumSimulationTreeFiles`` tree files of the
+    SAGE parameter file ``param_fname``.
+    """
+
+    params = read_parameter_file(param_fname)
+
+    tree_type = params.get("TreeType", "lhalo_binary")
+    if tree_type != "lhalo_binary":
+        msg = "Only 'lhalo_binary' trees can be read. The parameter file '{0}' uses '{1}' "\
+              "trees.".format(param_fname, tree_type)
+        raise ValueError(msg)
+
+    tree_prefix = os.path.join(params["SimulationDir"], params["TreeName"])
+
+    return LHaloTrees(tree_prefix, int(params["NumSimulationTreeFiles"]))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    description = "Summarize the halos at each snapshot of the LHalo binary trees used as "\
+                  "input by SAGE"
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("param_fname", metavar="PARAM_FILE",
+                        help="the SAGE parameter file. The trees are located using its "
+                             "SimulationDir, TreeName and NumSimulationTreeFiles.")
+    parser.add_argument("--chunk_size", metavar="CHUNK_SIZE", type=int, default=1000000,
+                        help="number of halos read at once.")
+    parser.add_argument("--num_workers", metavar="NUM_WORKERS", type=int, default=None,
+                        help="number of worker processes (default: the number of CPUs).")
+
+    args = parser.parse_args()
+
+    trees = load_trees_from_parameter_file(args.param_fname)
+    print("Read {0} forests from {1} files.".format(trees.num_forests, trees.num_files))
+
+    stats = trees.compute_snapshot_statistics(args.chunk_size, args.num_workers)
+
+    print("{0:>5} {1:>12} {2:>12} {3:>14} {4:>12} {5:>12} {6:>8}".format(
+        "snap", "num_halos", "num_fof", "num_particles", "Mvir_sum", "Mvir_max", "bad_ptr"))
+    for snap_num in range(len(stats["num_halos"])):
+        if stats["num_halos"][snap_num] == 0:
+            continue
+        print("{0:>5} {1:>12} {2:>12} {3:>14} {4:>12.4e} {5:>12.4e} {6:>8}".format(
+            snap_num, stats["num_halos"][snap_num], stats["num_fof_groups"][snap_num],
+            stats["num_particles"][snap_num], stats["Mvir_sum"][snap_num],
+            stats["Mvir_max"][snap_num], stats["num_bad_pointers"][snap_num]))
+
+    if stats["num_bad_pointers"].sum() > 0:
+        print("Found {0} tree pointers that lie outside their forest."
+              .format(stats["num_bad_pointers"].sum()))
@@ -0,0 +1,104 @@
+import os
+import sys
+
+
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported on first attribute access.  Importing
+    ``numpy`` (and ``h5py``) dominates the start-up time of the scripts in this directory, so
+    they are deferred until a catalog is actually read.  This keeps ``--help`` and calls that
+    only touch the cached metadata fast.
+    """
+
+    def __init__(self, name):
+        """
+        Set up instance variables
+        """
+        self._name = name
+        self._module = None
+
+
+    def __getattr__(self, attr):
+
+        if self._module is None:
+            import importlib
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+def lazy_import(name):
+    """
+    Returns a :py:class:`~LazyModule` for the module ``name``.  If the module has already been
+    imported, the module itself is returned.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    return LazyModule(name)
+
+
+def read_parameter_file(fname):
+    """
+    Reads the SAGE parameter file ``fname`` and returns a dictionary of the (string) values
+    keyed by the parameter name.  The parsing follows ``core_read_parameter_file.c``: lines
+    starting with ``%`` are skipped and anything after a ``%``, ``;`` or ``#`` is a comment.
+    The list of output snapshots (the line starting with ``->``) is returned under
+    ``"ListOutputSnaps"``.
+    """
+
+    params = {}
+
+    with open(fname, "r") as f:
+        for line in f:
+
+            parts = line.split(None, 1)
+            if len(parts) < 2 or parts[0].startswith("%"):
+                continue
+
+            tag, value = parts
+            for comment_char in ["%", ";", "#"]:
+                value = value.split(comment_char)[0]
+            value = value.strip()
+
+            if tag == "->":
+                tag = "ListOutputSnaps"
+            elif tag.startswith("-"):
+                continue
+
+            params[tag] = value
+
+    return params
+
+
+def determine_file_stamps(fnames):
+    """
+    Returns the (modification time, size) of each file.  Used to invalidate the cached indices
+    and results.
+    """
+    stamps = []
+    for fname in fnames:
+        stat = os.stat(fname)
+        stamps.append([stat.st_mtime, stat.st_size])
+
+    return stamps
+
+
+def run_tasks(func, tasks, num_workers):
+    """
+    Runs ``func(*task)`` for each task, using a process pool if ``num_workers > 1``.  The
+    results are returned in the order of ``tasks``.
+    """
+
+    if num_workers is None:
+        num_workers = os.cpu_count()
+    num_workers = min(num_workers, len(tasks))
+
+    if num_workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [executor.submit(func, *task) for task in tasks]
+            return [future.result() for future in futures]
+
+    return [func(*task) for task in tasks]
@@ -208,30 +208,68 @@ test_file=$(ls test_sage.hdf5)
 
 # Now run the comparison between each correct binary file and the single HDF5 file.
 if [[ $? == 0 ]]; then
-    npassed=0
-    nfiles=0
-    nfailed=0
-    for f in ${correct_files[@]}; do
-        ((nfiles++))
-        # The two `1` at the end here denotes that the 'correct' SAGE files are in one file and
-        # the SAGE output we're testing was written to a single file.
-        python "$parent_path"/sagediff.py ${correct_files[${nfiles}-1]} ${test_file} binary-hdf5 1 1
-        if [[ $? == 0 ]]; then
-            ((npassed++))
-        else
-            ((nfailed++))
-        fi
-    done
+    nfiles=${#correct_files[@]}
+
+    # A single invocation compares every redshift file against its matching HDF5 snapshot, with the
+    # snapshots and fields split across all available cores.
+    # The two `1` at the end here denotes that the 'correct' SAGE files are in one file and
+    # the SAGE output we're testing was written to a single file.
+    # The result of each redshift file is printed as 'Result: <file> <snapshot> <status>', where the
+    # status is either 'identical', 'passed' or 'failed'.
+    logfile="$(mktemp)"
+    python "$parent_path"/sagediff.py correct-mini-millennium-output ${test_file} binary-hdf5 1 1 --all_snapshots | tee ${logfile}
+    sagediff_status=${PIPESTATUS[0]}
+
+    nbitwise=$(grep -c "^Result: .* identical$" ${logfile})
+    npassed=$(grep -c "^Result: .* \(identical\|passed\)$" ${logfile})
+    nfailed=$((nfiles - npassed))
+    rm -f ${logfile}
+
+    # If 'sagediff.py' failed without reporting a failed snapshot (e.g., it crashed), count it as a failure.
+    if [[ $sagediff_status != 0 && $nfailed == 0 ]]; then
+        nfailed=1
+    fi
 else
     # Even the simple ls failed which means the code didnt produce the output file
     npassed=0
     # Use the knowledge that there is 8 SAGE output files we were trying to check against.
     nfiles=8
+    nbitwise=0
     nfailed=$nfiles
 fi
-echo "Passed: $npassed."
+echo "Passed: $npassed. Bitwise identical: $nbitwise"
 echo "Failed: $nfailed."
 
+# Finally, check the Python tools against the binary and HDF5 outputs of the two runs above.
+# What each check compares is described in its docstring in 'sagecheck.py'. Each check prints
+# 'Check: <name> passed' or 'Check: <name> failed'.
+checks=(memmap projection tree_index parallel_read streaming hdf5_metadata hdf5_trees round_trip
+        parquet select spatial stats analyze_models cache incremental trees history grid timing)
+nchecks=0
+nchecks_failed=0
+for check in "${checks[@]}"; do
+    ((nchecks++))
+    python "$parent_path"/sagecheck.py $check --num_files $NUM_SAGE_PROCS
+    if [[ $? != 0 ]]; then
+        ((nchecks_failed++))
+    fi
+done
+
+echo "Checks passed: $((nchecks - nchecks_failed)) of $nchecks."
+nfailed=$((nfailed + nchecks_failed))
+
+# The unit tests of the Python tools ('test_*.py') do not need the SAGE output.
+python -c "import pytest" > /dev/null 2>&1
+if [[ $? == 0 ]]; then
+    python -m pytest -q -p no:cacheprovider "$parent_path"
+    if [[ $? != 0 ]]; then
+        echo "The unit tests of the Python tools failed."
+        ((nfailed++))
+    fi
+else
+    echo "'pytest' is not installed, so the unit tests of the Python tools were not run."
+fi
+
 # restore the original working dir
 cd "$cwd"
 exit $nfailed
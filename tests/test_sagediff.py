@@ -0,0 +1,192 @@
+import collections
+import re
+
+import pytest
+
+from sagebench import generate_synthetic_catalogs
+from sagediff import Hdf5Sage, compare_field_equality, load_hdf5_metadata
+from sageutils import lazy_import
+
+np = lazy_import("numpy")
+
+# The tolerances used by ``sagediff.py`` when comparing binary and HDF5 catalogs.
+rtol = 1e-9
+atol = 5e-5
+
+num_gals = 1000
+
+
+def parse_mismatch_report(report):
+    """
+    Returns the number of mismatched values and the (index, ``GalaxyIndex``) of the worst
+    mismatches, in the order printed by :py:func:`sagediff.compare_field_equality`.
+    """
+
+    num_bad = int(re.search(r"found (\d+) mis-matched values out of a total of {0}".format(
+        num_gals), report).group(1))
+
+    lines = report.split("\n")
+    start = [idx for idx, line in enumerate(lines) if line.startswith("# index")][0] + 1
+    worst = []
+    for line in lines[start:]:
+        if line.startswith("#"):
+            break
+        index, galaxy_index = line.split()[:2]
+        worst.append((int(index), int(galaxy_index)))
+
+    return num_bad, worst
+
+
+@pytest.fixture
+def galaxy_index():
+    return 63 * 10 ** 12 + np.arange(num_gals, dtype=np.int64)
+
+
+def test_compare_field_equality_1d(tmp_path, capsys, galaxy_index):
+    """
+    Only the values perturbed beyond the tolerances are reported, the worst first, and saved
+    with their errors.
+    """
+
+    rng = np.random.RandomState(7)
+    field1 = rng.uniform(1.0, 10.0, num_gals).astype(np.float32)
+    field2 = field1.copy()
+
+    # (index, perturbation), from the smallest to the largest error.  The first one is within
+    # the tolerances.
+    perturbations = [(17, 1e-6), (3, 0.01), (998, 0.5), (500, 2.0)]
+    for idx, perturbation in perturbations:
+        field2[idx] += perturbation
+
+    mismatch_fname = str(tmp_path / "StellarMass_mismatches.npz")
+    passed = compare_field_equality(field1, field2, "StellarMass", rtol, atol,
+                                    galaxy_index=galaxy_index, num_worst=2,
+                                    mismatch_fname=mismatch_fname)
+    assert not passed
+
+    num_bad, worst = parse_mismatch_report(capsys.readouterr().err)
+    assert num_bad == 3
+    assert worst == [(500, galaxy_index[500]), (998, galaxy_index[998])]
+
+    mismatches = np.load(mismatch_fname)
+    bad_idx = [3, 500, 998]
+    np.testing.assert_array_equal(mismatches["index"], bad_idx)
+    np.testing.assert_array_equal(mismatches["galaxy_index"], galaxy_index[bad_idx])
+    np.testing.assert_array_equal(mismatches["field1"], field1[bad_idx])
+    np.testing.assert_array_equal(mismatches["field2"], field2[bad_idx])
+
+    abs_err = np.abs(field1[bad_idx].astype(np.float64) - field2[bad_idx])
+    np.testing.assert_allclose(mismatches["abs_err"], abs_err)
+    np.testing.assert_allclose(mismatches["rel_err"], abs_err / np.abs(field2[bad_idx]))
+
+
+def test_compare_field_equality_3d(tmp_path, capsys, galaxy_index):
+    """
+    A galaxy is reported once however many of its components are perturbed, with the largest
+    error of its components.
+    """
+
+    rng = np.random.RandomState(8)
+    field1 = rng.uniform(0.0, 62.5, (num_gals, 3)).astype(np.float32)
+    field2 = field1.copy()
+
+    # (index, component, perturbation).  Galaxy 250 has two perturbed components.
+    perturbations = [(10, 1, 0.1), (250, 0, 0.2), (250, 2, 3.0), (777, 2, 1.0)]
+    for idx, component, perturbation in perturbations:
+        field2[idx, component] += perturbation
+
+    mismatch_fname = str(tmp_path / "Pos_mismatches.npz")
+    passed = compare_field_equality(field1, field2, "Pos", rtol, atol,
+                                    galaxy_index=galaxy_index, mismatch_fname=mismatch_fname)
+    assert not passed
+
+    num_bad, worst = parse_mismatch_report(capsys.readouterr().err)
+    assert num_bad == 3
+    assert worst == [(250, galaxy_index[250]), (777, galaxy_index[777]),
+                     (10, galaxy_index[10])]
+
+    mismatches = np.load(mismatch_fname)
+    bad_idx = [10, 250, 777]
+    np.testing.assert_array_equal(mismatches["index"], bad_idx)
+    np.testing.assert_array_equal(mismatches["galaxy_index"], galaxy_index[bad_idx])
+    np.testing.assert_array_equal(mismatches["field1"], field1[bad_idx])
+    np.testing.assert_array_equal(mismatches["field2"], field2[bad_idx])
+
+    abs_err = np.abs(field1[bad_idx].astype(np.float64) - field2[bad_idx]).max(axis=1)
+    np.testing.assert_allclose(mismatches["abs_err"], abs_err)
+    np.testing.assert_allclose(mismatches["abs_err"], [0.1, 3.0, 1.0], rtol=1e-5)
+
+
+def test_compare_field_equality_within_tolerance(tmp_path, capsys):
+
+    field1 = np.linspace(1.0, 2.0, num_gals)
+    field2 = field1 + 1e-6
+
+    mismatch_fname = str(tmp_path / "Mvir_mismatches.npz")
+    assert compare_field_equality(field1, field2, "Mvir", rtol, atol,
+                                  mismatch_fname=mismatch_fname)
+    assert compare_field_equality(field1, field1.copy(), "Mvir", rtol, atol,
+                                  mismatch_fname=mismatch_fname)
+
+    assert "mis-matched" not in capsys.readouterr().err
+    assert not (tmp_path / "Mvir_mismatches.npz").exists()
+
+
+@pytest.fixture
+def hdf5_opens(tmp_path, monkeypatch):
+    """
+    The HDF5 master file of a synthetic catalog written by two cores, and a counter of the
+    number of times each object of its files is opened, keyed by ``(file name, object
+    name)``.
+    """
+    import h5py
+
+    _, hdf5_fname = generate_synthetic_catalogs(str(tmp_path), 2000, 40, num_files=1,
+                                                num_cores=2, num_snapshots=3)
+
+    # Building the metadata index scans the files, so it is done before counting.
+    load_hdf5_metadata(hdf5_fname)
+
+    opens = collections.Counter()
+    getitem = h5py.Group.__getitem__
+
+    def counting_getitem(group, name):
+        obj = getitem(group, name)
+        opens[(obj.file.filename, obj.name)] += 1
+        return obj
+
+    monkeypatch.setattr(h5py.Group, "__getitem__", counting_getitem)
+
+    return hdf5_fname, opens
+
+
+def test_hdf5_sage_opens_datasets_once(hdf5_opens):
+    """
+    Reading every field at every snapshot (twice), and seeking to and iterating over the trees,
+    opens each dataset and resolves each core's external link once per reader.
+    """
+    hdf5_fname, opens = hdf5_opens
+
+    for _ in range(2):
+        with Hdf5Sage(hdf5_fname) as g:
+            ncores = g.ncores
+            snap_keys = g.metadata["snap_keys"]
+
+            for _ in range(2):
+                for snap_key in snap_keys:
+                    for key in g.determine_fields(snap_key):
+                        g.read_field(snap_key, key)
+                    g.read_tree(3, snap_key)
+                    for _ in g.iter_trees(snap_key, chunk_size=500):
+                        pass
+
+        datasets = [(fname, name) for (fname, name) in opens
+                    if name.split("/")[1] in snap_keys and name.count("/") == 2]
+        assert len(datasets) > ncores * len(snap_keys)
+        assert [opens[dataset] for dataset in datasets] == [1] * len(datasets)
+
+        core_roots = [(fname, name) for (fname, name) in opens if name == "/"]
+        assert len(core_roots) == ncores
+        assert [opens[core_root] for core_root in core_roots] == [1] * ncores
+
+        opens.clear()
@@ -0,0 +1,97 @@
+import pytest
+
+from sagegrid import expand_parameter_grid, parse_parameter_grid, write_parameter_file
+from sageutils import read_parameter_file
+
+# A parameter file in the layout of ``input/millennium.par``, with comments, a commented-out
+# parameter and the list of output snapshots.
+base_parameters = """%------------------------------------------
+%----- SAGE output file information -------
+%------------------------------------------
+
+FileNameGalaxies       model
+OutputDir              ./output/ ; the trailing slash is required
+
+NumOutputs        2   ; sets the desired number of galaxy outputs
+-> 63 37              ; list your output snapshots
+
+%------------------------------------------
+%----- Recipe parameters ------------------
+%------------------------------------------
+
+SfrEfficiency           0.05  % the star formation efficiency
+% RadioModeEfficiency   0.08
+ReIncorporationFactor   0.15"""
+
+
+def test_expand_parameter_grid():
+    """
+    Every combination is listed once, varying the last parameter (by name) fastest, and the
+    values are strings.
+    """
+
+    grid = {"SfrEfficiency": [0.03, 0.05], "RadioModeEfficiency": ["0.08", "0.1", "0.2"]}
+
+    points = expand_parameter_grid(grid)
+
+    assert points == [{"RadioModeEfficiency": radio, "SfrEfficiency": sfr}
+                      for radio in ["0.08", "0.1", "0.2"] for sfr in ["0.03", "0.05"]]
+
+
+def test_expand_parameter_grid_single_value():
+    assert expand_parameter_grid({"SfrEfficiency": ["0.05"]}) == [{"SfrEfficiency": "0.05"}]
+
+
+def test_parse_parameter_grid():
+
+    grid = parse_parameter_grid(["SfrEfficiency=0.03,0.05", "RadioModeEfficiency=0.08"])
+
+    assert grid == {"SfrEfficiency": ["0.03", "0.05"], "RadioModeEfficiency": ["0.08"]}
+
+
+@pytest.mark.parametrize("spec", ["SfrEfficiency", "SfrEfficiency=", "=0.03"])
+def test_parse_parameter_grid_invalid(spec):
+
+    with pytest.raises(ValueError):
+        parse_parameter_grid([spec])
+
+
+def test_write_parameter_file(tmp_path):
+    """
+    The overridden parameters take their new values, missing ones are appended and everything
+    else (comments, commented-out parameters, the output snapshots) is kept as it was.
+    """
+
+    base_param_fname = tmp_path / "base.par"
+    base_param_fname.write_text(base_parameters)
+    param_fname = tmp_path / "grid.par"
+
+    write_parameter_file(str(base_param_fname), {"SfrEfficiency": "0.1",
+                                                 "RadioModeEfficiency": "0.2",
+                                                 "OutputDir": "/grid/point_0/"},
+                         str(param_fname))
+
+    expected = read_parameter_file(str(base_param_fname))
+    expected.update({"SfrEfficiency": "0.1", "RadioModeEfficiency": "0.2",
+                     "OutputDir": "/grid/point_0/"})
+    assert read_parameter_file(str(param_fname)) == expected
+
+    base_lines = base_parameters.split("\n")
+    lines = param_fname.read_text().split("\n")
+
+    # Only the overridden lines differ, and the new parameter follows the base file.
+    changed = [idx for idx, (base_line, line) in enumerate(zip(base_lines, lines))
+               if base_line != line]
+    assert [base_lines[idx].split()[0] for idx in changed] == ["OutputDir", "SfrEfficiency"]
+    assert lines[len(base_lines):] == ["RadioModeEfficiency    0.2", ""]
+
+
+def test_write_parameter_file_no_overrides(tmp_path):
+
+    base_param_fname = tmp_path / "base.par"
+    base_param_fname.write_text(base_parameters + "\n")
+    param_fname = tmp_path / "copy.par"
+
+    write_parameter_file(str(base_param_fname), {}, str(param_fname))
+
+    assert param_fname.read_text() == base_parameters + "\n"
@@ -0,0 +1,116 @@
+import math
+
+import pytest
+
+from sagebench import generate_synthetic_catalogs
+from sagediff import BinarySage, find_binary_redshift_files
+from sagegroupby import determine_group_keys, group_catalog
+from sageutils import lazy_import
+
+np = lazy_import("numpy")
+
+# The synthetic catalogs are small, so that the galaxy-by-galaxy grouping stays fast.
+num_gals = 2000
+num_trees = 40
+num_files = 3
+num_cores = 2
+
+# The fields and reductions of every grouping.
+group_fields = ["StellarMass", "ColdGas", "Len"]
+group_reductions = ("sum", "min", "max")
+
+
+@pytest.fixture(scope="module")
+def catalogs(tmp_path_factory):
+    """
+    The binary model prefix and HDF5 master file of a synthetic catalog with two snapshots.
+    """
+    work_dir = str(tmp_path_factory.mktemp("groupby"))
+
+    return generate_synthetic_catalogs(work_dir, num_gals, num_trees, num_files, num_cores,
+                                       num_snapshots=2)
+
+
+def brute_force_group(gals, keys, fields, mask):
+    """
+    Groups the galaxies ``gals`` by ``keys`` one galaxy at a time.  Returns a dictionary keyed
+    by the group key holding the number of galaxies where ``mask`` is ``True`` and, for each
+    field, the list of their values.
+    """
+
+    groups = {}
+    for row, key in enumerate(keys):
+        group = groups.setdefault(key, {"count": 0, "values": dict((field, [])
+                                                                  for field in fields)})
+        if not mask[row]:
+            continue
+
+        group["count"] += 1
+        for field in fields:
+            group["values"][field].append(gals[field][row])
+
+    return groups
+
+
+def assert_group_aggregates_equal(expected, aggregates, fields):
+    """
+    Asserts that the ``aggregates`` (see :py:func:`sagegroupby.group_catalog`) of the sum, min
+    and max of ``fields`` equal the brute-force grouping ``expected`` (see
+    :py:func:`~brute_force_group`).  Sums only need to agree to rounding.
+    """
+
+    assert aggregates["keys"].tolist() == sorted(expected)
+
+    for group_idx, key in enumerate(aggregates["keys"]):
+        group = expected[key]
+
+        assert aggregates["count"][group_idx] == group["count"], key
+
+        for field in fields:
+            values = group["values"][field]
+            assert math.isclose(aggregates["{0}_sum".format(field)][group_idx],
+                                math.fsum(values), rel_tol=1e-12), (key, field)
+
+            # Groups without any selected galaxy hold the identity of min and max.
+            if values:
+                assert aggregates["{0}_min".format(field)][group_idx] == min(values), (key, field)
+                assert aggregates["{0}_max".format(field)][group_idx] == max(values), (key, field)
+
+
+@pytest.mark.parametrize("output_format", ["sage_binary", "sage_hdf5"])
+@pytest.mark.parametrize("key_field", ["CentralGalaxyIndex", "SAGEHaloIndex"])
+@pytest.mark.parametrize("centrals_only", [False, True])
+def test_group_catalog_equals_brute_force(catalogs, output_format, key_field, centrals_only):
+    """
+    Grouping either format (serially, in parallel and again from the cached grouping) gives
+    the counts, sums, minima and maxima of a brute-force grouping.
+    """
+    binary_prefix, hdf5_fname = catalogs
+    catalog_fname = binary_prefix if output_format == "sage_binary" else hdf5_fname
+
+    for binary_fname in find_binary_redshift_files(binary_prefix):
+
+        gals = BinarySage(binary_fname, num_files=num_files).read_gals()
+        snap_key = "Snap_{0}".format(gals["SnapNum"][0])
+
+        keys = determine_group_keys(gals, key_field).tolist()
+        if centrals_only:
+            predicates, mask = [("Type", "==", 0)], gals["Type"] == 0
+        else:
+            predicates, mask = None, np.ones(len(gals), dtype=bool)
+
+        expected = brute_force_group(gals, keys, group_fields, mask)
+
+        # The first call builds the grouping, the others read it from the cache.
+        for num_workers in [1, 2, 1]:
+            aggregates = group_catalog(catalog_fname, snap_key, key_field, group_fields,
+                                       group_reductions, predicates, num_files, num_workers)
+            assert_group_aggregates_equal(expected, aggregates, group_fields)
+
+
+def test_group_catalog_missing_snapshot(catalogs):
+    binary_prefix, _ = catalogs
+
+    with pytest.raises(ValueError):
+        group_catalog(binary_prefix, "Snap_0", "CentralGalaxyIndex", group_fields,
+                      num_files=num_files, num_workers=1)
@@ -0,0 +1,78 @@
+import os
+import time
+
+from sagestats import ResultCache
+
+
+def set_last_used(cache, key, seconds_ago):
+    """
+    Marks the result cached under ``key`` as last used ``seconds_ago`` seconds ago (without
+    relying on the resolution of the file system clock).
+    """
+    last_used = time.time() - seconds_ago
+    os.utime(cache.determine_fname(key), (last_used, last_used))
+
+
+def test_result_cache_round_trip(tmp_path):
+
+    cache = ResultCache(str(tmp_path / "cache"))
+
+    assert cache.get("model") is None
+
+    result = {"history": [{"redshift": 0.0, "SMF": [1, 2, 3]}], "version": 1}
+    cache.put("model", result)
+
+    assert cache.get("model") == result
+    assert os.listdir(str(tmp_path / "cache")) == ["model.json"]
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    """
+    Once the cache grows beyond its size, the results that were read or written longest ago are
+    removed first.  Reading a result makes it the most recently used.
+    """
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    for key, seconds_ago in [("a", 30), ("b", 20), ("c", 10)]:
+        cache.put(key, {"value": key})
+        set_last_used(cache, key, seconds_ago)
+
+    # Each result takes the same number of bytes.  Room is left for three of them.
+    cache.max_size = 3 * os.path.getsize(cache.determine_fname("a"))
+
+    assert cache.get("a") == {"value": "a"}
+    cache.put("d", {"value": "d"})
+
+    assert sorted(os.listdir(cache.cache_dir)) == ["a.json", "c.json", "d.json"]
+    assert cache.get("b") is None
+
+    set_last_used(cache, "d", 5)
+    cache.put("e", {"value": "e"})
+
+    assert sorted(os.listdir(cache.cache_dir)) == ["a.json", "d.json", "e.json"]
+
+
+def test_result_cache_unwritable(tmp_path):
+    """
+    A cache that cannot be written to is not an error, it just never holds any results.
+    """
+
+    # A file where the cache directory should be.
+    cache_dir = tmp_path / "cache"
+    cache_dir.write_text("")
+    cache = ResultCache(str(cache_dir))
+
+    cache.put("model", {"value": 1})
+
+    assert cache.get("model") is None
+
+
+def test_result_cache_ignores_corrupt_results(tmp_path):
+
+    cache = ResultCache(str(tmp_path / "cache"))
+    cache.put("model", {"value": 1})
+
+    with open(cache.determine_fname("model"), "w") as f:
+        f.write("{")
+
+    assert cache.get("model") is None
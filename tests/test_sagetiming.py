@@ -0,0 +1,134 @@
+import pytest
+
+from sagetiming import compute_cost_against_size, determine_timing_fname, \
+    find_slowest_forests, forest_timing_dtype, read_forest_timings, read_run_timings, \
+    summarize_task_imbalance, timing_header_dtype
+from sageutils import lazy_import
+
+np = lazy_import("numpy")
+
+# The wall time (in seconds) of each task of the synthetic run.  Task 1 has no forests, and
+# writes no timings file.
+task_seconds = np.array([3.0, 0.5, 2.0])
+tasks_with_forests = [0, 2]
+
+
+def write_synthetic_timings(timing_prefix, task_forests, task_seconds):
+    """
+    Writes the forest timings files of a run with ``len(task_seconds)`` tasks, as written by
+    ``write_forest_timings()`` in ``sage.c``.  ``task_forests`` maps each task to its forests
+    (an array of ``forest_timing_dtype``); tasks without forests do not write a file.
+    """
+
+    for task, forests in task_forests.items():
+        header = np.array([(task, len(task_seconds), len(forests), task_seconds[task])],
+                          dtype=timing_header_dtype)
+        with open(determine_timing_fname(timing_prefix, task), "wb") as fp:
+            header.tofile(fp)
+            forests.tofile(fp)
+
+
+@pytest.fixture
+def synthetic_run(tmp_path):
+    """
+    The timing prefix and the forests of each task of a synthetic run, whose cost grows
+    linearly with the number of halos.
+    """
+
+    rng = np.random.RandomState(1)
+    task_forests = {}
+    for task in tasks_with_forests:
+        forests = np.zeros(rng.randint(5, 50), dtype=forest_timing_dtype)
+        forests["original_treenr"] = np.arange(len(forests))
+        forests["nhalos"] = rng.randint(1, 10000, size=len(forests))
+        forests["filenr"] = task
+        forests["ngals"] = rng.randint(0, 1000, size=len(forests))
+        forests["seconds"] = forests["nhalos"] * rng.uniform(1e-5, 1e-4, size=len(forests))
+        task_forests[task] = forests
+
+    timing_prefix = str(tmp_path / "synthetic")
+    write_synthetic_timings(timing_prefix, task_forests, task_seconds)
+
+    return timing_prefix, task_forests
+
+
+def test_read_run_timings(synthetic_run):
+    """
+    The forests of every task are read in task order and tasks without a file are included
+    with no time.
+    """
+    timing_prefix, task_forests = synthetic_run
+
+    timings = read_run_timings(timing_prefix)
+
+    expected_forests = np.concatenate([task_forests[task] for task in tasks_with_forests])
+    for name, _ in forest_timing_dtype:
+        np.testing.assert_array_equal(timings["forests"][name], expected_forests[name])
+
+    np.testing.assert_array_equal(timings["forests"]["task"],
+                                  np.repeat(tasks_with_forests,
+                                            [len(task_forests[task])
+                                             for task in tasks_with_forests]))
+    np.testing.assert_array_equal(timings["task_seconds"], [3.0, 0.0, 2.0])
+
+
+def test_read_run_timings_missing(tmp_path):
+
+    with pytest.raises(ValueError):
+        read_run_timings(str(tmp_path / "missing"))
+
+
+def test_read_forest_timings_truncated(synthetic_run):
+    """
+    A file holding fewer forests than its header promises is rejected.
+    """
+    timing_prefix, _ = synthetic_run
+
+    fname = determine_timing_fname(timing_prefix, 0)
+    with open(fname, "rb") as fp:
+        data = fp.read()
+    with open(fname, "wb") as fp:
+        fp.write(data[:-1])
+
+    with pytest.raises(ValueError):
+        read_forest_timings(fname)
+
+
+def test_summarize_task_imbalance(synthetic_run):
+    timing_prefix, task_forests = synthetic_run
+
+    summary = summarize_task_imbalance(read_run_timings(timing_prefix))
+
+    for task in range(len(task_seconds)):
+        forests = task_forests.get(task, np.zeros(0, dtype=forest_timing_dtype))
+        assert summary["nforests"][task] == len(forests)
+        assert summary["nhalos"][task] == forests["nhalos"].sum()
+        assert summary["ngals"][task] == forests["ngals"].sum()
+        assert np.isclose(summary["forest_seconds"][task], forests["seconds"].sum())
+
+    assert np.isclose(summary["imbalance"], 3.0 / np.mean([3.0, 0.0, 2.0]))
+
+
+def test_compute_cost_against_size(synthetic_run):
+    """
+    Every forest falls in a bin, and the cost of the synthetic forests scales (roughly)
+    linearly with their number of halos.
+    """
+    timing_prefix, _ = synthetic_run
+
+    forests = read_run_timings(timing_prefix)["forests"]
+    cost = compute_cost_against_size(forests)
+
+    assert cost["nforests"].sum() == len(forests)
+    assert np.isclose(cost["seconds"].sum(), forests["seconds"].sum())
+    assert 0.5 < cost["exponent"] < 1.5
+
+
+def test_find_slowest_forests(synthetic_run):
+    timing_prefix, _ = synthetic_run
+
+    timings = read_run_timings(timing_prefix)
+    slowest, _ = find_slowest_forests(timings, 5)
+
+    np.testing.assert_array_equal(np.sort(slowest["seconds"]),
+                                  np.sort(timings["forests"]["seconds"])[-5:])